@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Parse micro-benchmark for the endpoint readings.
+
+Builds a 2030.5 Reading payload for every endpoint in each of the
+endpoints_*.yaml configs (same element layout the meter returns) and
+times the old find() based parser against the compiled TagPlan.
+
+Usage: python3 scripts/bench_parse.py [-n ITERATIONS]
+"""
+import sys
+import argparse
+import timeit
+import yaml
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'
+sys.path.insert(0, str(PACKAGE_DIR))
+
+from xcelEndpoint import TagPlan, IEEE_PREFIX
+from mock_meter import sample_reading
+
+
+def legacy_parse(response: str, tags: dict) -> dict:
+    """
+    The pre-TagPlan parser, kept here as the baseline.
+    """
+    readings_dict = {}
+    root = ET.fromstring(response)
+    for k, v in tags.items():
+        if isinstance(v, list):
+            for val_items in v:
+                for k2, v2 in val_items.items():
+                    search_val = f'{IEEE_PREFIX}{k2}'
+                    if root.find(f'.//{search_val}') is not None:
+                        readings_dict[f'{k}{k2}'] = root.find(f'.//{search_val}').text
+        else:
+            if root.find(f'.//{IEEE_PREFIX}{k}') is not None:
+                readings_dict[k] = root.find(f'.//{IEEE_PREFIX}{k}').text
+    return readings_dict
+
+
+def bench_config(config_path: Path, iterations: int) -> None:
+    with open(config_path, mode='r', encoding='utf-8') as file:
+        endpoints = yaml.safe_load(file)
+    cases = []
+    for point in endpoints:
+        for _, v in point.items():
+            cases.append((sample_reading(v['url'], v['tags']), v['tags'], TagPlan(v['tags'])))
+
+    # Both parsers must agree before the numbers mean anything
+    for payload, tags, plan in cases:
+        assert legacy_parse(payload, tags) == plan.extract(payload), payload
+
+    def sweep_legacy():
+        for payload, tags, _ in cases:
+            legacy_parse(payload, tags)
+
+    def sweep_plan():
+        for payload, _, plan in cases:
+            plan.extract(payload)
+
+    legacy = min(timeit.repeat(sweep_legacy, number=iterations, repeat=3)) / iterations
+    planned = min(timeit.repeat(sweep_plan, number=iterations, repeat=3)) / iterations
+    print(f'{config_path.name}: {len(cases)} endpoints per sweep')
+    print(f'  legacy find():  {legacy * 1e6:9.1f} us/sweep')
+    print(f'  TagPlan:        {planned * 1e6:9.1f} us/sweep ({legacy / planned:.2f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    for config_path in sorted((PACKAGE_DIR / 'configs').glob('endpoints_*.yaml')):
+        bench_config(config_path, args.iterations)
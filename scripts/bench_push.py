@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Meter request load and reading freshness, polling vs 2030.5 push.
+
+Runs the bridge's main loop against the mock meter and broker for a
+while, once polling every endpoint and once with METER_PUSH_PORT set so
+the mock pushes notifications instead. Reports how many requests the
+meter had to answer once everything was set up, how many readings it
+pushed and how long the bridge took to publish each one. Each mode
+runs in its own process so they don't share state.
+
+Usage: python3 scripts/bench_push.py [--duration 30] [--notify-interval 5] [--unsubscribable 2]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import warnings
+import multiprocessing
+from pathlib import Path
+
+from mock_meter import MockMeter, PACKAGE_DIR, generate_certs, add_arguments
+from mock_broker import MockBroker
+
+
+def run_mode(args, push: bool, pipe) -> None:
+    logging.basicConfig(level=logging.ERROR)
+    warnings.simplefilter('ignore')
+    with tempfile.TemporaryDirectory() as tmp:
+        certs = generate_certs(Path(tmp))
+        meter = MockMeter(args.config, certs, latency=args.latency, jitter=args.jitter,
+                          notify_interval=args.notify_interval if push else 0.0)
+        # The first few resources are left for polling, like a meter that won't subscribe to everything
+        meter.push_resources = set(list(meter.resources)[args.unsubscribable:])
+        meter.start()
+        broker = MockBroker().start()
+        os.environ.update({'MQTT_SERVER': '127.0.0.1', 'MQTT_PORT': str(broker.port),
+                           'MQTT_HEARTBEAT': '0'})
+        if push:
+            os.environ.update({'METER_PUSH_PORT': '0', 'METER_PUSH_HOST': '127.0.0.1'})
+        os.chdir(PACKAGE_DIR)
+        sys.path.insert(0, str(PACKAGE_DIR))
+        from xcelMeter import xcelMeter
+
+        bridge = xcelMeter('Bench Meter', '127.0.0.1', meter.port, certs)
+        # Only count steady state, not the hardware query and subscription setup
+        before = meter.stats()
+        intervals = [bridge.scheduler.stats_for(obj)['interval'] for obj in bridge.endpoints]
+        threading.Thread(target=bridge.run, daemon=True).start()
+        time.sleep(args.duration)
+        after = meter.stats()
+        pipe.send({'requests': after['requests'] - before['requests'],
+                   'notifications': after['notifications'], 'notify_ms': after['notify_ms'],
+                   'subscriptions': after['subscriptions'], 'endpoints': len(intervals),
+                   'polls_per_min': sum(60 / i for i in intervals), 'publishes': broker.stats()['publishes']})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_arguments(parser)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--notify-interval', type=float, default=5.0,
+                        help='how often the mock pushes each subscribed reading')
+    parser.add_argument('--unsubscribable', type=int, default=2,
+                        help='# of resources the mock refuses subscriptions for')
+    args = parser.parse_args()
+    args.config = args.config.resolve()
+
+    context = multiprocessing.get_context('fork')
+    for push in (False, True):
+        parent, child = context.Pipe()
+        proc = context.Process(target=run_mode, args=(args, push, child), daemon=True)
+        proc.start()
+        results = parent.recv()
+        proc.kill()
+        print(f"{'push' if push else 'poll'}: {results['requests']} meter requests, "
+              f"{results['notifications']} notifications, {results['publishes']} publishes in "
+              f"{args.duration:.0f}s ({results['subscriptions']} of {results['endpoints']} endpoints pushed, "
+              f"{results['polls_per_min']:.0f} polls/min scheduled)")
+        if push:
+            print(f"  notification to published: {results['notify_ms']:.1f}ms mean")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Write throughput and replay time of the MQTT store-and-forward spool.
+
+Spools readings the way an outage would (a mix of coalesced
+measurements and kept totals) with no broker around, then points the
+client at the mock broker and times how long the backlog takes to
+drain. Replay runs unpaced unless --rate is given.
+
+Usage: python3 scripts/bench_spool.py [--readings 20000] [--sensors 20] [--rate 0]
+"""
+import sys
+import time
+import logging
+import argparse
+import tempfile
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+from mock_meter import PACKAGE_DIR
+from mock_broker import MockBroker
+
+sys.path.insert(0, str(PACKAGE_DIR))
+
+from xcelSpool import xcelSpool
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        broker = MockBroker().start()
+        client = mqtt.Client()
+        spool = xcelSpool(str(Path(tmp) / 'spool.db'), client, max_rows=args.max_rows, rate=args.rate)
+
+        start = time.perf_counter()
+        for i in range(args.readings):
+            sensor = i % args.sensors
+            # Half the sensors are measurements, only their latest reading is kept
+            spool.put(f'homeassistant/sensor/Bench/sensor_{sensor}/state', str(i),
+                      coalesce=sensor % 2 == 1)
+        write = time.perf_counter() - start
+        depth = len(spool)
+
+        client.connect(broker.host, broker.port)
+        client.loop_start()
+        start = time.perf_counter()
+        while len(spool) and time.perf_counter() - start < args.timeout:
+            time.sleep(0.005)
+        replay = time.perf_counter() - start
+        # Let paho flush its socket before counting what arrived
+        time.sleep(0.2)
+        stats = spool.stats()
+        spool.close()
+        client.loop_stop()
+        client.disconnect()
+        broker.stop()
+
+    return {
+        'readings': args.readings,
+        'write_s': write,
+        'writes_per_s': args.readings / write,
+        'depth': depth,
+        'replay_s': replay,
+        'replayed_per_s': stats['replayed'] / replay if replay else 0,
+        'broker_publishes': broker.stats()['publishes'],
+        'spool': stats,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--readings', type=int, default=20000)
+    parser.add_argument('--sensors', type=int, default=20, help='distinct topics the readings are spread over')
+    parser.add_argument('--max-rows', type=int, default=100000, help='MQTT_SPOOL_MAX for the spool')
+    parser.add_argument('--rate', type=float, default=0, help='MQTT_SPOOL_RATE for the replay, 0 is unpaced')
+    parser.add_argument('--timeout', type=float, default=120, help='give up on the replay after this long')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    results = run(args)
+    print(f"{results['readings']} readings over {args.sensors} sensors")
+    print(f"  write:   {results['write_s'] * 1000:.0f}ms ({results['writes_per_s']:.0f}/s), "
+          f"{results['depth']} kept after coalescing")
+    print(f"  replay:  {results['replay_s'] * 1000:.0f}ms ({results['replayed_per_s']:.0f}/s), "
+          f"{results['broker_publishes']} reached the broker")
+    print(f"  spool:   {results['spool']}")
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Sweep latency benchmark for concurrent endpoint fetching.
+
+Starts the mock meter with a fixed per-request latency and times full
+sweeps of every endpoint in the config at concurrency 1 through N,
+using the same session and polling code as xcelMeter.
+
+Usage: python3 scripts/bench_sweep.py [--max-concurrency 4] [--latency 0.05]
+"""
+import sys
+import time
+import logging
+import warnings
+import argparse
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import paho.mqtt.client as mqtt
+
+from mock_meter import MockMeter, PACKAGE_DIR, generate_certs
+
+sys.path.insert(0, str(PACKAGE_DIR))
+
+from xcelMeter import xcelMeter
+from xcelEndpoint import xcelEndpoint
+
+DEVICE_INFO = {'device': {'identifiers': ['0' * 40], 'name': 'Bench Meter',
+                          'model': 'Itron', 'sw_version': '3.2.50'}}
+
+
+def bench(meter: MockMeter, certs: tuple, concurrency: int, sweeps: int) -> float:
+    """
+    Returns: tuple of (mean seconds per sweep, adapter connection stats)
+    """
+    session = xcelMeter._setup_session(certs, meter.host, concurrency)
+    # Never connected, publishes just get dropped
+    client = mqtt.Client()
+    base_url = f'https://{meter.host}:{meter.port}'
+    endpoints = [xcelEndpoint(session, client, f'{base_url}{url}', url, tags, DEVICE_INFO)
+                 for url, tags in meter.resources.items()]
+    executor = ThreadPoolExecutor(max_workers=concurrency) if concurrency > 1 else None
+    # Warm up the connection pool so handshakes aren't part of the numbers
+    xcelMeter.poll_endpoints(endpoints, executor)
+    start = time.perf_counter()
+    for _ in range(sweeps):
+        xcelMeter.poll_endpoints(endpoints, executor)
+    elapsed = (time.perf_counter() - start) / sweeps
+    stats = session.get_adapter(base_url).connection_stats()
+    if executor:
+        executor.shutdown()
+    session.close()
+    return elapsed, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--config', type=Path, default=PACKAGE_DIR / 'configs' / 'endpoints_3_2_50.yaml')
+    parser.add_argument('--max-concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the mock takes per response')
+    parser.add_argument('--sweeps', type=int, default=5)
+    args = parser.parse_args()
+    # Every publish fails with no broker, keep that out of the output
+    logging.disable(logging.CRITICAL)
+    # Same as run.sh's -Wignore, verify=False warns on every request
+    warnings.simplefilter('ignore')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        certs = generate_certs(Path(tmp))
+        meter = MockMeter(args.config, certs, latency=args.latency).start()
+        print(f'{len(meter.resources)} endpoints, {args.latency * 1000:.0f}ms per response')
+        baseline = None
+        for concurrency in range(1, args.max_concurrency + 1):
+            elapsed, stats = bench(meter, certs, concurrency, args.sweeps)
+            baseline = baseline or elapsed
+            print(f'  concurrency {concurrency}: {elapsed * 1000:8.1f} ms/sweep ({baseline / elapsed:.2f}x), '
+                  f"{stats['requests']} requests over {stats['handshakes']} handshakes + "
+                  f"{stats['resumptions']} resumptions")
+        meter.stop()
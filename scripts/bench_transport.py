@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+CPU cost per meter request, requests session vs the lean transport.
+
+The mock meter runs in a child process so only the client side is
+measured: every endpoint in the config is fetched and parsed in turn
+over one kept-alive connection, first through the requests.Session the
+bridge uses by default, then through xcelTransport (METER_TRANSPORT=lean).
+Reports CPU and wall time per request. No network access needed.
+
+Usage: python3 scripts/bench_transport.py [-n REQUESTS] [--config endpoints.yaml]
+"""
+import sys
+import time
+import argparse
+import tempfile
+import warnings
+import multiprocessing
+import yaml
+from pathlib import Path
+
+from mock_meter import MockMeter, PACKAGE_DIR, generate_certs
+
+sys.path.insert(0, str(PACKAGE_DIR))
+
+from xcelEndpoint import TagPlan
+from xcelMeter import xcelMeter
+
+
+def serve_meter(config: Path, certs: tuple, pipe) -> None:
+    meter = MockMeter(config, certs).start()
+    pipe.send(meter.port)
+    pipe.recv()
+    meter.stop()
+
+
+def load_cases(config: Path, base_url: str) -> list:
+    with open(config, mode='r', encoding='utf-8') as file:
+        endpoints = yaml.safe_load(file)
+    return [(f'{base_url}{v["url"]}', TagPlan(v['tags']))
+            for point in endpoints for v in point.values()]
+
+
+def measure(fetch, cases: list, requests: int) -> tuple:
+    """
+    Returns: tuple of (cpu, wall) seconds per request
+    """
+    # Connect and warm up caches first
+    for url, plan in cases:
+        plan.extract(fetch(url))
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(requests):
+        url, plan = cases[i % len(cases)]
+        plan.extract(fetch(url))
+    return ((time.process_time() - cpu_start) / requests,
+            (time.perf_counter() - wall_start) / requests)
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        certs = generate_certs(Path(tmp))
+        parent, child = multiprocessing.Pipe()
+        mock = multiprocessing.get_context('fork').Process(target=serve_meter,
+                                                           args=(args.config, certs, child), daemon=True)
+        mock.start()
+        port = parent.recv()
+        base_url = f'https://127.0.0.1:{port}'
+        cases = load_cases(args.config, base_url)
+
+        session = xcelMeter._setup_session(certs, '127.0.0.1')
+        def fetch_requests(url):
+            x = session.get(url, verify=False, timeout=15.0)
+            x.raise_for_status()
+            return x.text
+
+        transport = xcelMeter._setup_transport(session, base_url)
+        def fetch_lean(url):
+            return transport.get(url, timeout=15.0)
+
+        results = {
+            'requests': measure(fetch_requests, cases, args.requests),
+            'lean': measure(fetch_lean, cases, args.requests),
+            'connections': {'requests': session.get_adapter(base_url).connection_stats(),
+                            'lean': transport.connection_stats()},
+        }
+        session.close()
+        transport.close()
+        parent.send('stop')
+        mock.join(timeout=5)
+
+        return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('--config', type=Path, default=PACKAGE_DIR / 'configs' / 'endpoints_3_2_50.yaml')
+    args = parser.parse_args()
+    args.config = args.config.resolve()
+    # Same as run.sh's -Wignore, verify=False warns on every request
+    warnings.simplefilter('ignore')
+
+    results = run(args)
+    base_cpu = results['requests'][0]
+    print(f'{args.requests} requests against {args.config.name}')
+    for name in ('requests', 'lean'):
+        cpu, wall = results[name]
+        print(f'  {name + ":":<10} cpu {cpu * 1e6:8.1f} us/request  wall {wall * 1e6:8.1f} us/request  '
+              f'({base_cpu / cpu:.2f}x)  {results["connections"][name]}')
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the bridge against the mock meter and broker.
+
+The mock meter and mock broker run in a child process so the numbers
+below only cover the bridge itself: a real xcelMeter is built against
+them and full sweeps of every endpoint are run back to back. Reports
+sweep latency, publishes per second, CPU time per endpoint poll and
+RSS. No network access needed.
+
+Usage: python3 scripts/benchmark.py [--sweeps 20] [--latency 0.05] [--concurrency 1]
+                                    [--state-json endpoint] [--batch-reads] [--pipeline]
+                                    [--mqtt-version 5] [--transport lean] [--json]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import warnings
+import statistics
+import multiprocessing
+from pathlib import Path
+
+from mock_meter import MockMeter, PACKAGE_DIR, generate_certs, add_arguments
+from mock_broker import MockBroker
+
+
+def serve_mocks(args, certs: tuple, pipe) -> None:
+    """
+    Child process, runs both mocks until told to stop then reports
+    their counters back over the pipe.
+    """
+    meter = MockMeter(args.config, certs, latency=args.latency, jitter=args.jitter,
+                      error_rate=args.error_rate, drop_rate=args.drop_rate, broken=args.broken).start()
+    broker = MockBroker().start()
+    pipe.send((meter.port, broker.port))
+    while pipe.recv() != 'stop':
+        pipe.send((meter.stats(), broker.stats()))
+    pipe.send((meter.stats(), broker.stats()))
+    meter.stop()
+    broker.stop()
+
+
+def rss_kb() -> tuple:
+    """
+    Returns: tuple of (current, peak) resident set size in KB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    current = peak
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1])
+    except OSError:
+        pass
+    return current, peak
+
+
+def percentile(samples: list, pct: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def run(args) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        certs = generate_certs(Path(tmp))
+        parent, child = multiprocessing.Pipe()
+        mocks = multiprocessing.get_context('fork').Process(target=serve_mocks, args=(args, certs, child),
+                                                            daemon=True)
+        mocks.start()
+        meter_port, broker_port = parent.recv()
+
+        os.environ.update({'MQTT_SERVER': '127.0.0.1', 'MQTT_PORT': str(broker_port),
+                           'METER_CONCURRENCY': str(args.concurrency),
+                           'MQTT_HEARTBEAT': str(args.heartbeat),
+                           'MQTT_STATE_JSON': args.state_json,
+                           'METER_BATCH_READS': '1' if args.batch_reads else '',
+                           'METER_PIPELINE': '1' if args.pipeline else '',
+                           'MQTT_VERSION': args.mqtt_version,
+                           'METER_TRANSPORT': args.transport,
+                           'METER_TTL': args.ttl})
+        # xcelMeter looks for configs/ relative to where it's run from, same as run.sh
+        os.chdir(PACKAGE_DIR)
+        sys.path.insert(0, str(PACKAGE_DIR))
+        from xcelMeter import xcelMeter
+
+        meter = xcelMeter('Bench Meter', '127.0.0.1', meter_port, certs)
+        deadline = time.monotonic() + 5
+        while not meter.mqtt_client.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # One sweep to get connections and caches warm
+        meter.poll_due(meter.endpoints)
+        parent.send('stats')
+        _, broker_before = parent.recv()
+
+        latencies = []
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        for _ in range(args.sweeps):
+            start = time.perf_counter()
+            meter.poll_due(meter.endpoints)
+            latencies.append(time.perf_counter() - start)
+        # Sweeps only cover fetching with the pipeline, wait for it to publish the rest
+        while meter.pipeline is not None and not meter.pipeline.idle():
+            time.sleep(0.001)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        # Let paho drain whatever is still queued before counting
+        time.sleep(0.2)
+
+        parent.send('stop')
+        meter_stats, broker_after = parent.recv()
+        mocks.join(timeout=5)
+        current_rss, peak_rss = rss_kb()
+        polls = args.sweeps * len(meter.endpoints)
+        publishes = broker_after['publishes'] - broker_before['publishes']
+
+        return {
+            'endpoints': len(meter.endpoints),
+            'sweeps': args.sweeps,
+            'sweep_ms_mean': statistics.mean(latencies) * 1000,
+            'sweep_ms_p50': percentile(latencies, 0.50) * 1000,
+            'sweep_ms_p95': percentile(latencies, 0.95) * 1000,
+            'sweep_ms_max': max(latencies) * 1000,
+            'publishes': publishes,
+            'publishes_per_s': publishes / wall,
+            'publish_bytes': broker_after['bytes_in'] - broker_before['bytes_in'],
+            'cpu_ms_per_poll': cpu / polls * 1000,
+            'rss_kb': current_rss,
+            'rss_peak_kb': peak_rss,
+            'meter': meter_stats,
+            'connection': meter.connection_stats(),
+            'fresh_skipped': sum(obj.fresh_skipped for obj in meter.endpoints),
+            'pipeline': meter.pipeline.stats() if meter.pipeline is not None else None,
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_arguments(parser)
+    parser.add_argument('--sweeps', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1, help='METER_CONCURRENCY for the bridge')
+    parser.add_argument('--heartbeat', type=float, default=0, help='MQTT_HEARTBEAT for the bridge')
+    parser.add_argument('--state-json', default='', choices=['', 'endpoint', 'meter'],
+                        help='MQTT_STATE_JSON for the bridge')
+    parser.add_argument('--batch-reads', action='store_true', help='METER_BATCH_READS for the bridge')
+    parser.add_argument('--pipeline', action='store_true', help='METER_PIPELINE for the bridge')
+    parser.add_argument('--mqtt-version', default='3.1.1', choices=['3.1.1', '5'], help='MQTT_VERSION for the bridge')
+    parser.add_argument('--transport', default='requests', choices=['requests', 'lean'],
+                        help='METER_TRANSPORT for the bridge')
+    parser.add_argument('--ttl', default='', help='METER_TTL for the bridge, ie. auto')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    args.config = args.config.resolve()
+    logging.basicConfig(level=logging.ERROR)
+    # Same as run.sh's -Wignore, verify=False warns on every request
+    warnings.simplefilter('ignore')
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['endpoints']} endpoints, {results['sweeps']} sweeps")
+        print(f"  sweep latency:  mean {results['sweep_ms_mean']:.1f}ms  p50 {results['sweep_ms_p50']:.1f}ms  "
+              f"p95 {results['sweep_ms_p95']:.1f}ms  max {results['sweep_ms_max']:.1f}ms")
+        print(f"  publishes:      {results['publishes']} ({results['publishes_per_s']:.1f}/s, "
+              f"{results['publish_bytes']} bytes, {results['publish_bytes'] / results['sweeps']:.0f} per sweep)")
+        print(f"  cpu per poll:   {results['cpu_ms_per_poll']:.2f}ms")
+        print(f"  rss:            {results['rss_kb'] / 1024:.1f}MB (peak {results['rss_peak_kb'] / 1024:.1f}MB)")
+        print(f"  meter:          {results['meter']}")
+        print(f"  connection:     {results['connection']}")
+        if args.ttl:
+            print(f"  fresh skipped:  {results['fresh_skipped']}")
+        if results['pipeline'] is not None:
+            print(f"  pipeline:       {results['pipeline']}")
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Minimal local MQTT 3.1.1 and 5 broker stand-in.
+
+Accepts connections, acknowledges QoS 0/1/2 publishes, keeps retained
+messages and forwards publishes to matching subscribers. v5 clients
+get topic aliases (up to --topic-alias-maximum), other v5 properties
+are ignored. Counts every publish and byte it receives so benchmarks
+can see what the bridge puts on the wire. Not meant for anything but
+local testing.
+
+Usage: python3 scripts/mock_broker.py [--port 1883] [--topic-alias-maximum 100]
+"""
+import struct
+import argparse
+import threading
+import socketserver
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+MQTT_V5 = 5
+# v5 property identifiers we care about
+RECEIVE_MAXIMUM, TOPIC_ALIAS_MAXIMUM, TOPIC_ALIAS = 0x21, 0x22, 0x23
+
+
+def encode_length(length: int) -> bytes:
+    """
+    MQTT variable length integer
+    """
+    out = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        out.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(out)
+
+
+def decode_length(data: bytes, offset: int) -> tuple:
+    """
+    Returns: tuple of (length, offset just past it)
+    """
+    length, multiplier = 0, 1
+    while True:
+        digit = data[offset]
+        offset += 1
+        length += (digit & 0x7f) * multiplier
+        multiplier *= 128
+        if not digit & 0x80:
+            return length, offset
+
+
+def topic_alias(properties: bytes) -> int | None:
+    """
+    Pull the Topic Alias out of a PUBLISH's properties, the only one
+    that's 2 bytes long is all we need to step over the rest
+    """
+    offset = 0
+    while offset < len(properties):
+        identifier, offset = decode_length(properties, offset)
+        if identifier == TOPIC_ALIAS:
+            return struct.unpack('!H', properties[offset:offset + 2])[0]
+        if identifier in (0x01, 0x17, 0x19, 0x24, 0x25):
+            offset += 1
+        elif identifier in (0x13, 0x21, 0x22):
+            offset += 2
+        elif identifier in (0x02, 0x11, 0x18, 0x27):
+            offset += 4
+        elif identifier == 0x0b:
+            _, offset = decode_length(properties, offset)
+        elif identifier == 0x26:
+            for _ in range(2):
+                offset += 2 + struct.unpack('!H', properties[offset:offset + 2])[0]
+        else:
+            offset += 2 + struct.unpack('!H', properties[offset:offset + 2])[0]
+    return None
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    """
+    Match a topic against a subscription filter with + and # wildcards
+    """
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class MockBroker():
+    """
+    Threaded TCP MQTT broker. Call start() to serve in the background
+    and stop() to shut it down.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, topic_alias_maximum: int = 100):
+        self.topic_alias_maximum = topic_alias_maximum
+        self.connections = 0
+        self.publishes = 0
+        self.bytes_in = 0
+        self.retained = {}
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._server = socketserver.ThreadingTCPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+
+    def _handler(self):
+        broker = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def setup(self):
+                self.subscriptions = []
+                self.write_lock = threading.Lock()
+                self.protocol = 4
+                # {alias: topic} the client has set up on this connection
+                self.aliases = {}
+
+            def send(self, data: bytes):
+                with self.write_lock:
+                    self.request.sendall(data)
+
+            def read_exact(self, size: int) -> bytes:
+                data = bytearray()
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise ConnectionError('client went away')
+                    data += chunk
+                return bytes(data)
+
+            def read_packet(self) -> tuple:
+                header = self.read_exact(1)[0]
+                length, multiplier, size = 0, 1, 1
+                while True:
+                    digit = self.read_exact(1)[0]
+                    size += 1
+                    length += (digit & 0x7f) * multiplier
+                    multiplier *= 128
+                    if not digit & 0x80:
+                        break
+                body = self.read_exact(length)
+                with broker._lock:
+                    broker.bytes_in += size + length
+                return header >> 4, header & 0x0f, body
+
+            def handle(self):
+                try:
+                    while self.dispatch(*self.read_packet()):
+                        pass
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with broker._lock:
+                        if self in broker._sessions:
+                            broker._sessions.remove(self)
+
+            def dispatch(self, packet_type: int, flags: int, body: bytes) -> bool:
+                if packet_type == CONNECT:
+                    # Protocol name then level
+                    name_length = struct.unpack('!H', body[:2])[0]
+                    self.protocol = body[2 + name_length]
+                    with broker._lock:
+                        broker.connections += 1
+                        broker._sessions.append(self)
+                    connack = b'\x00\x00'
+                    if self.protocol == MQTT_V5:
+                        properties = bytes([TOPIC_ALIAS_MAXIMUM]) + struct.pack('!H', broker.topic_alias_maximum)
+                        connack += encode_length(len(properties)) + properties
+                    self.send(packet(CONNACK, 0, connack))
+                elif packet_type == PUBLISH:
+                    broker.on_publish(self, flags, body)
+                elif packet_type == PUBREL:
+                    self.send(packet(PUBCOMP, 0, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    broker.on_subscribe(self, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.send(packet(UNSUBACK, 0, body[:2] + (b'\x00\x00' if self.protocol == MQTT_V5 else b'')))
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP, 0, b''))
+                elif packet_type == DISCONNECT:
+                    return False
+                return True
+
+        return Handler
+
+    def on_publish(self, session, flags: int, body: bytes) -> None:
+        qos = (flags >> 1) & 0x03
+        retain = flags & 0x01
+        topic_length = struct.unpack('!H', body[:2])[0]
+        topic = body[2:2 + topic_length].decode('utf-8')
+        offset = 2 + topic_length
+        packet_id = body[offset:offset + 2] if qos else b''
+        offset += len(packet_id)
+        if session.protocol == MQTT_V5:
+            length, start = decode_length(body, offset)
+            alias = topic_alias(body[start:start + length])
+            offset = start + length
+            if alias is not None:
+                # A topic sets the alias up, an empty one uses it
+                if topic:
+                    session.aliases[alias] = topic
+                else:
+                    topic = session.aliases[alias]
+        payload = body[offset:]
+        with self._lock:
+            self.publishes += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            subscribers = [s for s in self._sessions
+                           if any(topic_matches(f, topic) for f in s.subscriptions)]
+        if qos == 1:
+            session.send(packet(PUBACK, 0, packet_id))
+        elif qos == 2:
+            session.send(packet(PUBREC, 0, packet_id))
+        for subscriber in subscribers:
+            subscriber.send(self._forward(subscriber, topic, payload, 0))
+
+    @staticmethod
+    def _forward(session, topic: str, payload: bytes, flags: int) -> bytes:
+        properties = b'\x00' if session.protocol == MQTT_V5 else b''
+        return packet(PUBLISH, flags, encode_string(topic) + properties + payload)
+
+    def on_subscribe(self, session, body: bytes) -> None:
+        packet_id, offset, granted, filters = body[:2], 2, bytearray(), []
+        if session.protocol == MQTT_V5:
+            length, offset = decode_length(body, offset)
+            offset += length
+        while offset < len(body):
+            length = struct.unpack('!H', body[offset:offset + 2])[0]
+            filters.append(body[offset + 2:offset + 2 + length].decode('utf-8'))
+            # Everything gets delivered at QoS 0
+            granted.append(0)
+            offset += 3 + length
+        session.subscriptions.extend(filters)
+        properties = b'\x00' if session.protocol == MQTT_V5 else b''
+        session.send(packet(SUBACK, 0, packet_id + properties + bytes(granted)))
+        with self._lock:
+            retained = [(t, p) for t, p in self.retained.items()
+                        if any(topic_matches(f, t) for f in filters)]
+        for topic, payload in retained:
+            session.send(self._forward(session, topic, payload, 0x01))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'connections': self.connections, 'publishes': self.publishes,
+                    'bytes_in': self.bytes_in, 'retained': len(self.retained)}
+
+    def start(self) -> 'MockBroker':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--topic-alias-maximum', type=int, default=100, help='0 turns topic aliases off')
+    args = parser.parse_args()
+    broker = MockBroker(args.host, args.port, args.topic_alias_maximum)
+    print(f'Mock broker listening on {broker.host}:{broker.port}')
+    try:
+        broker.start()._thread.join()
+    except KeyboardInterrupt:
+        broker.stop()
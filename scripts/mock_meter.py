@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Itron meter's 2030.5 HTTPS interface.
+
+Serves /sdev/sdi, every url from an endpoints_*.yaml, the
+ReadingLists those urls are items of and the /dcap, UsagePoint,
+MeterReading, ReadingType and ReadingSet resources above them over the same
+ECDHE-ECDSA-AES128-CCM8 TLS setup the real meter uses. Response
+latency, jitter and error rates are configurable and the readings
+change over time the way the meter's do: summations climb, demand
+wanders and timePeriod.start rolls over every interval.
+
+With --notify-interval set it also accepts 2030.5 Subscriptions at
+/edev/0/sub and pushes a Notification with the current reading to each
+subscriber that often.
+
+Usage: python3 scripts/mock_meter.py [--port 8081] [--latency 0.05] [--jitter 0.02]
+                                     [--error-rate 0.01] [--drop-rate 0.01]
+                                     [--notify-interval 5]
+"""
+import ssl
+import sys
+import math
+import time
+import zlib
+import hashlib
+import yaml
+import random
+import argparse
+import subprocess
+import threading
+import http.client
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, parse_qs
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'
+sys.path.insert(0, str(PACKAGE_DIR))
+
+from xcelMeter import CIPHERS
+
+READING_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Reading xmlns="urn:ieee:std:2030.5:ns" href="{href}">'
+    '<consumptionBlock>0</consumptionBlock>'
+    '<qualityFlags>00</qualityFlags>'
+    '{time_period}'
+    '<touTier>{tier}</touTier>'
+    '<value>{value}</value>'
+    '</Reading>'
+)
+
+DEVICE_INFO_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<DeviceInformation xmlns="urn:ieee:std:2030.5:ns" href="/sdev/sdi">'
+    '<lFDI>{lfdi}</lFDI>'
+    '<mfDate>1577836800</mfDate>'
+    '<mfHwVer>1.0</mfHwVer>'
+    '<mfID>{mfid}</mfID>'
+    '<mfModel>GEN5</mfModel>'
+    '<mfSerNum>00000000</mfSerNum>'
+    '<primaryPower>1</primaryPower>'
+    '<secondaryPower>0</secondaryPower>'
+    '<swActTime>1577836800</swActTime>'
+    '<swVer>{sw_ver}</swVer>'
+    '</DeviceInformation>'
+)
+
+NOTIFICATION_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Notification xmlns="urn:ieee:std:2030.5:ns" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+    '<subscribedResource>{resource}</subscribedResource>'
+    '{reading}'
+    '<status>0</status>'
+    '<subscriptionURI>{href}</subscriptionURI>'
+    '</Notification>'
+)
+
+SUBSCRIPTION_LIST = '/edev/0/sub'
+
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+
+# Length of the meter's demand/summation interval in seconds
+READING_INTERVAL = 900
+
+
+def sample_reading(url: str, tags: dict, value: int = 1234567, start: int = 1706295600) -> str:
+    """
+    Build a Reading in the shape the meter sends back, including the
+    timePeriod children only when the endpoint asks for them.
+    """
+    time_period = ''
+    # Items of a ReadingSet are one per TOU tier
+    tier = int(url.rpartition('/')[2]) - 1 if '/rs/' in url else 0
+    if 'timePeriod' in tags:
+        time_period = (f'<timePeriod><duration>{READING_INTERVAL}</duration>'
+                       f'<start>{start}</start></timePeriod>')
+    return READING_TEMPLATE.format(href=url, time_period=time_period, value=value, tier=tier)
+
+
+def load_resources(config_path: Path) -> dict:
+    """
+    Returns: dict, {url: tags} for every endpoint in the config
+    """
+    with open(config_path, mode='r', encoding='utf-8') as file:
+        endpoints = yaml.safe_load(file)
+    return {v['url']: v['tags'] for point in endpoints for v in point.values()}
+
+
+def load_names(config_path: Path) -> dict:
+    """
+    Returns: dict, {url: endpoint name} for every endpoint in the config
+    """
+    with open(config_path, mode='r', encoding='utf-8') as file:
+        endpoints = yaml.safe_load(file)
+    return {v['url']: name for point in endpoints for name, v in point.items()}
+
+
+def meter_reading_of(url: str) -> str:
+    """
+    Returns: str, the MeterReading a Reading url belongs to, ie. /upt/1/mr/8
+    """
+    return '/'.join(url.split('/')[:5])
+
+
+def generate_certs(directory: Path) -> tuple:
+    """
+    Generate a throwaway prime256v1 cert/key pair the same way
+    scripts/generate_keys.sh does. Used for both ends of the mock.
+
+    Returns: tuple of (cert path, key path)
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    cert, key = directory / '.cert.pem', directory / '.key.pem'
+    if not (cert.is_file() and key.is_file()):
+        subprocess.run(['openssl', 'req', '-x509', '-nodes', '-newkey', 'ec',
+                        '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+                        '-keyout', str(key), '-out', str(cert), '-sha256', '-days', '30',
+                        '-subj', '/CN=MockMeter'],
+                       check=True, capture_output=True)
+    return str(cert), str(key)
+
+
+class MockMeter():
+    """
+    Threaded HTTPS server answering like the meter. Call start() to
+    serve in the background and stop() to shut it down.
+
+    latency + up to jitter seconds is spent on every response.
+    error_rate is the fraction of requests answered with a 503 and
+    drop_rate the fraction where the connection is closed unanswered.
+    Resources in broken always get a 503. With notify_interval set
+    subscriptions are accepted for every resource in push_resources
+    (default all of them) and notified that often.
+    """
+    def __init__(self, config_path: Path, certs: tuple, host: str = '127.0.0.1',
+                 port: int = 0, latency: float = 0.0, sw_ver: str = None,
+                 jitter: float = 0.0, error_rate: float = 0.0, drop_rate: float = 0.0,
+                 notify_interval: float = 0.0, push_resources: set = None, broken: set = None):
+        self.resources = load_resources(config_path)
+        self.names = load_names(config_path)
+        # Resources that always answer with a 503
+        self.broken = set(broken or ())
+        self.notify_interval = notify_interval
+        self.push_resources = set(self.resources) if push_resources is None else set(push_resources)
+        # {href: (resource, notification uri)}
+        self.subscriptions = {}
+        self.notifications = 0
+        self.notify_seconds = 0.0
+        self._client_context = self._notify_context(certs)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.sw_ver = sw_ver or Path(config_path).stem.replace('endpoints_', '').replace('_', '.')
+        # Derived from its certificate, same as a real meter's
+        with open(certs[0], mode='r', encoding='utf-8') as file:
+            self.lfdi = hashlib.sha256(ssl.PEM_cert_to_DER_cert(file.read())).hexdigest()[:40].upper()
+        self.requests = 0
+        self.errors = 0
+        self.drops = 0
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        # Handshakes happen lazily in each connection's thread rather than in accept()
+        self._server.socket = self._ssl_context(certs).wrap_socket(
+            self._server.socket, server_side=True, do_handshake_on_connect=False)
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    @staticmethod
+    def _notify_context(certs: tuple) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers(CIPHERS)
+        context.load_cert_chain(*certs)
+        return context
+
+    @staticmethod
+    def _ssl_context(certs: tuple) -> ssl.SSLContext:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.set_ciphers(CIPHERS)
+        context.load_cert_chain(*certs)
+        return context
+
+    def value_for(self, path: str, now: float) -> int:
+        """
+        Reading value for a resource at the given time. Totals climb
+        steadily from a per-resource starting point, everything else
+        wanders around a per-resource level.
+        """
+        seed = zlib.crc32(path.encode('utf-8'))
+        tag = self.resources[path].get('value', {})
+        if tag.get('state_class') == 'total':
+            # Somewhere around 0.5-1.5kW worth of Wh per second
+            rate = 0.14 + (seed % 1000) / 3600
+            return 10_000_000 + seed % 1_000_000 + int((now - self._started) * rate)
+        level = 500 + seed % 1500
+        return int(level + level * 0.3 * math.sin(now / 60 + seed) + random.uniform(-10, 10))
+
+    def respond(self, path: str) -> tuple:
+        """
+        Returns: tuple of (status code, body), status None to drop the connection
+        """
+        with self._lock:
+            self.requests += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if self.drop_rate and random.random() < self.drop_rate:
+            with self._lock:
+                self.drops += 1
+            return None, ''
+        if self.error_rate and random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return 503, ''
+        path, _, query = path.partition('?')
+        if path in self.broken:
+            with self._lock:
+                self.errors += 1
+            return 503, ''
+        if path == '/sdev/sdi':
+            return 200, DEVICE_INFO_TEMPLATE.format(lfdi=self.lfdi, mfid='Itron', sw_ver=self.sw_ver)
+        if path in self.resources:
+            now = time.time()
+            start = int(now // READING_INTERVAL * READING_INTERVAL)
+            return 200, sample_reading(path, self.resources[path], self.value_for(path, now), start)
+        tree = self.tree(path, parse_qs(query))
+        if tree is not None:
+            return 200, tree
+        items = [url for url in self.resources if url.rpartition('/')[0] == path]
+        if items:
+            return 200, self.reading_list(path, sorted(items, key=lambda url: int(url.rpartition('/')[2])),
+                                          parse_qs(query))
+        if path in self.subscriptions:
+            resource, uri = self.subscriptions[path]
+            return 200, (f'<Subscription xmlns="urn:ieee:std:2030.5:ns" href="{path}">'
+                         f'<subscribedResource>{resource}</subscribedResource>'
+                         f'<notificationURI>{uri}</notificationURI></Subscription>')
+        return 404, ''
+
+    def tree(self, path: str, query: dict) -> str | None:
+        """
+        The resources above the Readings, derived from the config: one
+        UsagePoint with a MeterReading for each /upt/1/mr/N the urls are
+        under, with ReadingTypes guessed from the tags and names
+
+        Returns: str, the resource's XML or None if it isn't one of them
+        """
+        ns = 'xmlns="urn:ieee:std:2030.5:ns"'
+        meter_readings = {}
+        for url in self.resources:
+            meter_readings.setdefault(meter_reading_of(url), []).append(url)
+        if path == '/dcap':
+            return (f'<DeviceCapability {ns} href="/dcap"><EndDeviceListLink href="/edev" all="1"/>'
+                    f'<SelfDeviceLink href="/sdev"/><UsagePointListLink href="/upt" all="1"/></DeviceCapability>')
+        if path == '/upt':
+            return (f'<UsagePointList {ns} href="/upt" all="1" results="1"><UsagePoint href="/upt/1">'
+                    f'<serviceCategoryKind>0</serviceCategoryKind><status>1</status>'
+                    f'<MeterReadingListLink href="/upt/1/mr" all="{len(meter_readings)}"/></UsagePoint></UsagePointList>')
+        if path == '/upt/1/mr':
+            ordered = sorted(meter_readings, key=lambda href: int(href.rpartition('/')[2]))
+            start = int(query.get('s', ['0'])[0])
+            page = ordered[start:start + int(query.get('l', ['1'])[0])]
+            items = ''
+            for href in page:
+                urls = meter_readings[href]
+                # TOU tiers share a MeterReading, named for what they have in common
+                description = ' '.join(word for word in self.names[urls[0]].split()
+                                       if word != 'TOU' and not word.isdigit())
+                link = (f'<ReadingLink href="{href}/r"/>' if f'{href}/r' in self.resources else
+                        f'<ReadingSetListLink href="{href}/rs" all="1"/>')
+                items += (f'<MeterReading href="{href}"><description>{description}</description>'
+                          f'{link}<ReadingTypeLink href="{href}/rt"/></MeterReading>')
+            return (f'<MeterReadingList {ns} href="{path}" all="{len(ordered)}" '
+                    f'results="{len(page)}">{items}</MeterReadingList>')
+        href, _, leaf = path.rpartition('/')
+        urls = meter_readings.get(href)
+        if urls is None:
+            return None
+        if leaf == 'rt':
+            name = self.names[urls[0]]
+            value = self.resources[urls[0]].get('value', {})
+            power_factor = value.get('device_class') == 'power_factor'
+            uom = 65 if power_factor else 71 if name.startswith('VAh') else 73 if name.startswith('VARh') else \
+                {'W': 38, 'Wh': 72}.get(value.get('unit_of_measurement'), 0)
+            phase = {'PhaseA': 128, 'PhaseB': 64, 'PhaseC': 32}.get(name.split()[-1], 0)
+            return (f'<ReadingType {ns} href="{path}">'
+                    f'<accumulationBehaviour>{9 if value.get("state_class") == "total" else 12}</accumulationBehaviour>'
+                    f'<commodity>1</commodity><dataQualifier>{8 if "Max" in name else 0}</dataQualifier>'
+                    f'<flowDirection>{19 if "Received" in name else 1}</flowDirection>'
+                    f'<kind>{8 if "Demand" in name else 12}</kind><numberOfTouTiers>{len(urls) if len(urls) > 1 else 0}'
+                    f'</numberOfTouTiers><phase>{phase}</phase><powerOfTenMultiplier>{-3 if power_factor else 0}'
+                    f'</powerOfTenMultiplier><uom>{uom}</uom></ReadingType>')
+        if leaf == 'rs' and f'{href}/rs/1/r' in {url.rpartition('/')[0] for url in urls}:
+            return (f'<ReadingSetList {ns} href="{path}" all="1" results="1"><ReadingSet href="{path}/1">'
+                    f'<ReadingListLink href="{path}/1/r" all="{len(urls)}"/></ReadingSet></ReadingSetList>')
+        return None
+
+    def reading_list(self, path: str, items: list, query: dict) -> str:
+        """
+        A ReadingList of the given Readings, paged by the s (start) and
+        l (limit) query parameters
+        """
+        start = int(query.get('s', ['0'])[0])
+        limit = int(query.get('l', ['1'])[0])
+        page = items[start:start + limit]
+        now = time.time()
+        period = int(now // READING_INTERVAL * READING_INTERVAL)
+        readings = ''.join(sample_reading(url, self.resources[url], self.value_for(url, now), period)
+                           .split('\n', 1)[1].replace(' xmlns="urn:ieee:std:2030.5:ns"', '')
+                           for url in page)
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<ReadingList xmlns="urn:ieee:std:2030.5:ns" href="{path}" all="{len(items)}" '
+                f'results="{len(page)}">{readings}</ReadingList>')
+
+    def subscribe(self, path: str, body: bytes) -> tuple:
+        """
+        Returns: tuple of (status code, Location of the new subscription)
+        """
+        with self._lock:
+            self.requests += 1
+        if path != SUBSCRIPTION_LIST or not self.notify_interval:
+            return 405, None
+        root = ET.fromstring(body)
+        resource = root.findtext(f'{IEEE_PREFIX}subscribedResource')
+        uri = root.findtext(f'{IEEE_PREFIX}notificationURI')
+        if resource not in self.push_resources:
+            return 400, None
+        with self._lock:
+            href = f'{SUBSCRIPTION_LIST}/{len(self.subscriptions)}'
+            self.subscriptions[href] = (resource, uri)
+        return 201, href
+
+    def unsubscribe(self, path: str) -> int:
+        with self._lock:
+            return 204 if self.subscriptions.pop(path, None) else 404
+
+    def notification(self, href: str, resource: str) -> str:
+        now = time.time()
+        start = int(now // READING_INTERVAL * READING_INTERVAL)
+        reading = sample_reading(resource, self.resources[resource], self.value_for(resource, now), start)
+        reading = reading.split('\n', 1)[1].replace('<Reading xmlns="urn:ieee:std:2030.5:ns"',
+                                                     '<Resource xsi:type="Reading"')
+        reading = reading.replace('</Reading>', '</Resource>')
+        return NOTIFICATION_TEMPLATE.format(resource=resource, reading=reading, href=href)
+
+    def _notify_loop(self) -> None:
+        # One kept-alive connection per subscriber
+        connections = {}
+        while not self._stopped.wait(self.notify_interval):
+            with self._lock:
+                subscriptions = list(self.subscriptions.items())
+            for href, (resource, uri) in subscriptions:
+                target = urlsplit(uri)
+                body = self.notification(href, resource).encode('utf-8')
+                try:
+                    conn = connections.get(target.netloc)
+                    if conn is None:
+                        conn = http.client.HTTPSConnection(target.hostname, target.port,
+                                                           context=self._client_context, timeout=5)
+                        connections[target.netloc] = conn
+                    started = time.perf_counter()
+                    conn.request('POST', target.path, body, {'Content-Type': 'application/sep+xml'})
+                    conn.getresponse().read()
+                    with self._lock:
+                        self.notifications += 1
+                        self.notify_seconds += time.perf_counter() - started
+                except (OSError, http.client.HTTPException):
+                    connections.pop(target.netloc, None)
+                    conn.close()
+
+    def _handler(self):
+        meter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep connections open between requests like the meter does
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in separate writes, don't let Nagle hold the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                status, body = meter.respond(self.path)
+                if status is None:
+                    self.close_connection = True
+                    return
+                data = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/sep+xml')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, location = meter.subscribe(self.path, body)
+                self.send_response(status)
+                if location:
+                    self.send_header('Location', location)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_DELETE(self):
+                self.send_response(meter.unsubscribe(self.path))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'requests': self.requests, 'errors': self.errors, 'drops': self.drops,
+                    'subscriptions': len(self.subscriptions), 'notifications': self.notifications,
+                    'notify_ms': self.notify_seconds / self.notifications * 1000 if self.notifications else 0}
+
+    def start(self) -> 'MockMeter':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if self.notify_interval:
+            threading.Thread(target=self._notify_loop, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Mock meter knobs, shared with the benchmark's command line
+    """
+    parser.add_argument('--config', type=Path, default=PACKAGE_DIR / 'configs' / 'endpoints_3_2_50.yaml')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many more seconds per response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of requests dropped unanswered')
+    parser.add_argument('--broken', action='append', default=[], help='resource that always answers 503, repeatable')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    add_arguments(parser)
+    parser.add_argument('--notify-interval', type=float, default=0.0,
+                        help='accept subscriptions and push notifications this often')
+    parser.add_argument('--certs', type=Path, default=Path('certs/mock'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    meter = MockMeter(args.config, generate_certs(args.certs), args.host, args.port, args.latency,
+                      jitter=args.jitter, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                      notify_interval=args.notify_interval, broken=args.broken)
+    print(f'Mock meter serving {len(meter.resources)} resources on https://{meter.host}:{meter.port}')
+    try:
+        meter.start()._thread.join()
+    except KeyboardInterrupt:
+        meter.stop()
@@ -0,0 +1,63 @@
+import sys
+import json
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'))
+
+from xcelAggregate import xcelAggregator, xcelRingBuffer
+from xcelEndpoint import xcelEndpoint
+
+
+def test_ring_buffer_window():
+    buffer = xcelRingBuffer(horizon=10, size=4)
+    for t in range(12):
+        buffer.append(float(t), t * 10.0)
+    # Still within the horizon when it filled up, so it grew rather than overwrote
+    assert len(buffer) == 12
+    assert buffer.since(8.0) == [110.0, 100.0, 90.0]
+
+
+def test_window_stats():
+    aggregator = xcelAggregator('value', {'windows': ['10s'], 'stats': ['min', 'max', 'mean', 'last']})
+    for t, value in enumerate([5, 1, 9, 3, 7, 2, 8, 4, 6, 10]):
+        assert aggregator.add(str(value), 100.0 + t) == {}
+    # The window closes 10s after the first reading, over the 10s since (the 5 at 100 has aged out)
+    assert aggregator.add('0', 110.0) == {
+        'value_min_10s': '0', 'value_max_10s': '10', 'value_mean_10s': '5', 'value_last_10s': '0'}
+
+
+def test_rate_from_summation_deltas():
+    aggregator = xcelAggregator('value', {'rate': True})
+    # Polled every 10s, the summation only ticks over every 30s
+    readings = [(0, 1000), (10, 1000), (20, 1000), (30, 1010), (40, 1010), (50, 1010), (60, 1025)]
+    fresh = [aggregator.add(str(value), float(t)) for t, value in readings]
+    assert fresh[:6] == [{}] * 6
+    # 15 Wh over the 30s since it last changed
+    assert fresh[6] == {'value_rate': '1800'}
+
+
+class Client():
+    """
+    Just enough of the MQTT client for an endpoint to send its configs
+    """
+    class Result():
+        rc = 0
+        mid = 1
+
+    def publish(self, topic: str, payload, retain: bool = False) -> 'Client.Result':
+        return self.Result()
+
+
+def test_aggregate_configs_are_measurements():
+    tags = {'value': {'entity_type': 'sensor', 'device_class': 'energy', 'unit_of_measurement': 'Wh',
+                      'state_class': 'total_increasing', 'value_template': '{{ value | int }}',
+                      'aggregate': {'windows': ['1m'], 'stats': ['mean', 'last'], 'rate': True}}}
+    device_info = {'device': {'name': 'Test Meter'}}
+    endpoint = xcelEndpoint(None, Client(), 'https://meter/upt/1/mr/1/r', 'Summation', tags, device_info)
+    configs = {json.loads(payload)['name'].rsplit(' ', 1)[-1]: json.loads(payload)
+               for payload in endpoint.discovery_plan().values()}
+    mean, last, rate = configs['value_mean_1m'], configs['value_last_1m'], configs['value_rate']
+    assert mean['state_class'] == 'measurement' and 'device_class' not in mean
+    assert last['state_class'] == 'total_increasing' and last['device_class'] == 'energy'
+    assert rate['state_class'] == 'measurement' and rate['unit_of_measurement'] == 'W'
+    assert not any('value_template' in config for config in (mean, last, rate))
@@ -0,0 +1,120 @@
+import sys
+from pathlib import Path
+from time import sleep
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'))
+
+import xcelBreaker
+from xcelBreaker import xcelBreaker as Breaker, OPEN, HALF_OPEN, CLOSED
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def open_breaker(monkeypatch) -> tuple:
+    clock = Clock()
+    monkeypatch.setattr(xcelBreaker, 'monotonic', clock)
+    breaker = Breaker('test', failures=1, reset=30)
+    breaker.failed()
+    assert breaker.state == OPEN
+    return breaker, clock
+
+
+def test_unfinished_probe_is_replaced(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # The probe never records a result, nothing else gets through meanwhile
+    assert not breaker.allow()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow()
+    breaker.succeeded()
+    assert breaker.state == CLOSED
+
+
+def test_failed_probe_backs_off(monkeypatch):
+    breaker, clock = open_breaker(monkeypatch)
+    clock.now += 30
+    assert breaker.allow()
+    breaker.failed()
+    assert breaker.state == OPEN
+    clock.now += 30
+    assert not breaker.allow()
+    clock.now += 30
+    assert breaker.allow()
+
+
+class Endpoint():
+    """
+    Just enough of xcelEndpoint for poll_endpoints
+    """
+    def __init__(self, name: str, delay: float = 0.0):
+        self.name = name
+        self.delay = delay
+        self.breaker = Breaker(name, failures=1, reset=30)
+        self._metric_labels = {'meter': 'test', 'endpoint': name}
+        self.polled = 0
+
+    def allow(self) -> bool:
+        return self.breaker.allow()
+
+    @property
+    def probing(self) -> bool:
+        return self.breaker.state == HALF_OPEN
+
+    def record(self, ok: bool) -> None:
+        self.breaker.succeeded() if ok else self.breaker.failed()
+
+    def query_endpoint(self) -> str:
+        self.polled += 1
+        sleep(self.delay)
+        return ''
+
+    def process_response(self, response: str) -> None:
+        pass
+
+
+def test_probe_skipped_by_budget_is_retried(monkeypatch):
+    from xcelMeter import xcelMeter
+
+    clock = Clock()
+    monkeypatch.setattr(xcelBreaker, 'monotonic', clock)
+    slow = Endpoint('slow', delay=0.05)
+    probed = Endpoint('probed')
+    probed.breaker.failed()
+    clock.now += 30
+    # The slow endpoint uses up the budget, the probe that goes last is skipped
+    xcelMeter.poll_endpoints([slow, probed], budget=0.01)
+    assert probed.polled == 0
+    assert probed.breaker.state == HALF_OPEN
+    xcelMeter.poll_endpoints([probed], budget=0.01)
+    assert probed.polled == 0
+    clock.now += 30
+    xcelMeter.poll_endpoints([probed], budget=0.01)
+    assert probed.polled == 1
+    assert probed.breaker.state == CLOSED
+
+
+def test_sweep_out_of_budget_cancels_queued_queries():
+    from concurrent.futures import ThreadPoolExecutor
+    from xcelMeter import xcelMeter
+
+    stuck = Endpoint('stuck', delay=0.2)
+    healthy = [Endpoint(f'healthy_{i}') for i in range(3)]
+    executor = ThreadPoolExecutor(max_workers=1)
+    xcelMeter.poll_endpoints([stuck] + healthy, executor, budget=0.05)
+    # Nothing left queued to go to the meter once the worker is free
+    executor.shutdown(wait=True)
+    assert stuck.polled == 1
+    assert [obj.polled for obj in healthy] == [0, 0, 0]
+    # The query that hung on past the budget counts against its breaker
+    assert stuck.breaker.state == OPEN
+    assert all(obj.breaker.state == CLOSED for obj in healthy)
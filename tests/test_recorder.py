@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'xcel_itron2mqtt'))
+
+from xcelRecorder import xcelRecorder, scan
+
+# Noon UTC, well away from a segment's day boundary
+NOON = 1790000000.0 - 1790000000.0 % 86400 + 43200
+
+
+def test_earlier_reading_keeps_segment_in_order(tmp_path):
+    recorder = xcelRecorder(str(tmp_path), retention=0)
+    recorder.record('Meter', 'Demand', {'value': '1'}, NOON)
+    recorder.record('Meter', 'Demand', {'value': '2'}, NOON + 10)
+    # Parsed late, stamped before the last record
+    recorder.record('Meter', 'Demand', {'value': '3'}, NOON + 5)
+    recorder.record('Meter', 'Demand', {'value': '4'}, NOON + 20)
+    recorder.close()
+    (times, values), = scan(str(tmp_path), 'Meter/Demand/value')
+    assert list(times) == [NOON, NOON + 10, NOON + 10, NOON + 20]
+    assert list(values) == [1, 2, 3, 4]
+    # The range search finds the late one where it was put
+    (times, values), = scan(str(tmp_path), 'Meter/Demand/value', NOON + 10, NOON + 10)
+    assert list(values) == [2, 3]
+
+
+def test_segment_picks_up_where_it_left_off(tmp_path):
+    recorder = xcelRecorder(str(tmp_path), retention=0)
+    recorder.record('Meter', 'Demand', {'value': '1'}, NOON + 10)
+    recorder.close()
+    # A restart with the clock behind the last record
+    recorder = xcelRecorder(str(tmp_path), retention=0)
+    recorder.record('Meter', 'Demand', {'value': '2'}, NOON)
+    recorder.close()
+    (times, _), = scan(str(tmp_path), 'Meter/Demand/value')
+    assert list(times) == [NOON + 10, NOON + 10]
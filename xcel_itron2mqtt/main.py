@@ -1,8 +1,14 @@
 import os
+import json
+import yaml
 import logging
+import threading
 from time import sleep
 from pathlib import Path
 from xcelMeter import xcelMeter
+from xcelMetrics import metrics
+from xcelProfiler import profiler
+from xcelScheduler import xcelScheduler
 from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
 
 INTEGRATION_NAME = "Xcel Itron 5"
@@ -10,20 +16,42 @@ INTEGRATION_NAME = "Xcel Itron 5"
 LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
 logging.basicConfig(format='%(levelname)s: %(message)s', level=LOGLEVEL)
 
+# Seconds to wait on the meter to answer mDNS
+DISCOVERY_TIMEOUT = float(os.getenv('METER_DISCOVERY_TIMEOUT', '10'))
+# Where the last meter found is remembered between restarts, empty to disable
+METER_CACHE = os.getenv('METER_CACHE', 'certs/.meter_cache.json')
+
 # mDNS listener to find the IP Address of the meter on the network
 class XcelListener(ServiceListener):
-    def __init__(self):
+    def __init__(self, on_change=None):
         self.info = None
+        # Every meter heard from, keyed by service name
+        self.services = {}
+        # Set as soon as the first meter answers
+        self.found = threading.Event()
+        # Called with (name, info) whenever a meter shows up or changes address
+        self.on_change = on_change
 
     def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        pass
+        info = zc.get_service_info(type_, name)
+        if info:
+            self.info = info
+            self.services[name] = info
+            if self.on_change:
+                self.on_change(name, info)
 
     def remove_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        pass
+        self.services.pop(name, None)
+        logging.warning(f"Service {name} went away")
 
     def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
         self.info = zc.get_service_info(type_, name)
-        print(f"Service {name} added, service info: {self.info}")
+        if self.info:
+            self.services[name] = self.info
+            self.found.set()
+            if self.on_change:
+                self.on_change(name, self.info)
+        logging.debug(f"Service {name} added, service info: {self.info}")
 
 def look_for_creds() -> tuple:
     """
@@ -46,41 +74,218 @@ def look_for_creds() -> tuple:
     else:
         raise FileNotFoundError('Could not find cert and key credentials')
 
-def mDNS_search_for_meter() -> str | int:
+def mDNS_search_for_meter() -> tuple:
     """
     Creates a new zeroconf instance to probe the network for the meter
     to extract its ip address and port. Closes the instance down when complete.
 
-    Returns: string, ip address of the meter
+    Returns: tuple of the meter's ip address, port and mDNS service name
     """
     zeroconf = Zeroconf()
     listener = XcelListener()
     # Meter will respond on _smartenergy._tcp.local. port 5353
     browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
     # Have to wait to hear back from the asynchrounous listener/browser task
-    sleep(10)
-    try:
-        addresses = listener.info.addresses
-    except:
+    if not listener.found.wait(DISCOVERY_TIMEOUT):
+        zeroconf.close()
         raise TimeoutError('Waiting too long to get response from meter')
-    print(listener.info)
+    logging.info(f"Found meter service {listener.info.name}")
+    logging.debug(f"Service info: {listener.info}")
     # Auto parses the network byte format into a legible address
     ip_address = listener.info.parsed_addresses()[0]
     port = listener.info.port
     # Close out our mDNS discovery device
     zeroconf.close()
 
-    return ip_address, port
+    return ip_address, port, listener.info.name
+
+def mDNS_search_for_meters(creds: tuple) -> list:
+    """
+    Same as mDNS_search_for_meter but keeps every meter that answers.
+    Each is named after its own lFDI (or its mDNS service if that can't
+    be read), so its homeassistant ids stay with it however many
+    meters answer, or in what order.
+
+    Returns: list of dicts with the name, ip, port and lFDI of each meter
+    """
+    zeroconf = Zeroconf()
+    listener = XcelListener()
+    browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
+    # No telling how many meters there are, give them all the full timeout
+    sleep(DISCOVERY_TIMEOUT)
+    zeroconf.close()
+    if not listener.services:
+        raise TimeoutError('Waiting too long to get response from any meter')
+    meters = []
+    for info in listener.services.values():
+        ip_address, port = info.parsed_addresses()[0], info.port
+        lfdi = xcelMeter.read_lfdi(creds, ip_address, port)
+        suffix = lfdi[-8:] if lfdi else info.name.split('.')[0]
+        meters.append({'name': f'{INTEGRATION_NAME} {suffix}', 'ip': ip_address, 'port': port,
+                       'lfdi': lfdi})
+
+    return meters
+
+def watch_meter(meter: xcelMeter, service_name: str = None) -> Zeroconf:
+    """
+    Keeps browsing mDNS in the background and moves the meter over to
+    a new address its service announces, ie. after a DHCP change. Only
+    the meter's own service is followed, and only to an address that
+    answers with the meter's lFDI. Without a service name to go by
+    (ie. a meter cached by an older version) the first service to pass
+    the lFDI check becomes the one followed.
+
+    Returns: the running Zeroconf instance
+    """
+    followed = [service_name]
+    def moved(name, info):
+        if followed[0] is not None and name != followed[0]:
+            return
+        addresses = info.parsed_addresses()
+        if not addresses:
+            return
+        if (addresses[0], info.port) == (meter.ip_address, int(meter.port)):
+            return
+        lfdi = meter.lfdi_at(addresses[0], info.port)
+        if lfdi != meter._lfdi:
+            logging.warning(f"Not following {name} to {addresses[0]}:{info.port}, "
+                            f"it answered as {lfdi} rather than {meter._lfdi}")
+            return
+        followed[0] = name
+        meter.set_address(addresses[0], info.port)
+        save_meter_cache(meter, name)
+
+    zeroconf = Zeroconf()
+    ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", XcelListener(on_change=moved))
+
+    return zeroconf
+
+def load_meter_cache() -> dict | None:
+    """
+    Returns: dict of the meter found last time, or None
+    """
+    if not METER_CACHE or not Path(METER_CACHE).is_file():
+        return None
+    try:
+        with open(METER_CACHE, mode='r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable meter cache {METER_CACHE}: {e}")
+        return None
+
+def save_meter_cache(meter: xcelMeter, service_name: str = None) -> None:
+    """
+    Remember where the meter is, what it is and the mDNS service it
+    answers as, for the next start
+
+    Returns: None
+    """
+    if not METER_CACHE:
+        return
+    cache = {'ip': meter.ip_address, 'port': int(meter.port), **meter.hardware_details}
+    if service_name:
+        cache['service'] = service_name
+    try:
+        with open(METER_CACHE, mode='w', encoding='utf-8') as file:
+            json.dump(cache, file)
+    except OSError as e:
+        logging.warning(f"Could not write meter cache {METER_CACHE}: {e}")
+
+def connect_cached_meter(creds: tuple) -> xcelMeter | None:
+    """
+    Try the meter at the address it had last time, a single request
+    checks it's still there and still the same meter.
+
+    Returns: xcelMeter object, or None if the cache is missing or stale
+    """
+    cache = load_meter_cache()
+    if not cache:
+        return None
+    try:
+        meter = xcelMeter(INTEGRATION_NAME, cache['ip'], cache['port'], creds,
+                          expected_lfdi=cache['lFDI'])
+    except Exception as e:
+        logging.info(f"Meter isn't at its cached address {cache['ip']}:{cache['port']} anymore ({e})")
+        return None
+    logging.info(f"Found meter at its cached address {cache['ip']}:{cache['port']}")
+
+    return meter
+
+def load_meters(file_path: str) -> list:
+    """
+    Reads the meters to poll from a yaml list, each entry needs a name,
+    ip and port and may give its own cert_path and key_path.
+
+    Returns: list of dicts, one per meter
+    """
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        return yaml.safe_load(file)
+
+def run_multiple(meter_list: list) -> None:
+    """
+    Polls several meters from the one process, sharing a single MQTT
+    connection and scheduler between them. Meters that can't be set up
+    are logged and skipped.
+
+    Returns: None
+    """
+    mqtt_client = xcelMeter._setup_mqtt(os.getenv('MQTT_SERVER'), xcelMeter.get_mqtt_port())
+    scheduler = xcelScheduler()
+    spool = xcelMeter._setup_spool(mqtt_client)
+    recorder = xcelMeter._setup_recorder()
+    sinks = xcelMeter._setup_sinks()
+    notifier = xcelMeter._setup_notifier(look_for_creds()) if os.getenv('METER_PUSH_PORT') else None
+    meters = []
+    for entry in meter_list:
+        if entry.get('cert_path') and entry.get('key_path'):
+            creds = (entry['cert_path'], entry['key_path'])
+        else:
+            creds = look_for_creds()
+        try:
+            meter = xcelMeter(entry['name'], entry['ip'], entry['port'], creds,
+                              mqtt_client=mqtt_client, scheduler=scheduler, spool=spool,
+                              notifier=notifier, recorder=recorder, sinks=sinks,
+                              expected_lfdi=entry.get('lfdi'))
+        except Exception as e:
+            logging.error(f"Could not set up meter {entry['name']}: {e}")
+            continue
+        if meter.initalized:
+            meters.append(meter)
+    if not meters:
+        raise RuntimeError('None of the configured meters could be set up')
+    xcelMeter.run_meters(meters)
 
 
 if __name__ == '__main__':
+    # Optional periodic profiling and memory growth reports
+    if os.getenv('METER_PROFILE'):
+        profiler.start(os.getenv('METER_PROFILE'),
+                       sweeps=int(os.getenv('METER_PROFILE_SWEEPS', '10')),
+                       interval=float(os.getenv('METER_PROFILE_INTERVAL', '3600')),
+                       keep=int(os.getenv('METER_PROFILE_KEEP', '24')),
+                       frames=int(os.getenv('METER_PROFILE_FRAMES', '1')))
+    # Optional Prometheus style /metrics page
+    if os.getenv('METRICS_PORT'):
+        metrics.serve(os.getenv('METRICS_HOST', '0.0.0.0'), int(os.getenv('METRICS_PORT')))
+    # More than one meter, either listed in a file or everything mDNS finds
+    if os.getenv('METERS_FILE'):
+        run_multiple(load_meters(os.getenv('METERS_FILE')))
+    elif os.getenv('METER_DISCOVERY', '').lower() == 'all':
+        run_multiple(mDNS_search_for_meters(look_for_creds()))
+
+    creds = look_for_creds()
+    watcher = None
     if os.getenv('METER_IP') and os.getenv('METER_PORT'):
-        ip_address = os.getenv('METER_IP')
-        port_num = os.getenv('METER_PORT')
+        meter = xcelMeter(INTEGRATION_NAME, os.getenv('METER_IP'), os.getenv('METER_PORT'), creds)
     else:
-        ip_address, port_num = mDNS_search_for_meter()
-    creds = look_for_creds()
-    meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds)
+        meter = connect_cached_meter(creds)
+        service_name = (load_meter_cache() or {}).get('service')
+        if meter is None:
+            ip_address, port_num, service_name = mDNS_search_for_meter()
+            meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds)
+        save_meter_cache(meter, service_name)
+        # Follow the meter if it changes address rather than failing every poll
+        watcher = watch_meter(meter, service_name)
 
     if meter.initalized:
         # The run method controls all the looping, querying, and mqtt sending
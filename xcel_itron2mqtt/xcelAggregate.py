@@ -0,0 +1,177 @@
+from array import array
+
+# Aggregates that can be asked for, over the samples in a window newest first
+STATS = {
+    'min': min,
+    'max': max,
+    'mean': lambda values: sum(values) / len(values),
+    'last': lambda values: values[0],
+}
+
+# Units of the rate derived from a total, anything else gets '/h' tacked on
+RATE_UNITS = {'Wh': 'W', 'kWh': 'kW', 'VArh': 'VAr', 'kVArh': 'kVAr'}
+
+def parse_window(window) -> float:
+    """
+    Windows come from the endpoints.yaml as seconds (ie. 10) or with a
+    unit (ie. '10s', '1m', '15m', '1h')
+
+    Returns: float, the window in seconds
+    """
+    if isinstance(window, str):
+        window = window.strip()
+        units = {'s': 1, 'm': 60, 'h': 3600}
+        if window[-1:] in units:
+            return float(window[:-1]) * units[window[-1]]
+    return float(window)
+
+def window_label(seconds: float) -> str:
+    """
+    Returns: str, the shortest whole unit label for a window, ie. 900 -> '15m'
+    """
+    for unit, size in (('h', 3600), ('m', 60)):
+        if seconds >= size and seconds % size == 0:
+            return f'{int(seconds // size)}{unit}'
+    return f'{seconds:g}s'
+
+def _format(value: float) -> str:
+    return format(round(value, 3), '.15g')
+
+class xcelRingBuffer():
+    """
+    Timestamped samples of one sensor, kept in a pair of flat arrays of
+    doubles rather than a list of tuples. Once full the oldest sample is
+    overwritten, unless it's still within `horizon` seconds of the newest
+    in which case the buffer doubles in size first (up to max_size).
+    """
+    def __init__(self, horizon: float, size: int = 64, max_size: int = 65536):
+        self.horizon = horizon
+        self.max_size = max_size
+        self._times = array('d', bytes(8 * size))
+        self._values = array('d', bytes(8 * size))
+        # Where the next sample goes, the oldest sample once the buffer is full
+        self._head = 0
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def append(self, t: float, value: float) -> None:
+        size = len(self._times)
+        if self._len == size and size < self.max_size and t - self._times[self._head] < self.horizon:
+            self._grow()
+            size = len(self._times)
+        self._times[self._head] = t
+        self._values[self._head] = value
+        self._head = (self._head + 1) % size
+        self._len = min(self._len + 1, size)
+
+    def _grow(self) -> None:
+        size = len(self._times)
+        # Unwrap oldest to newest, then double with the free half after
+        self._times = self._times[self._head:] + self._times[:self._head] + array('d', bytes(8 * size))
+        self._values = self._values[self._head:] + self._values[:self._head] + array('d', bytes(8 * size))
+        self._head = size
+
+    def since(self, start: float) -> list:
+        """
+        Returns: list of the values sampled after `start`, newest first
+        """
+        size = len(self._times)
+        values = []
+        i = self._head
+        for _ in range(self._len):
+            i = (i - 1) % size
+            if self._times[i] <= start:
+                break
+            values.append(self._values[i])
+        return values
+
+class xcelAggregator():
+    """
+    Sensors derived from one sensor's readings, set up by the
+    `aggregate` key of a tag in the endpoints.yaml:
+
+    windows: aggregates of the readings over each window, published once
+             per window (a 1m window every minute)
+    stats:   which aggregates, any of min, max, mean and last
+    rate:    true to also derive the rate from the change between
+             readings of a total, per hour (ie. W from Wh)
+    raw:     false to only publish the derived sensors
+
+    add() is handed every reading and returns the derived values it
+    produced, `latest` holds the most recent value of each.
+    """
+    def __init__(self, sensor_name: str, aggregate: dict):
+        self.sensor_name = sensor_name
+        self.windows = sorted(parse_window(w) for w in aggregate.get('windows', []))
+        self.stats = list(aggregate.get('stats', STATS))
+        unknown = set(self.stats) - set(STATS)
+        if unknown:
+            raise ValueError(f"Unknown aggregate(s) for {sensor_name}: {', '.join(sorted(unknown))}")
+        self.rate = bool(aggregate.get('rate', False))
+        self.raw = bool(aggregate.get('raw', True))
+        self._buffer = xcelRingBuffer(self.windows[-1]) if self.windows else None
+        # {window: monotonic time it next closes}
+        self._closes = {}
+        # Last reading seen, and (time, value) of the last one that changed
+        self._last = None
+        self._changed = None
+        self.latest = {}
+
+    def window_sensors(self) -> list:
+        """
+        Returns: list of (sensor name, stat, window) for every windowed aggregate
+        """
+        return [(f'{self.sensor_name}_{stat}_{window_label(window)}', stat, window)
+                for window in self.windows for stat in self.stats]
+
+    @property
+    def rate_sensor(self) -> str:
+        return f'{self.sensor_name}_rate'
+
+    def add(self, value: str, now: float) -> dict:
+        """
+        Take in a reading, closing any windows that are due
+
+        Returns: dict of {derived sensor name: value} for the windows that
+        closed and the rate if it moved
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return {}
+        fresh = {}
+        if self.rate:
+            fresh.update(self._add_rate(value, now))
+        if self._buffer is None:
+            self.latest.update(fresh)
+            return fresh
+        self._buffer.append(now, value)
+        for name, stat, window in self.window_sensors():
+            close = self._closes.setdefault(window, now + window)
+            if now < close:
+                continue
+            values = self._buffer.since(now - window)
+            fresh[name] = _format(STATS[stat](values))
+        for window in self.windows:
+            close = self._closes[window]
+            if now >= close:
+                # Stay on the same boundaries unless we've fallen a whole window behind
+                self._closes[window] = close + window if now < close + window else now + window
+        self.latest.update(fresh)
+
+        return fresh
+
+    def _add_rate(self, value: float, now: float) -> dict:
+        # Totals only tick over every so often, so the rate is taken
+        # between readings that changed rather than between polls
+        rate = {}
+        if self._last is not None and value != self._last:
+            if self._changed is not None and value > self._changed[1] and now > self._changed[0]:
+                start, previous = self._changed
+                rate[self.rate_sensor] = _format((value - previous) / (now - start) * 3600)
+            self._changed = (now, value)
+        self._last = value
+
+        return rate
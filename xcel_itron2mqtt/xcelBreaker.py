@@ -0,0 +1,83 @@
+import logging
+import threading
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class xcelBreaker():
+    """
+    Circuit breaker for a single meter resource. After `failures`
+    polls in a row fail the breaker opens and the resource is left
+    alone for `reset` seconds, after which one probe poll is let
+    through (half open). A successful probe closes the breaker, a failed
+    one opens it again for twice as long, up to `max_reset` seconds.
+    A probe that never reports back (ie. skipped by the sweep budget)
+    is replaced by a new one once it's been out as long as the wait was.
+    on_change(state) is called on every change of state.
+    """
+    def __init__(self, name: str, failures: int = 3, reset: float = 30.0,
+                 max_reset: float = 600.0, on_change=None):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self.max_reset = max_reset
+        self.on_change = on_change
+        self.state = CLOSED
+        self._failed = 0
+        self._open_for = reset
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        if self.on_change is not None:
+            self.on_change(state)
+
+    def allow(self) -> bool:
+        """
+        Whether the resource should be polled right now, moves an open
+        breaker whose wait is over to half open for its probe.
+
+        Returns: bool
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = monotonic()
+            if self.state == OPEN and now >= self._probe_at:
+                logger.info(f"Probing {self.name} after {self._open_for:.0f}s")
+                self._probe_at = now + self._open_for
+                self._set_state(HALF_OPEN)
+                return True
+            if self.state == HALF_OPEN and now >= self._probe_at:
+                logger.info(f"Probe of {self.name} never finished, probing again")
+                self._probe_at = now + self._open_for
+                return True
+            return False
+
+    def succeeded(self) -> None:
+        with self._lock:
+            self._failed = 0
+            self._open_for = self.reset
+            if self.state != CLOSED:
+                logger.info(f"{self.name} is responding again")
+            self._set_state(CLOSED)
+
+    def failed(self) -> None:
+        with self._lock:
+            self._failed += 1
+            if self.state == HALF_OPEN:
+                self._open_for = min(self._open_for * 2, self.max_reset)
+            elif self._failed < self.failures:
+                return
+            self._probe_at = monotonic() + self._open_for
+            if self.state != OPEN:
+                logger.warning(f"{self.name} failed {self._failed} time(s) in a row, "
+                               f"not polling it for {self._open_for:.0f}s")
+            self._set_state(OPEN)
@@ -0,0 +1,227 @@
+import yaml
+import logging
+import requests
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+
+# 2030.5 UomType: (unit_of_measurement, device_class)
+UOMS = {
+    5: ('A', 'current'),
+    29: ('V', 'voltage'),
+    33: ('Hz', 'frequency'),
+    38: ('W', 'power'),
+    61: ('VA', 'apparent_power'),
+    63: ('var', 'reactive_power'),
+    65: (None, 'power_factor'),
+    71: ('VAh', None),
+    72: ('Wh', 'energy'),
+    73: ('varh', None),
+}
+# AccumulationBehaviourType values that are running totals
+TOTALS = {3, 9}
+# Instantaneous readings don't come with a timePeriod worth publishing
+INSTANTANEOUS = 12
+# FlowDirectionType
+FLOW = {1: 'Delivered', 19: 'Received'}
+# PhaseCode
+PHASES = {128: 'PhaseA', 64: 'PhaseB', 32: 'PhaseC'}
+# Seconds between polls of a reading that isn't instantaneous, same as the shipped configs
+TOTAL_INTERVAL = 15
+# Items asked for per page of a list
+PAGE = 64
+
+class xcelCrawler():
+    """
+    Builds an endpoints.yaml for a meter by walking its 2030.5 resource
+    tree from the DeviceCapability down, rather than guessing from its
+    firmware version:
+
+        /dcap -> UsagePointList -> MeterReadingList -> each MeterReading's
+        ReadingType, and its Reading or ReadingSetList -> ReadingList
+
+    Units, device classes and multipliers come from the ReadingType.
+    Only Readings the meter actually answered with a value make it into
+    the plan, so nothing that isn't there gets polled.
+    """
+    def __init__(self, session: requests.Session, base_url: str, timeout: float = 4.0):
+        self.session = session
+        self.base_url = base_url
+        self.timeout = timeout
+        # Requests made, for the log
+        self.requests = 0
+
+    def _get(self, href: str) -> ET.Element | None:
+        """
+        Returns: the parsed resource, or None if the meter doesn't have it
+        """
+        self.requests += 1
+        try:
+            response = self.session.get(f'{self.base_url}{href}', verify=False, timeout=self.timeout)
+        except requests.RequestException as e:
+            logger.debug(f"Crawling {href} failed: {e}")
+            return None
+        if response.status_code != 200:
+            logger.debug(f"Crawling {href}: HTTP {response.status_code}")
+            return None
+        return ET.fromstring(response.content)
+
+    def _list(self, href: str, item: str) -> list:
+        """
+        Every item of a 2030.5 list resource, a page at a time
+
+        Returns: list of Elements
+        """
+        items = []
+        while True:
+            page = self._get(f'{href}?s={len(items)}&l={PAGE}')
+            if page is None:
+                return items
+            found = page.findall(f'{IEEE_PREFIX}{item}')
+            items.extend(found)
+            if not found or len(items) >= int(page.get('all', len(items))):
+                return items
+
+    @staticmethod
+    def _link(element: ET.Element, name: str) -> str | None:
+        link = element.find(f'{IEEE_PREFIX}{name}')
+        return urlsplit(link.get('href')).path if link is not None and link.get('href') else None
+
+    @staticmethod
+    def _int(element: ET.Element, name: str, default: int = 0) -> int:
+        text = element.findtext(f'{IEEE_PREFIX}{name}') if element is not None else None
+        return int(text) if text not in (None, '') else default
+
+    def crawl(self) -> list:
+        """
+        Walk the meter's resources
+
+        Returns: list in the endpoints.yaml form, [{name: {'url', 'tags', ...}}]
+        """
+        dcap = self._get('/dcap')
+        if dcap is None:
+            raise ValueError('Meter has no DeviceCapability at /dcap')
+        usage_points = self._link(dcap, 'UsagePointListLink') or '/upt'
+        endpoints = []
+        names = set()
+        for usage_point in self._list(usage_points, 'UsagePoint'):
+            meter_readings = self._link(usage_point, 'MeterReadingListLink')
+            if meter_readings is None:
+                continue
+            for meter_reading in self._list(meter_readings, 'MeterReading'):
+                for name, v in self._meter_reading(meter_reading):
+                    # The odd meter repeats a description
+                    unique, n = name, 2
+                    while unique in names:
+                        unique, n = f'{name} {n}', n + 1
+                    names.add(unique)
+                    endpoints.append({unique: v})
+        logger.info(f"Crawled {self.requests} resources, found {len(endpoints)} live readings")
+
+        return endpoints
+
+    def _meter_reading(self, meter_reading: ET.Element) -> list:
+        """
+        Returns: list of (name, endpoint) for the live Readings of a MeterReading
+        """
+        href = urlsplit(meter_reading.get('href', '')).path
+        reading_type_href = self._link(meter_reading, 'ReadingTypeLink')
+        reading_type = self._get(reading_type_href) if reading_type_href else None
+        description = meter_reading.findtext(f'{IEEE_PREFIX}description') or self._describe(reading_type)
+        readings = []
+        reading_href = self._link(meter_reading, 'ReadingLink')
+        if reading_href is not None:
+            reading = self._get(reading_href)
+            if reading is not None:
+                readings.append((description, reading_href, reading))
+        reading_sets = self._link(meter_reading, 'ReadingSetListLink')
+        if reading_sets is not None:
+            for reading_set in self._list(reading_sets, 'ReadingSet'):
+                reading_list = self._link(reading_set, 'ReadingListLink')
+                if reading_list is None:
+                    continue
+                items = self._list(reading_list, 'Reading')
+                for reading in items:
+                    tier = reading.findtext(f'{IEEE_PREFIX}touTier')
+                    name = f'TOU {tier} {description}' if len(items) > 1 and tier is not None else description
+                    readings.append((name, urlsplit(reading.get('href', '')).path, reading))
+                # Only the newest set is of interest
+                break
+
+        endpoints = []
+        for name, url, reading in readings:
+            if not url or reading.find(f'{IEEE_PREFIX}value') is None:
+                logger.debug(f"Skipping {href} {name}, no value at {url}")
+                continue
+            endpoints.append((name, self._endpoint(url, reading, reading_type)))
+
+        return endpoints
+
+    def _describe(self, reading_type: ET.Element | None) -> str:
+        """
+        A name for a MeterReading without a description, ie. 'Wh Delivered'
+
+        Returns: str
+        """
+        uom = self._int(reading_type, 'uom')
+        unit, device_class = UOMS.get(uom, (None, None))
+        words = [unit or (device_class or f'uom {uom}').replace('_', ' ').title()]
+        words.append(FLOW.get(self._int(reading_type, 'flowDirection'), ''))
+        words.append(PHASES.get(self._int(reading_type, 'phase'), ''))
+        return ' '.join(word for word in words if word)
+
+    def _endpoint(self, url: str, reading: ET.Element, reading_type: ET.Element | None) -> dict:
+        """
+        Returns: dict, an endpoints.yaml entry for the Reading
+        """
+        unit, device_class = UOMS.get(self._int(reading_type, 'uom'), (None, None))
+        accumulation = self._int(reading_type, 'accumulationBehaviour', INSTANTANEOUS)
+        multiplier = self._int(reading_type, 'powerOfTenMultiplier')
+        value = {'entity_type': 'sensor'}
+        if device_class:
+            value['device_class'] = device_class
+        if unit:
+            value['unit_of_measurement'] = unit
+        if multiplier:
+            value['value_template'] = (f'{{{{ (float( value ) * {10 ** multiplier:g}) '
+                                       f'| round( {max(0, -multiplier)} ) }}}}')
+        value['state_class'] = 'total' if accumulation in TOTALS else 'measurement'
+
+        tags = {}
+        if accumulation != INSTANTANEOUS and reading.find(f'{IEEE_PREFIX}timePeriod/{IEEE_PREFIX}start') is not None:
+            tags['timePeriod'] = [{'start': {
+                'entity_type': 'sensor',
+                'device_class': 'timestamp',
+                'value_template': '{{ as_datetime( value ) }}',
+            }}]
+        tags['value'] = value
+        endpoint = {'url': url}
+        if accumulation != INSTANTANEOUS:
+            endpoint['interval'] = TOTAL_INTERVAL
+        endpoint['tags'] = tags
+
+        return endpoint
+
+    @staticmethod
+    def cache_path(cache_dir: str, lfdi: str, sw_ver: str) -> Path:
+        """
+        Returns: Path, where the crawl of a meter with this lFDI and firmware is kept
+        """
+        return Path(cache_dir) / f"endpoints_{lfdi}_{sw_ver.replace('.', '_')}.yaml"
+
+    @staticmethod
+    def save(path: Path, endpoints: list, source: str) -> None:
+        """
+        Write a crawl out as an endpoints.yaml, which can be edited (or
+        copied into configs/) like any other
+
+        Returns: None
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, mode='w', encoding='utf-8') as file:
+            file.write(f'# Generated by crawling {source}, delete to crawl again\n')
+            yaml.safe_dump(endpoints, file, sort_keys=False, allow_unicode=True)
@@ -0,0 +1,211 @@
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from time import sleep, monotonic
+import paho.mqtt.client as mqtt
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+def plan_hash(configs: dict) -> str:
+    """
+    Returns: str, hex digest over every topic and payload of a plan
+    """
+    digest = hashlib.sha256()
+    for topic in sorted(configs):
+        digest.update(topic.encode('utf-8') + b'\0' + configs[topic] + b'\0')
+    return digest.hexdigest()
+
+def _digest(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+class xcelDiscovery():
+    """
+    Sends homeassistant only the discovery configs that changed since
+    they were last published, rather than all of them on every start.
+
+    Each endpoint adds its plan, {config topic: payload bytes}, along
+    with a topic filter matching all of its configs. sync() then reads
+    back what's retained on the broker under those filters and publishes
+    the configs that are missing or differ. Plans are remembered in
+    `cache_path` under `scope` (the meter name), and configs in there that
+    aren't planned any more (sensors removed from the endpoints.yaml) are
+    cleared with an empty retained payload. Only what the cache says we
+    sent is ever cleared, whatever else the broker holds under the same
+    topics (ie. another bridge's) is left alone. The cache is also what
+    goes if the broker can't be read back within `timeout` seconds
+    (ie. an ACL that won't let us subscribe).
+    """
+    def __init__(self, client: mqtt.Client, scope: str, cache_path: str = None,
+                 timeout: float = 5.0, settle: float = 0.5):
+        self.client = client
+        self.scope = scope
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.timeout = timeout
+        # Seconds without another retained config before the broker is taken to be done
+        self.settle = settle
+        # {endpoint key: (topic filter, {topic: payload})}
+        self._plans = {}
+
+    def add(self, key: str, topic_filter: str, configs: dict) -> None:
+        """
+        Plan an endpoint's configs, sent on the next sync()
+
+        Returns: None
+        """
+        self._plans[key] = (topic_filter, configs)
+
+    def remove(self, key: str) -> None:
+        """
+        Drop an endpoint's plan, its configs are cleared on the next sync()
+
+        Returns: None
+        """
+        self._plans.pop(key, None)
+
+    def sync(self) -> dict:
+        """
+        Publish what's changed, clear what's gone and remember the plans
+
+        Returns: dict of the # of configs 'published', 'unchanged' and 'removed'
+        """
+        previous = self._load()
+        filters = {topic_filter for topic_filter, _ in self._plans.values()}
+        filters.update(entry['filter'] for key, entry in previous.items() if key not in self._plans)
+        retained = self._retained(sorted(filters)) if self.timeout > 0 else None
+        if retained is None:
+            logger.info("Couldn't read discovery configs back from the broker, going by the cache")
+
+        counts = {'published': 0, 'unchanged': 0, 'removed': 0}
+        planned = set()
+        for key, (_, configs) in self._plans.items():
+            known = previous.get(key, {})
+            # Without the broker to go by an endpoint planned the same as last time is left be
+            same = retained is None and known.get('hash') == plan_hash(configs)
+            for topic, payload in configs.items():
+                planned.add(topic)
+                if same:
+                    changed = False
+                elif retained is not None:
+                    # Nothing retained and an empty payload are the same to homeassistant
+                    changed = retained.get(topic, b'') != payload
+                else:
+                    changed = known.get('topics', {}).get(topic) != _digest(payload)
+                if changed:
+                    self._publish(topic, payload)
+                    counts['published'] += 1
+                else:
+                    counts['unchanged'] += 1
+
+        # Only ever clear what we sent, no point clearing what the broker doesn't have
+        stale = {topic for entry in previous.values() for topic in entry['topics']} - planned
+        if retained is not None:
+            stale &= retained.keys()
+        for topic in sorted(stale):
+            self._publish(topic, b'')
+            counts['removed'] += 1
+
+        self._save()
+        for outcome, count in counts.items():
+            metrics.inc('xcel_discovery_configs_total', count, outcome=outcome)
+        logger.info(f"Discovery configs for {self.scope}: {counts['published']} published, "
+                    f"{counts['unchanged']} unchanged, {counts['removed']} removed")
+
+        return counts
+
+    def _publish(self, topic: str, payload: bytes) -> None:
+        result = self.client.publish(topic, payload, retain=True)
+        metrics.inc('xcel_mqtt_publish_total', rc=result.rc)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            logger.error(f"MQTT publish to {topic} failed with return code: {result.rc}")
+
+    def _retained(self, filters: list) -> dict | None:
+        """
+        Subscribe to the filters long enough to collect their retained
+        messages, then unsubscribe
+
+        Returns: dict of {topic: payload}, or None if the broker couldn't be read
+        """
+        deadline = monotonic() + self.timeout
+        while not self.client.is_connected():
+            if monotonic() >= deadline:
+                return None
+            sleep(0.05)
+
+        retained = {}
+        sub_mid = None
+        changed = threading.Condition()
+        # Bumped on the suback and every retained message
+        progress = [0, False]
+        def on_message(client, userdata, message):
+            if message.retain:
+                with changed:
+                    retained[message.topic] = message.payload
+                    progress[0] += 1
+                    changed.notify_all()
+        def on_subscribe(client, userdata, mid, *args):
+            # Held by the subscribe() call until sub_mid is set
+            with changed:
+                if mid == sub_mid:
+                    progress[1] = True
+                    changed.notify_all()
+
+        for topic_filter in filters:
+            self.client.message_callback_add(topic_filter, on_message)
+        previous_on_subscribe = self.client.on_subscribe
+        self.client.on_subscribe = on_subscribe
+        try:
+            with changed:
+                rc, sub_mid = self.client.subscribe([(topic_filter, 0) for topic_filter in filters])
+                if rc != mqtt.MQTT_ERR_SUCCESS:
+                    return None
+                if not changed.wait_for(lambda: progress[1], timeout=max(0, deadline - monotonic())):
+                    return None
+                # Retained messages follow the suback, wait for them to stop coming
+                while True:
+                    seen = progress[0]
+                    changed.wait(self.settle)
+                    if progress[0] == seen or monotonic() >= deadline:
+                        break
+            return dict(retained)
+        finally:
+            self.client.on_subscribe = previous_on_subscribe
+            self.client.unsubscribe(filters)
+            for topic_filter in filters:
+                self.client.message_callback_remove(topic_filter)
+
+    def _load(self) -> dict:
+        """
+        Returns: dict of this scope's plans from last time, {key: {'filter', 'hash', 'topics'}}
+        """
+        if self.cache_path is None or not self.cache_path.is_file():
+            return {}
+        try:
+            with open(self.cache_path, mode='r', encoding='utf-8') as file:
+                return json.load(file).get(self.scope, {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable discovery cache {self.cache_path}: {e}")
+            return {}
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        try:
+            cache = {}
+            if self.cache_path.is_file():
+                with open(self.cache_path, mode='r', encoding='utf-8') as file:
+                    cache = json.load(file)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self.scope] = {key: {'filter': topic_filter, 'hash': plan_hash(configs),
+                                   'topics': {t: _digest(p) for t, p in configs.items()}}
+                             for key, (topic_filter, configs) in self._plans.items()}
+        try:
+            with open(self.cache_path, mode='w', encoding='utf-8') as file:
+                json.dump(cache, file)
+        except OSError as e:
+            logger.warning(f"Could not write discovery cache {self.cache_path}: {e}")
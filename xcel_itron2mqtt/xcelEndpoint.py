@@ -5,79 +5,252 @@ import logging
 import requests
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
-from copy import deepcopy
-from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
+from itertools import chain
+from urllib.parse import urlsplit
+from time import monotonic, time
+from tenacity import retry, stop_after_attempt, stop_after_delay, before_sleep_log, wait_exponential
+
+# Local imports
+from xcelMetrics import metrics
+from xcelBreaker import xcelBreaker, OPEN, CLOSED, HALF_OPEN
+from xcelAggregate import xcelAggregator, RATE_UNITS
+from xcelSinks import xcelMqttSink
 
 logger = logging.getLogger(__name__)
 
 # Prefix that appears on all of the XML elements
 IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+# Seconds past the end of a reading's ttl before it's fetched again, gives the meter time to roll over
+TTL_MARGIN = 2.0
+
+class TagPlan():
+    """
+    Compiled form of an endpoint's tags from the endpoints.yaml.
+    Maps the namespaced path of every element we care about to the
+    sensor key its reading is reported under, so a response can be
+    read in one streaming pass instead of searching the tree per tag.
+    """
+    # Bytes fed to the pull parser at a time, lets us bail out early
+    CHUNK_SIZE = 512
+
+    def __init__(self, tags: dict):
+        # {'<ns>parent/<ns>tag' or '<ns>tag': sensor key}
+        self.paths = {}
+        for k, v in tags.items():
+            if isinstance(v, list):
+                for val_items in v:
+                    for k2 in val_items.keys():
+                        self.paths[f'{IEEE_PREFIX}{k}/{IEEE_PREFIX}{k2}'] = f'{k}{k2}'
+            else:
+                # Top level tags match wherever they appear in the document
+                self.paths[f'{IEEE_PREFIX}{k}'] = k
+
+    def _chunks(self, response):
+        """
+        Split a complete response into parser sized chunks, anything
+        else is assumed to already be an iterable of chunks.
+        """
+        if isinstance(response, (str, bytes)):
+            for i in range(0, len(response), self.CHUNK_SIZE):
+                yield response[i:i + self.CHUNK_SIZE]
+        else:
+            yield from response
+
+    def extract(self, response) -> dict:
+        """
+        Stream the response through a pull parser, stopping as soon as
+        every element in the plan has been seen.
+
+        Returns: dict in the form of {sensor key: value}
+        """
+        readings = {}
+        wanted = len(self.paths)
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        # Tags of the currently open elements
+        stack = []
+        # A trailing None closes the parser to flush any buffered events
+        for chunk in chain(self._chunks(response), (None,)):
+            if chunk is None:
+                parser.close()
+            else:
+                parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    stack.append(elem.tag)
+                    continue
+                stack.pop()
+                key = None
+                if stack:
+                    key = self.paths.get(f'{stack[-1]}/{elem.tag}')
+                if key is None:
+                    key = self.paths.get(elem.tag)
+                # First match in document order wins, same as find()
+                if key is not None and key not in readings:
+                    readings[key] = elem.text
+                    if len(readings) == wanted:
+                        return readings
+
+        return readings
+
+_log_retry = before_sleep_log(logger, logging.WARNING)
+
+def _before_sleep(retry_state) -> None:
+    """
+    Log the upcoming retry same as before, and count it against the endpoint
+    """
+    _log_retry(retry_state)
+    metrics.inc('xcel_request_retries_total', **retry_state.args[0]._metric_labels)
 
 class xcelEndpoint():
     """
     Class wrapper for all readings associated with the Xcel meter.
     Expects a request session that should be shared amongst the
-    instances.
+    instances. topic_namespace gets prefixed onto the MQTT topics, needed
+    when several meters share one broker. Readings that can't be
+    published are handed to the spool (see xcelSpool) when one is given,
+    and every reading is kept by the recorder (see xcelRecorder) if one is.
+    Readings are published to each of the sinks (see xcelSinks), MQTT
+    alone unless others are given.
+    Polls go through the transport instead of the session if one is
+    given (see xcelTransport). Discovery configs are left to discovery
+    to send if given (see xcelDiscovery), rather than all sent here.
+    With a ttl each reading is taken to stay good until its timePeriod
+    (or the configured period) is up, see fresh_for().
     """
     def __init__(self, session: requests.Session, mqtt_client: mqtt.Client,
-                    url: str, name: str, tags: list, device_info: dict):
+                    url: str, name: str, tags: list, device_info: dict,
+                    topic_namespace: str = None, spool=None, recorder=None,
+                    transport=None, discovery=None, ttl=None, sinks=None):
         self.requests_session = session
+        self.transport = transport
+        self.discovery = discovery
         self.url = url
         self.name = name
         self.tags = tags
         self.client = mqtt_client
+        self.spool = spool
+        self.recorder = recorder
+        self.sinks = sinks if sinks is not None else [xcelMqttSink()]
         self.device_info = device_info
+        # Compile the tags once so each poll is a single pass over the XML
+        self._tag_plan = TagPlan(tags)
+        # Wall-clock time the last reading stops being good, and how long it was good for
+        self.ttl = self._parse_ttl(ttl)
+        self.valid_until = 0.0
+        self._ttl_window = 0.0
+        # Times a poll came due while the reading was still good, and the requests that saved
+        self.fresh_hits = 0
+        self.fresh_skipped = 0
+        # The reading the last ttl was worked out from, to tell whether the refetch brought a new one
+        self._ttl_reading = None
+        self._refetching = False
+        # timePeriod children read only to work out the ttl, never published
+        self._ttl_keys = ()
+        if self.ttl == 'auto':
+            hidden = []
+            for leaf in ('start', 'duration'):
+                path = f'{IEEE_PREFIX}timePeriod/{IEEE_PREFIX}{leaf}'
+                if path not in self._tag_plan.paths:
+                    self._tag_plan.paths[path] = f'timePeriod{leaf}'
+                    hidden.append(f'timePeriod{leaf}')
+            self._ttl_keys = tuple(hidden)
 
         self._mqtt_topic_prefix = os.getenv('MQTT_TOPIC_PREFIX', 'homeassistant')
         self._mqtt_topic = None
+        # MQTT Topics don't like spaces
+        self._mqtt_friendly_name = self.name.replace(" ", "_")
+        if topic_namespace:
+            self._mqtt_friendly_name = f'{topic_namespace}_{self.name}'.replace(" ", "_")
+        # Labels every metric for this endpoint is recorded under
+        self._metric_labels = {'meter': device_info['device']['name'], 'endpoint': name}
         # Record all of the sensor state topics in an easy to lookup dict
         self._sensor_state_topics = {}
+        # Readings are only republished once they move past the sensor's
+        # deadband, or once they've been quiet for the heartbeat in seconds.
+        # A heartbeat of 0 publishes every reading
+        self._heartbeat = float(os.getenv('MQTT_HEARTBEAT', '300'))
+        self._sensor_deadbands = {}
+        self._sensor_heartbeats = {}
+        # Sensors where only the latest reading matters if they have to be spooled
+        self._sensor_coalesce = {}
+        # {sensor name: xcelAggregator} for sensors with derived ones, see xcelAggregate
+        self._aggregators = {}
+        # {config topic: payload} last sent to homeassistant
+        self.discovery_configs = {}
+        # {sensor name: (last published value, monotonic time it was sent)}
+        self._last_published = {}
+        # Running totals of readings sent vs held back as unchanged
+        self.sent = 0
+        self.suppressed = 0
+        # MQTT_STATE_JSON bundles readings into one JSON state document per
+        # 'endpoint' or per 'meter' (xcelMeter publishes that one), unset
+        # publishes every sensor to its own topic
+        self._state_json = os.getenv('MQTT_STATE_JSON', '').lower() or None
+        if self._state_json == 'meter':
+            meter_name = device_info['device']['name'].replace(' ', '_')
+            self._state_topic = f'{self._mqtt_topic_prefix}/sensor/{meter_name}/state'
+        else:
+            self._state_topic = f'{self._mqtt_topic_prefix}/sensor/{self._mqtt_friendly_name}/state'
+        # Latest reading and whether it still needs to go out, used in meter mode
+        self.state = {}
+        self.state_pending = False
+        # Homeassistant marks this endpoint's sensors unavailable while its breaker is open
+        self._availability_topic = f'{self._mqtt_topic_prefix}/sensor/{self._mqtt_friendly_name}/availability'
+        self.breaker = xcelBreaker(f"{device_info['device']['name']} {name}",
+                                   failures=int(os.getenv('METER_BREAKER_FAILURES', '3')),
+                                   reset=float(os.getenv('METER_BREAKER_RESET', '30')),
+                                   on_change=self._availability_changed)
 
         # Setup the rest of what we need for this endpoint
         self._mqtt_send_config()
 
-    @retry(stop=stop_after_attempt(15),
-           wait=wait_exponential(multiplier=1, min=1, max=15),
-           before_sleep=before_sleep_log(logger, logging.WARNING),
-           reraise=True)
-    def query_endpoint(self) -> str:
+    def query_endpoint(self) -> str | bytes:
         """
         Sends a request to the given endpoint associated with the
-        object instance
+        object instance, retrying on failure
 
-        Returns: str in XML format of the meter's response
+        Returns: str in XML format of the meter's response, bytes if it
+        came through the transport
         """
-        x = self.requests_session.get(self.url, verify=False, timeout=15.0)
+        try:
+            return self._query_with_retries()
+        except Exception:
+            metrics.inc('xcel_request_failures_total', **self._metric_labels)
+            raise
+
+    # A few quick retries for a flaky response, anything more is left to the breaker
+    @retry(stop=(stop_after_attempt(3) | stop_after_delay(10)),
+           wait=wait_exponential(multiplier=0.5, min=0.5, max=2),
+           before_sleep=_before_sleep,
+           reraise=True)
+    def _query_with_retries(self) -> str | bytes:
+        try:
+            with metrics.timer('xcel_request_seconds', **self._metric_labels):
+                if self.transport is not None:
+                    # Left as bytes, the parser takes them as they are
+                    return self.transport.get(self.url, timeout=15.0)
+                x = self.requests_session.get(self.url, verify=False, timeout=15.0)
+                # Error pages from a busy meter aren't readings, retry them
+                x.raise_for_status()
+        except Exception:
+            metrics.inc('xcel_request_errors_total', **self._metric_labels)
+            raise
 
         return x.text
 
     @staticmethod
-    def parse_response(response: str, tags: dict) -> dict:
+    def parse_response(response: str | bytes, tags: 'dict | TagPlan') -> dict:
         """
         Drill down the XML response from the meter and extract the
-        readings according to the endpoints.yaml structure.
+        readings according to the endpoints.yaml structure. Accepts either
+        the raw tags dict or an already compiled TagPlan.
 
         Returns: dict in the nesting structure of found below each tag
         in the endpoints.yaml
         """
-        readings_dict = {}
-        root = ET.fromstring(response)
-        # Kinda gross
-        for k, v in tags.items():
-            if isinstance(v, list):
-                for val_items in v:
-                    for k2, v2 in val_items.items():
-                        search_val = f'{IEEE_PREFIX}{k2}'
-                        if root.find(f'.//{search_val}') is not None:
-                            value = root.find(f'.//{search_val}').text
-                            readings_dict[f'{k}{k2}'] = value
-            else:
-                search_val = f'{IEEE_PREFIX}{k}'
-                if root.find(f'.//{IEEE_PREFIX}{k}') is not None:
-                    value = root.find(f'.//{IEEE_PREFIX}{k}').text
-                    readings_dict[k] = value
+        plan = tags if isinstance(tags, TagPlan) else TagPlan(tags)
 
-        return readings_dict
+        return plan.extract(response)
 
     def _get_reading(self) -> dict:
         """
@@ -87,83 +260,365 @@ class xcelEndpoint():
         Returns: Dict in the form of {reading: value}
         """
         response = self.query_endpoint()
-        parsed_response = self.parse_response(response, self.tags)
+        parsed_response = self.parse_response(response, self._tag_plan)
 
         return parsed_response
 
-    def _create_config(self, sensor_name: str,  details: dict) -> tuple[str, dict]:
+    def _create_config(self, sensor_name: str,  details: dict) -> tuple[str, str]:
         """
         Helper to generate the JSON sonfig payload for setting
         up the new Homeassistant entities
 
         Returns: Tuple consisting of a string representing the mqtt
-        topic, and a dict to be used as the payload.
+        topic, and the JSON payload as a string.
         """
-        payload = deepcopy(details)
-        mqtt_friendly_name = self.name.replace(" ", "_")
+        # Only top level keys are changed, a shallow copy keeps the yaml as it was
+        payload = dict(details)
+        mqtt_friendly_name = self._mqtt_friendly_name
         entity_type = payload.pop('entity_type')
+        # Publish-on-change settings are ours, Homeassistant doesn't know them
+        self._sensor_deadbands[sensor_name] = self._parse_deadband(payload.pop('deadband', None))
+        self._sensor_heartbeats[sensor_name] = float(payload.pop('heartbeat', self._heartbeat))
+        self._sensor_coalesce[sensor_name] = payload.get('state_class') == 'measurement'
+        aggregate = payload.pop('aggregate', None)
         payload["state_topic"] = f'{self._mqtt_topic_prefix}/{entity_type}/{mqtt_friendly_name}/{sensor_name}/state'
+        if self._state_json:
+            # Pull this sensor's field out of the shared document, then let
+            # any template from the endpoints.yaml work on it as before
+            path = f"['{sensor_name}']"
+            if self._state_json == 'meter':
+                path = f"['{mqtt_friendly_name}']{path}"
+            template = payload.get('value_template', '{{ value }}')
+            payload['value_template'] = f'{{% set value = value_json{path} %}}{template}'
+            payload["state_topic"] = self._state_topic
         payload['name'] = f'{self.name} {sensor_name}'
         # Mouthful
         # Unique ID becomes the device name + class name + sensor name, all lower case, all underscores instead of spaces
         payload['unique_id'] = f"{self.device_info['device']['name']}_{self.name}_{sensor_name}".lower().replace(' ', '_')
+        payload['availability_topic'] = self._availability_topic
         payload.update(self.device_info)
         # MQTT Topics don't like spaces
         mqtt_topic = f'{self._mqtt_topic_prefix}/{entity_type}/{mqtt_friendly_name}/{sensor_name}/config'
         # Capture the state topic the sensor is associated with for later use
         self._sensor_state_topics[sensor_name] = payload['state_topic']
+        if aggregate is not None:
+            self._aggregators[sensor_name] = xcelAggregator(sensor_name, aggregate)
+            if not self._aggregators[sensor_name].raw:
+                # An empty config removes the raw sensor from homeassistant
+                return mqtt_topic, ''
         payload = json.dumps(payload)
 
         return mqtt_topic, payload
 
+    def _create_aggregate_configs(self, sensor_name: str, details: dict) -> dict:
+        """
+        The configs of the sensors derived from this one, each a copy
+        of the source sensor's. Aggregates are plain numbers so the
+        source's value_template is left off, and min/max/mean are
+        measurements whatever the source is (a mean of a summation isn't
+        a running total).
+
+        Returns: dict of {mqtt topic: JSON payload}
+        """
+        aggregator = self._aggregators[sensor_name]
+        derived = {k: v for k, v in details.items()
+                   if k not in ('aggregate', 'deadband', 'heartbeat', 'value_template')}
+        # Without the template a timestamp is just seconds
+        if derived.get('device_class') == 'timestamp':
+            del derived['device_class']
+        summary = {**derived, 'state_class': 'measurement'}
+        # Homeassistant only takes energy and the like on totals
+        if details.get('state_class') in ('total', 'total_increasing'):
+            summary.pop('device_class', None)
+        sensors = [(name, derived if stat == 'last' else summary)
+                   for name, stat, _ in aggregator.window_sensors()]
+        if aggregator.rate:
+            unit = details.get('unit_of_measurement', '')
+            sensors.append((aggregator.rate_sensor, {
+                'entity_type': details.get('entity_type', 'sensor'),
+                'device_class': 'power' if unit in ('Wh', 'kWh') else None,
+                'unit_of_measurement': RATE_UNITS.get(unit, f'{unit}/h'),
+                'state_class': 'measurement',
+            }))
+        configs = {}
+        for name, config in sensors:
+            config = {k: v for k, v in config.items() if v is not None}
+            mqtt_topic, payload = self._create_config(name, config)
+            configs[mqtt_topic] = payload
+
+        return configs
+
+    def _aggregate(self, reading: dict, now: float) -> dict:
+        """
+        Feed the reading through each aggregator, adding whatever derived
+        values it produced and leaving out raw ones that are hidden. A
+        JSON state document always carries the latest of every one.
+
+        Returns: dict in the form of {sensor key: value}
+        """
+        aggregated = {}
+        for k, v in reading.items():
+            aggregator = self._aggregators.get(k)
+            if aggregator is None:
+                aggregated[k] = v
+                continue
+            if aggregator.raw:
+                aggregated[k] = v
+            fresh = aggregator.add(v, now)
+            aggregated.update(aggregator.latest if self._state_json else fresh)
+
+        return aggregated
+
     def _mqtt_send_config(self) -> None:
         """
         Homeassistant requires a config payload to be sent to more
         easily setup the sensor/device once it appears over mqtt
         https://www.home-assistant.io/integrations/mqtt/
         """
-        _tags = deepcopy(self.tags)
-        for k, v in _tags.items():
-            if isinstance(v, list):
-                for val_items in v:
-                    name, details = val_items.popitem()
-                    sensor_name = f'{k}{name}'
-                    mqtt_topic, payload = self._create_config(sensor_name, details)
-                    # Send MQTT payload
-                    self._mqtt_publish(mqtt_topic, str(payload))
-            else:
-                name_suffix = f'{k[0].upper()}'
-                mqtt_topic, payload = self._create_config(k, v)
-                self._mqtt_publish(mqtt_topic, str(payload), retain=True)
+        configs = self.discovery_configs = self.discovery_plan()
+        if self.discovery is not None:
+            self.discovery.add(self._mqtt_friendly_name, self.discovery_filter, configs)
+        else:
+            for mqtt_topic, payload in configs.items():
+                self._mqtt_publish(mqtt_topic, payload, retain=True)
+        self._mqtt_publish(self._availability_topic, 'online', retain=True)
+
+    def discovery_plan(self) -> dict:
+        """
+        Build every discovery config this endpoint sends, encoded and
+        ready to publish
+
+        Returns: dict of {mqtt topic: payload bytes}
+        """
+        configs = {}
+        for k, v in self.tags.items():
+            sensors = [(f'{k}{name}', details) for val_items in v for name, details in val_items.items()] \
+                if isinstance(v, list) else [(k, v)]
+            for sensor_name, details in sensors:
+                mqtt_topic, payload = self._create_config(sensor_name, details)
+                configs[mqtt_topic] = payload.encode('utf-8')
+                if sensor_name in self._aggregators:
+                    for derived_topic, derived in self._create_aggregate_configs(sensor_name, details).items():
+                        configs[derived_topic] = derived.encode('utf-8')
+
+        return configs
+
+    @property
+    def discovery_filter(self) -> str:
+        """
+        Returns: str, MQTT topic filter matching every config of this endpoint
+        """
+        return f'{self._mqtt_topic_prefix}/+/{self._mqtt_friendly_name}/+/config'
+
+    def _availability_changed(self, state: str) -> None:
+        """
+        Tell homeassistant when the breaker gives up on or recovers this endpoint
+
+        Returns: None
+        """
+        if state == OPEN:
+            self._mqtt_publish(self._availability_topic, 'offline', retain=True)
+        elif state == CLOSED:
+            self._mqtt_publish(self._availability_topic, 'online', retain=True)
+
+    @staticmethod
+    def _parse_deadband(deadband) -> tuple | None:
+        """
+        Deadbands come from the endpoints.yaml as either an absolute
+        number (ie. 5) or a percent of the last published value (ie. '2%')
+
+        Returns: tuple of (band, is percent) or None if not set
+        """
+        if deadband is None:
+            return None
+        if isinstance(deadband, str) and deadband.strip().endswith('%'):
+            return float(deadband.strip()[:-1]), True
+        return float(deadband), False
+
+    @staticmethod
+    def _parse_ttl(ttl) -> float | str | None:
+        """
+        ttls come from the endpoints.yaml (or METER_TTL) as either 'auto',
+        good until the reading's own timePeriod start + duration is up,
+        or a period in seconds, good until the next wall-clock multiple
+        of it (ie. 900 for :00, :15, :30, :45)
+
+        Returns: 'auto', the period as a float, or None if not set
+        """
+        if ttl is None or ttl is False or str(ttl).strip().lower() in ('', '0', 'off'):
+            return None
+        if str(ttl).strip().lower() == 'auto':
+            return 'auto'
+        try:
+            period = float(ttl)
+        except (TypeError, ValueError):
+            period = 0
+        if period <= 0:
+            raise ValueError(f"ttl must be 'auto' or a positive number of seconds, got {ttl}")
+        return period
+
+    def _update_ttl(self, reading: dict, now: float) -> None:
+        """
+        Work out how long a freshly parsed reading stays good for, taking
+        out the timePeriod children that were only read for it
+
+        Returns: None
+        """
+        start = reading.get('timePeriodstart')
+        duration = reading.get('timePeriodduration')
+        for key in self._ttl_keys:
+            reading.pop(key, None)
+        if self._refetching:
+            self._refetching = False
+            # A refetch that gets the same reading back was too early for the meter
+            outcome = 'same' if reading == self._ttl_reading else 'new'
+            metrics.inc('xcel_ttl_refetch_total', outcome=outcome, **self._metric_labels)
+        self._ttl_reading = dict(reading)
+        if self.ttl == 'auto':
+            try:
+                self._ttl_window = float(duration)
+                self.valid_until = float(start) + self._ttl_window
+            except (TypeError, ValueError):
+                # Nothing to go by, poll as usual
+                self.valid_until = 0.0
+        else:
+            self._ttl_window = self.ttl
+            self.valid_until = (now // self.ttl + 1) * self.ttl
+
+    def fresh_for(self, now: float) -> float:
+        """
+        How much longer the last reading stays good, never more than one
+        whole timePeriod in case the meter's clock is off from ours
+
+        Returns: float, seconds from the wall-clock time now, 0 if it's expired
+        """
+        if self.ttl is None:
+            return 0.0
+        return max(0.0, min(self.valid_until - now, self._ttl_window))
+
+    def skip_fresh(self, polls: int) -> None:
+        """
+        Count polls left unsent while the reading was good, the next
+        one is a refetch
+
+        Returns: None
+        """
+        self.fresh_hits += 1
+        self.fresh_skipped += polls
+        self._refetching = True
+
+    def _should_publish(self, sensor_name: str, value: str, now: float) -> bool:
+        """
+        Decide whether a reading has changed enough from the last one
+        we published, or been quiet long enough, to be worth sending.
+
+        Returns: bool
+        """
+        last = self._last_published.get(sensor_name)
+        heartbeat = self._sensor_heartbeats.get(sensor_name, self._heartbeat)
+        if last is None or heartbeat <= 0:
+            return True
+        last_value, last_time = last
+        if now - last_time >= heartbeat:
+            return True
+        if value == last_value:
+            return False
+        deadband = self._sensor_deadbands.get(sensor_name)
+        if deadband is None:
+            return True
+        try:
+            new, old = float(value), float(last_value)
+        except (TypeError, ValueError):
+            return True
+        band, is_percent = deadband
+        limit = abs(old) * band / 100 if is_percent else band
+
+        return abs(new - old) > limit
 
     def _process_send_mqtt(self, reading: dict) -> None:
         """
         Run through the readings from the meter and translate
-        and prepare these readings to send over mqtt
+        and prepare these readings to send over mqtt, skipping any
+        that haven't changed since they were last published
 
         Returns: None
         """
-        mqtt_topic_message = {}
+        now = monotonic()
+        if self._state_json:
+            self._process_send_state(reading, now)
+            return
         # Cycle through all the readings for the given sensor
         for k, v in reading.items():
+            if not self._should_publish(k, v, now):
+                self.suppressed += 1
+                continue
             # Figure out which topic this reading needs to be sent to
             topic = self._sensor_state_topics[k]
-            if topic not in mqtt_topic_message.keys():
-                mqtt_topic_message[topic] = {}
-            # Create dict of {topic: payload}
-            mqtt_topic_message[topic] = v
+            self.sent += 1
+            # Only remember readings the broker (or spool) actually got, so failures retry next poll
+            coalesce = self._sensor_coalesce.get(k, False)
+            if self._publish_reading(topic, v, coalesce) == mqtt.MQTT_ERR_SUCCESS:
+                self._last_published[k] = (v, now)
 
-        # Cycle through and send the payload to the associated keys
-        for topic, payload in mqtt_topic_message.items():
-            self._mqtt_publish(topic, payload)
+    def _process_send_state(self, reading: dict, now: float) -> None:
+        """
+        Send the whole reading as one JSON document, if any of its
+        sensors are due. In meter mode the reading is left for xcelMeter
+        to bundle up with the other endpoints instead.
 
-    def _mqtt_publish(self, topic: str, message: str, retain=False) -> int:
+        Returns: None
+        """
+        self.state = reading
+        if not any(self._should_publish(k, v, now) for k, v in reading.items()):
+            self.suppressed += len(reading)
+            return
+        if self._state_json == 'meter':
+            self.state_pending = True
+            return
+        coalesce = all(self._sensor_coalesce.get(k, False) for k in reading)
+        if self._publish_reading(self._state_topic, json.dumps(reading), coalesce) == mqtt.MQTT_ERR_SUCCESS:
+            self.mark_published(now)
+
+    def mark_published(self, now: float) -> None:
+        """
+        Record the current JSON state as published
+
+        Returns: None
+        """
+        for k, v in self.state.items():
+            self._last_published[k] = (v, now)
+        self.sent += len(self.state)
+        self.state_pending = False
+
+    def _publish_reading(self, topic: str, value: str, coalesce: bool = False) -> int:
+        """
+        Publish a reading, falling back to the spool if the broker
+        can't take it. While the spool has a backlog new readings queue
+        up behind it so they still reach the broker in order.
+
+        Returns: integer (return code), MQTT_ERR_SUCCESS once spooled
+        """
+        if self.spool is not None and len(self.spool):
+            self.spool.put(topic, value, coalesce=coalesce)
+            return mqtt.MQTT_ERR_SUCCESS
+        rc = self._mqtt_publish(topic, value)
+        if rc != mqtt.MQTT_ERR_SUCCESS and self.spool is not None:
+            self.spool.put(topic, value, coalesce=coalesce)
+            logger.debug(f"Spooled reading for {topic} until the broker is back")
+            return mqtt.MQTT_ERR_SUCCESS
+
+        return rc
+
+    def _mqtt_publish(self, topic: str, message: str | bytes, retain=False) -> int:
         """
         Publish the given message to the topic associated with the class
 
         Returns: integer (return code)
         """
-        result = self.client.publish(topic, str(message), retain=retain)
+        if not isinstance(message, bytes):
+            message = str(message)
+        result = self.client.publish(topic, message, retain=retain)
+        metrics.inc('xcel_mqtt_publish_total', rc=result.rc)
 
         # Check the return code and log appropriately
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
@@ -176,6 +631,57 @@ class xcelEndpoint():
         # Return status of the published message (backwards compatibility)
         return result.rc
 
+    def process_response(self, response: str) -> None:
+        """
+        Parse an already fetched response and send the readings
+        to the sinks. Split out from run() so fetching can happen
+        elsewhere (ie. a worker pool).
+
+        Returns: None
+        """
+        for obj, reading, timestamp in self.parse(response):
+            obj.publish(reading, timestamp)
+
+    def parse(self, response: str, timestamp: float = None) -> list:
+        """
+        Parse an already fetched response, the first half of
+        process_response. `timestamp` is when it was polled, now if
+        not given.
+
+        Returns: list of (endpoint, reading, timestamp) triples, just
+        this endpoint's
+        """
+        with metrics.timer('xcel_parse_seconds', **self._metric_labels):
+            reading = self.parse_response(response, self._tag_plan)
+            timestamp = time() if timestamp is None else timestamp
+            if self.ttl is not None:
+                self._update_ttl(reading, timestamp)
+            if self.recorder is not None:
+                self.recorder.record(self._metric_labels['meter'], self.name, reading, timestamp)
+            if self._aggregators:
+                reading = self._aggregate(reading, monotonic())
+            return [(self, reading, timestamp)]
+
+    def publish(self, reading: dict, timestamp: float = None) -> None:
+        """
+        Hand a parsed reading to each of the sinks, the second half
+        of process_response
+
+        Returns: None
+        """
+        timestamp = time() if timestamp is None else timestamp
+        with metrics.timer('xcel_publish_seconds', **self._metric_labels):
+            for sink in self.sinks:
+                sink.submit(self, reading, timestamp)
+
+    @property
+    def coalescable(self) -> bool:
+        """
+        Whether an older, unpublished reading can be dropped in favour
+        of a newer one, true when every sensor is a measurement
+        """
+        return all(self._sensor_coalesce.values())
+
     def run(self) -> None:
         """
         Main business loop for the endpoint class.
@@ -183,5 +689,147 @@ class xcelEndpoint():
 
         Returns: None
         """
-        reading = self._get_reading()
-        self._process_send_mqtt(reading)
+        self.process_response(self.query_endpoint())
+
+    def allow(self) -> bool:
+        """
+        Returns: bool, whether the breaker lets this endpoint be polled now
+        """
+        return self.breaker.allow()
+
+    @property
+    def probing(self) -> bool:
+        return self.breaker.state == HALF_OPEN
+
+    def record(self, ok: bool) -> None:
+        """
+        Count a poll of this endpoint towards its breaker
+
+        Returns: None
+        """
+        self.breaker.succeeded() if ok else self.breaker.failed()
+
+class xcelReadingList():
+    """
+    Several endpoints that are Readings in the same 2030.5 ReadingList
+    (ie. /upt/1/mr/8/rs/1/r/1 through /r/4), fetched with one paged GET
+    of the list and fanned back out to each endpoint. Has the same
+    query_endpoint/process_response/run interface as xcelEndpoint so it
+    can be polled in its place. Readings missing from the list are
+    fetched on their own through the executor if given (the meter's, so
+    they count against its concurrency), otherwise one at a time.
+    """
+    def __init__(self, list_url: str, endpoints: list, executor=None):
+        self.url = list_url
+        self.endpoints = endpoints
+        self.executor = executor
+        self.requests_session = endpoints[0].requests_session
+        self.transport = endpoints[0].transport
+        self.name = urlsplit(list_url).path
+        self._metric_labels = {**endpoints[0]._metric_labels, 'endpoint': self.name}
+        # {reading href: endpoint}
+        self._by_href = {urlsplit(obj.url).path: obj for obj in endpoints}
+        # Readings are numbered from 1, the list's start index from 0
+        self._limit = max(int(href.rsplit('/', 1)[1]) for href in self._by_href)
+        # Endpoints that had to be queried on their own and failed
+        self._fell_through = set()
+
+    @staticmethod
+    def list_url(url: str) -> str | None:
+        """
+        Returns: str, url of the ReadingList the Reading is in, or None
+        if the url isn't an item of a list
+        """
+        parent, _, index = url.rstrip('/').rpartition('/')
+        if not index.isdigit() or not parent.endswith('/r'):
+            return None
+        return parent
+
+    def query_endpoint(self) -> str | bytes:
+        try:
+            return self._query_with_retries()
+        except Exception:
+            metrics.inc('xcel_request_failures_total', **self._metric_labels)
+            raise
+
+    # A few quick retries for a flaky response, anything more is left to the breaker
+    @retry(stop=(stop_after_attempt(3) | stop_after_delay(10)),
+           wait=wait_exponential(multiplier=0.5, min=0.5, max=2),
+           before_sleep=_before_sleep,
+           reraise=True)
+    def _query_with_retries(self) -> str | bytes:
+        try:
+            with metrics.timer('xcel_request_seconds', **self._metric_labels):
+                if self.transport is not None:
+                    return self.transport.get(f'{self.url}?s=0&l={self._limit}', timeout=15.0)
+                x = self.requests_session.get(self.url, params={'s': 0, 'l': self._limit},
+                                              verify=False, timeout=15.0)
+                x.raise_for_status()
+        except Exception:
+            metrics.inc('xcel_request_errors_total', **self._metric_labels)
+            raise
+
+        return x.text
+
+    def process_response(self, response: str) -> None:
+        """
+        Hand each Reading in the list to its endpoint to publish
+
+        Returns: None
+        """
+        for obj, reading, timestamp in self.parse(response):
+            obj.publish(reading, timestamp)
+
+    def parse(self, response: str, timestamp: float = None) -> list:
+        """
+        Split the list into each endpoint's Reading and parse it, all
+        stamped with when the list was polled. Any endpoint whose
+        Reading didn't come back is queried on its own.
+
+        Returns: list of (endpoint, reading, timestamp) triples
+        """
+        root = ET.fromstring(response)
+        pending = dict(self._by_href)
+        self._fell_through = set()
+        readings = []
+        for reading in root.iter(f'{IEEE_PREFIX}Reading'):
+            obj = pending.pop(urlsplit(reading.get('href', '')).path, None)
+            if obj is not None:
+                readings.extend(obj.parse(ET.tostring(reading), timestamp))
+        fetches = []
+        for obj in pending.values():
+            logger.debug(f"{obj.url} missing from {self.name}, querying it on its own")
+            fetches.append((obj, self.executor.submit(obj.query_endpoint) if self.executor else None))
+        for obj, fetch in fetches:
+            try:
+                readings.extend(obj.parse(fetch.result() if fetch else obj.query_endpoint()))
+            except Exception as e:
+                logger.error(f"Failed to poll {obj.name}: {e}")
+                obj.breaker.failed()
+                self._fell_through.add(obj)
+
+        return readings
+
+    # A list mixes whatever its Readings are, always keep them in order
+    coalescable = False
+
+    def run(self) -> None:
+        self.process_response(self.query_endpoint())
+
+    def allow(self) -> bool:
+        # Only endpoints with closed breakers get batched
+        return True
+
+    probing = False
+
+    def record(self, ok: bool) -> None:
+        """
+        Count the poll against every endpoint in the list, bar any that
+        already failed on their own
+
+        Returns: None
+        """
+        for obj in self.endpoints:
+            if obj in self._fell_through:
+                continue
+            obj.breaker.succeeded() if ok else obj.breaker.failed()
@@ -1,21 +1,42 @@
 import os
 import ssl
 import yaml
+import socket
+import threading
 import json
 import requests
 import logging
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
-from time import sleep
+from time import sleep, monotonic, time
 from typing import Tuple
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError as FutureTimeout
 from packaging.version import Version
 from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.exceptions import EmptyPoolError, ClosedPoolError
 from requests.adapters import HTTPAdapter
 from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
 
 # Local imports
-from xcelEndpoint import xcelEndpoint
+from xcelEndpoint import xcelEndpoint, xcelReadingList, TagPlan, TTL_MARGIN
+from xcelAggregate import xcelAggregator
+from xcelScheduler import xcelScheduler
+from xcelSpool import xcelSpool
+from xcelRecorder import xcelRecorder
+from xcelSinks import build_sinks, xcelMqttSink
+from xcelBreaker import CLOSED, OPEN
+from xcelNotify import xcelNotifier, xcelSubscriptions, peer_certificate, certificate_lfdi
+from xcelPipeline import xcelPipeline
+from xcelMetrics import metrics
+from xcelProfiler import profiler
+from xcelMqtt import xcelMqttClient
+from xcelTransport import xcelTransport
+from xcelDiscovery import xcelDiscovery
+from xcelCrawler import xcelCrawler
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 
 IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
 # Stuffing the IEEE spec here for reference
@@ -33,29 +54,127 @@ logger = logging.getLogger(__name__)
 # import http.client
 # http.client.HTTPConnection.debuglevel = 1
 
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    SSLContext that offers the last TLS session negotiated with the meter
+    on every new connection, so a reconnect can skip the meter's slow
+    CCM8 handshake, and tells its adapter how each connection was set up.
+    """
+    adapter = None
+    tls_session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if not kwargs.get('server_side') and kwargs.get('session') is None:
+            kwargs['session'] = self.tls_session
+        ssl_sock = super().wrap_socket(sock, *args, **kwargs)
+        # Only meaningful once the handshake has happened, which urllib3 does on wrap
+        if ssl_sock.session is not None:
+            self.tls_session = ssl_sock.session
+            if self.adapter is not None:
+                self.adapter._record_connection(ssl_sock.session_reused)
+
+        return ssl_sock
+
 # Create an adapter for our request to enable the non-standard cipher
 # From https://lukasa.co.uk/2017/02/Configuring_TLS_With_Requests/
 class CCM8Adapter(HTTPAdapter):
     """
     A TransportAdapter that re-enables ECDHE support in Requests.
     Not really sure how much redundancy is actually required here
+
+    Connections are kept alive as long as the meter allows. Reconnects
+    resume the previous TLS session, and with keep_warm set a background
+    thread re-establishes a dropped connection every keep_warm seconds
+    so the next poll doesn't pay for it.
     """
-    def __init__(self, cert_file=None, key_file=None, *args, **kwargs):
+    def __init__(self, cert_file=None, key_file=None, *args, keep_warm: float = 0, **kwargs):
         self.cert_file = cert_file
         self.key_file = key_file
+        self.keep_warm = keep_warm
+        # Tally of requests sent vs the connections it took to send them
+        self._stats = {'requests': 0, 'handshakes': 0, 'resumptions': 0, 'reused': 0}
+        self._stats_lock = threading.Lock()
+        # Flags whether the request being sent on this thread had to connect
+        self._local = threading.local()
+        self._closed = threading.Event()
         super(CCM8Adapter, self).__init__(*args, **kwargs)
+        if self.keep_warm > 0:
+            threading.Thread(target=self._keep_warm_loop, name='meter_keep_warm',
+                             daemon=True).start()
 
     def init_poolmanager(self, *args, **kwargs):
         kwargs['ssl_context'] = self.create_ssl_context()
+        # Have the OS probe idle connections rather than letting them silently die
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
         return super(CCM8Adapter, self).init_poolmanager(*args, **kwargs)
 
     def proxy_manager_for(self, *args, **kwargs):
         kwargs['ssl_context'] = self.create_ssl_context()
         return super(CCM8Adapter, self).proxy_manager_for(*args, **kwargs)
 
+    def send(self, *args, **kwargs):
+        self._local.connected = False
+        try:
+            return super(CCM8Adapter, self).send(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self._stats['requests'] += 1
+                if not self._local.connected:
+                    self._stats['reused'] += 1
+
+    def close(self):
+        self._closed.set()
+        super(CCM8Adapter, self).close()
+
+    def _record_connection(self, resumed: bool) -> None:
+        self._local.connected = True
+        with self._stats_lock:
+            self._stats['resumptions' if resumed else 'handshakes'] += 1
+        logger.debug(f"New meter connection, TLS session {'resumed' if resumed else 'full handshake'}")
+
+    def connection_stats(self) -> dict:
+        """
+        Returns: dict, {'requests': #, 'handshakes': #, 'resumptions': #, 'reused': #}
+        where reused is the # of requests sent on an already open connection
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _keep_warm_loop(self) -> None:
+        """
+        Every keep_warm seconds look at the most recently used connection
+        in each pool and reconnect it if the meter dropped it.
+        """
+        while not self._closed.wait(self.keep_warm):
+            pools = self.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    self._warm_pool(pool)
+
+    @staticmethod
+    def _warm_pool(pool) -> None:
+        try:
+            # Never wait, if every connection is busy there's nothing to warm
+            conn = pool._get_conn(timeout=0)
+        except (EmptyPoolError, ClosedPoolError):
+            return
+        try:
+            # urllib3 closes dropped connections on the way out of the pool
+            if conn.sock is None:
+                logger.debug(f"Re-establishing dropped connection to {pool.host}")
+                conn.connect()
+        except Exception as e:
+            logger.debug(f"Failed to re-establish connection to {pool.host}: {e}")
+            conn.close()
+        finally:
+            pool._put_conn(conn)
+
     def create_ssl_context(self):
         # Create SSL context with TLSv1.2
-        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+        context = ResumingSSLContext(ssl.PROTOCOL_TLSv1_2)
+        context.adapter = self
 
         # Disable hostname checking and set verify mode
         context.check_hostname = False
@@ -97,20 +216,74 @@ class CCM8Adapter(HTTPAdapter):
 
         return context
 
+    @staticmethod
+    def create_server_ssl_context(cert_file: str, key_file: str) -> ssl.SSLContext:
+        """
+        The server side of create_ssl_context, for connections the meter
+        makes to us (see xcelNotifier). Same TLSv1.2 CCM8 setup, but the
+        meter has to present a client certificate. Nothing is trusted
+        until each meter's own certificate is pinned with
+        xcelNotifier.trust, which the partial chain flag lets stand in
+        for the CA that issued it.
+
+        Returns: ssl.SSLContext
+        """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN
+        context.set_ciphers(CIPHERS)
+        context.options |= ssl.OP_NO_COMPRESSION
+        context.load_cert_chain(cert_file, key_file)
+
+        return context
+
 class xcelMeter():
-    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str]):
+    """
+    A single meter and all of its endpoints. Several meters can share
+    one process by passing in the same mqtt_client and scheduler, their
+    topics then get namespaced by meter name (see run_meters).
+    """
+    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str],
+                 mqtt_client: mqtt.Client = None, scheduler: xcelScheduler = None,
+                 spool: xcelSpool = None, notifier: xcelNotifier = None,
+                 expected_lfdi: str = None, recorder: xcelRecorder = None, sinks: list = None):
         self.name = name
+        self.ip_address = ip_address
+        self.port = port
+        # Polling and pushed notifications don't process readings at the same time
+        self._lock = threading.Lock()
+        # Default polling interval for endpoints that don't set their own
         self.POLLING_RATE = 5.0
         # Base URL used to query the meter
         self.url = f'https://{ip_address}:{port}'
 
-        # Setup the MQTT server connection
-        self.mqtt_server_address = os.getenv('MQTT_SERVER')
-        self.mqtt_port = self.get_mqtt_port()
-        self.mqtt_client = self._setup_mqtt(self.mqtt_server_address, self.mqtt_port)
-
+        # Number of requests allowed in flight to the meter at once. The meter's
+        # HAN interface is fragile so this defaults to one at a time
+        self.concurrency = max(1, int(os.getenv('METER_CONCURRENCY', '1')))
+        # Most seconds a sweep may spend on the meter before the rest of it is skipped
+        self.sweep_budget = float(os.getenv('METER_SWEEP_BUDGET', '30'))
+        # Fetch Readings that share a ReadingList with one request per list
+        self.batch_reads = os.getenv('METER_BATCH_READS', '').lower() in ('1', 'true', 'yes')
+        # Parse and publish readings on threads of their own, see xcelPipeline
+        self.pipeline = None
+        if os.getenv('METER_PIPELINE', '').lower() in ('1', 'true', 'yes'):
+            self.pipeline = xcelPipeline(name, int(os.getenv('METER_PIPELINE_DEPTH', '64')))
+        # Every request to the meter goes through here. The pipeline's parse thread
+        # can fetch too (see xcelReadingList) so it needs one even at concurrency 1
+        self._executor = None
+        if self.concurrency > 1 or self.pipeline is not None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency,
+                                                thread_name_prefix='meter_fetch')
+        # Seconds between checks that the meter connection is still up, 0 to disable
+        keep_warm = float(os.getenv('METER_KEEP_WARM', '10'))
         # Create a new requests session based on the passed in ip address and port #
-        self.requests_session = self._setup_session(creds, ip_address)
+        self.requests_session = self._setup_session(creds, ip_address, self.concurrency, keep_warm)
+        # METER_TRANSPORT=lean polls over xcelTransport rather than the requests session
+        self.transport = None
+        if os.getenv('METER_TRANSPORT', 'requests').lower() == 'lean':
+            self.transport = self._setup_transport(self.requests_session, self.url, self.concurrency)
 
         # Set to uninitialized
         self.initalized = False
@@ -118,11 +291,41 @@ class xcelMeter():
         hw_info_names = ['lFDI', 'swVer', 'mfID']
         # Endpoint of the meter used for HW info
         hw_info_url = '/sdev/sdi'
-        # Query the meter to get some more details about it
-        details_dict = self._get_hardware_details(hw_info_url, hw_info_names)
+        # Query the meter to get some more details about it. An address
+        # remembered from last time only gets the one try, and has to
+        # still be the same meter
+        if expected_lfdi:
+            try:
+                details_dict = self._read_hardware_details(hw_info_url, hw_info_names)
+                if details_dict['lFDI'] != expected_lfdi:
+                    raise ValueError(f"Meter at {self.url} is {details_dict['lFDI']}, expected {expected_lfdi}")
+            except Exception:
+                # Don't leave the keep warm thread behind
+                self.requests_session.close()
+                if self.transport is not None:
+                    self.transport.close()
+                raise
+        else:
+            details_dict = self._get_hardware_details(hw_info_url, hw_info_names)
+        self.hardware_details = details_dict
         self._mfid = details_dict['mfID']
         self._lfdi = details_dict['lFDI']
         self._swVer = details_dict['swVer']
+        # Setup the MQTT server connection, unless we were handed a shared one
+        self.mqtt_server_address = os.getenv('MQTT_SERVER')
+        self.mqtt_port = self.get_mqtt_port()
+        self._shared = mqtt_client is not None
+        self.mqtt_client = mqtt_client or self._setup_mqtt(self.mqtt_server_address, self.mqtt_port)
+        # Optional on-disk spool for readings published while the broker is down
+        self.spool = spool if self._shared else self._setup_spool(self.mqtt_client)
+        # Optional local history of every reading, see xcelRecorder
+        self.recorder = recorder if self._shared else self._setup_recorder()
+        # Where readings go, MQTT and whatever else, see xcelSinks
+        if self._shared:
+            self.sinks = sinks if sinks is not None else [xcelMqttSink()]
+        else:
+            self.sinks = self._setup_sinks()
+
         # Device info used for home assistant MQTT discovery
         self.device_info = {
                             "device": {
@@ -134,18 +337,44 @@ class xcelMeter():
                             }
         # Send homeassistant a new device config for the meter
         self._send_mqtt_config()
-        # The swVer will dictate which version of endpoints we use
-        supported_endpoint_versions = self._identify_config_version_support('configs/')
-        endpoints_file_ver = self._select_endpoint_version(supported_endpoint_versions, self._swVer)
+        # The swVer will dictate which version of endpoints we use, unless the meter gets crawled
+        self.endpoints_file = self._select_endpoints_file()
         # List to store our endpoint objects in
-        self.endpoints_list = self._load_endpoints(f'configs/endpoints_{endpoints_file_ver}.yaml')
+        self._config_stamp = self._file_stamp(self.endpoints_file)
+        self.endpoints_list = self._load_endpoints(self.endpoints_file)
+        # Seconds between checks of the endpoints.yaml for changes, 0 to disable
+        self.config_reload = float(os.getenv('METER_CONFIG_RELOAD', '10'))
+        self._config_due = monotonic() + self.config_reload
+        # ttl for endpoints that don't set their own, see xcelEndpoint._parse_ttl
+        self.default_ttl = os.getenv('METER_TTL') or None
+        # Each endpoint gets polled on its own interval
+        self.scheduler = scheduler or xcelScheduler()
+        # Only send homeassistant the discovery configs that changed, see xcelDiscovery
+        self.discovery = self._setup_discovery(self.mqtt_client, self.name)
         # create endpoints from list
         self.endpoints = self._create_endpoints(self.endpoints_list, self.device_info)
+        if self.discovery is not None:
+            self.discovery.sync()
+        # Have the meter push readings where it will, see xcelNotify
+        if not self._shared:
+            notifier = self._setup_notifier(creds)
+        self.subscriptions = self._setup_subscriptions(notifier) if notifier else None
+        # Instrumentation, see xcelMetrics
+        self._last_poll = {}
+        metrics.add_collector(self._collect_metrics)
+        profiler.add_probe(self._profile_probe)
+        # Seconds between publishing diagnostic sensors to homeassistant, 0 to disable
+        self.diagnostics_rate = float(os.getenv('MQTT_DIAGNOSTICS', '0'))
+        self._diagnostics_due = monotonic() + self.diagnostics_rate
+        self._diagnostics_configured = False
+        # Histogram (count, sum) as of the last diagnostics publish
+        self._diagnostics_prev = {}
         # ready to go
         self.initalized = True
 
     @staticmethod
-    def _select_endpoint_version(supported_endpoint_versions: list, meter_sw_version: str) -> str:
+    def _select_endpoint_version(supported_endpoint_versions: list, meter_sw_version: str,
+                                 fallback: bool = True) -> str | None:
 
         # Sort the versions lowest to highest
         supported_versions_sorted =  sorted(supported_endpoint_versions)
@@ -162,6 +391,9 @@ class xcelMeter():
                 continue
             if meter_sw_version >= version:
                 selected_version = version
+        if selected_version is None and not fallback:
+            logger.warning(f'No endpoints config matches meter version: {meter_sw_version}')
+            return None
         # Looks like we don't support a version this low, default to lowest supported?
         if selected_version is None:
             selected_version = supported_versions_sorted[0]
@@ -170,6 +402,57 @@ class xcelMeter():
         config_version_path = str(selected_version).replace('.', '_')
         return config_version_path
 
+    def _select_endpoints_file(self) -> str:
+        """
+        Picks the shipped endpoints yaml for the meter's firmware. With
+        METER_CRAWL=auto a meter no shipped config matches is crawled
+        instead, with METER_CRAWL=always every meter is.
+
+        Returns: str, path of the endpoints yaml to use
+        """
+        crawl = os.getenv('METER_CRAWL', '').lower()
+        supported_endpoint_versions = self._identify_config_version_support('configs/')
+        endpoints_file_ver = self._select_endpoint_version(supported_endpoint_versions, self._swVer,
+                                                           fallback=crawl != 'auto')
+        if crawl == 'always' or endpoints_file_ver is None:
+            crawled = self._crawl_endpoints()
+            if crawled is not None:
+                return crawled
+            endpoints_file_ver = self._select_endpoint_version(supported_endpoint_versions, self._swVer)
+
+        return f'configs/endpoints_{endpoints_file_ver}.yaml'
+
+    def _crawl_endpoints(self) -> str | None:
+        """
+        Crawl the meter for its endpoints (see xcelCrawler), or use the
+        crawl from a previous start if this lFDI and swVer have been
+        crawled before
+
+        Returns: str, path of the crawled endpoints yaml, None if crawling failed
+        """
+        cache_dir = os.getenv('METER_CRAWL_CACHE', 'certs/crawled')
+        path = xcelCrawler.cache_path(cache_dir, self._lfdi, self._swVer)
+        if path.is_file():
+            logger.info(f"Using the endpoints crawled from this meter before, {path}")
+            return str(path)
+        logger.info(f"Crawling meter {self.name} for its endpoints")
+        try:
+            endpoints = xcelCrawler(self.requests_session, self.url).crawl()
+        except Exception as e:
+            logger.error(f"Crawling the meter failed, falling back to the shipped configs: {e}")
+            return None
+        problems = self._validate_endpoints(endpoints)
+        if problems:
+            logger.error(f"Crawled endpoints aren't usable, falling back to the shipped configs: {problems}")
+            return None
+        try:
+            xcelCrawler.save(path, endpoints, f'meter {self._lfdi} running {self._swVer}')
+        except OSError as e:
+            logger.error(f"Could not write crawled endpoints to {path}, falling back to the shipped configs: {e}")
+            return None
+
+        return str(path)
+
     @staticmethod
     def _identify_config_version_support(config_path: str) -> list[Version]:
         """
@@ -188,10 +471,14 @@ class xcelMeter():
         return supported_endpoint_versions
 
     @staticmethod
-    def _setup_session(creds: tuple, ip_address: str) -> requests.Session:
+    def _setup_session(creds: tuple, ip_address: str, pool_size: int = 1,
+                       keep_warm: float = 0) -> requests.Session:
         """
         Creates a new requests session with the given credentials pointed
         at the give IP address. Will be shared across each xcelQuery object.
+        The connection pool holds `pool_size` connections to the meter and
+        blocks rather than opening any extra ones. See CCM8Adapter for
+        keep_warm.
 
         Returns: request.session
         """
@@ -200,10 +487,27 @@ class xcelMeter():
         # Mount our adapter to the domain, passing the client cert/key
         # creds is a tuple of (cert_file, key_file)
         cert_file, key_file = creds
-        session.mount(f'https://{ip_address}', CCM8Adapter(cert_file=cert_file, key_file=key_file))
+        adapter = CCM8Adapter(cert_file=cert_file, key_file=key_file, pool_connections=1,
+                              pool_maxsize=pool_size, pool_block=True, keep_warm=keep_warm)
+        session.mount(f'https://{ip_address}', adapter)
 
         return session
 
+    @staticmethod
+    def _setup_transport(session: requests.Session, url: str, pool_size: int = 1) -> xcelTransport:
+        """
+        Creates the lean transport to poll with, using the same TLS setup
+        as the session's CCM8Adapter
+
+        Returns: xcelTransport
+        """
+        context = session.get_adapter(url).create_ssl_context()
+        transport = xcelTransport(context, pool_size)
+        # Count its connections rather than the adapter's
+        context.adapter = transport
+
+        return transport
+
     @staticmethod
     def _load_endpoints(file_path: str) -> list:
         """
@@ -216,17 +520,228 @@ class xcelMeter():
 
         return endpoints
 
-    def _create_endpoints(self, endpoints: dict, device_info: dict) -> None:
-        # Build query objects for each endpoint
+    def _create_endpoints(self, endpoints: dict, device_info: dict) -> list:
+        """
+        Build query objects for each endpoint and add them to the
+        scheduler using the optional interval, align and jitter keys
+        from the endpoints.yaml
+
+        Returns: list of xcelEndpoint
+        """
         query_obj = []
         for point in endpoints:
             for endpoint_name, v in point.items():
-                request_url = f'{self.url}{v["url"]}'
-                query_obj.append(xcelEndpoint(self.requests_session, self.mqtt_client,
-                                    request_url, endpoint_name, v['tags'], device_info))
+                query_obj.append(self._create_endpoint(endpoint_name, v, device_info))
 
         return query_obj
 
+    def _create_endpoint(self, endpoint_name: str, v: dict, device_info: dict) -> xcelEndpoint:
+        """
+        Build and schedule the query object of a single endpoint
+
+        Returns: xcelEndpoint
+        """
+        request_url = f'{self.url}{v["url"]}'
+        # Meters sharing a broker need their own topics
+        namespace = self.name if self._shared else None
+        endpoint = xcelEndpoint(self.requests_session, self.mqtt_client,
+                            request_url, endpoint_name, v['tags'], device_info,
+                            topic_namespace=namespace, spool=self.spool,
+                            recorder=self.recorder, transport=self.transport,
+                            discovery=self.discovery, ttl=v.get('ttl', self.default_ttl),
+                            sinks=self.sinks)
+        self._schedule(endpoint, v)
+
+        return endpoint
+
+    def _schedule(self, endpoint: xcelEndpoint, v: dict) -> None:
+        self.scheduler.add(endpoint, float(v.get('interval', self.POLLING_RATE)),
+                           align=v.get('align', False),
+                           jitter=float(v.get('jitter', 0.0)),
+                           name=f'{self.name} {endpoint.name}' if self._shared else endpoint.name,
+                           group=self)
+
+    @staticmethod
+    def _file_stamp(file_path: str) -> tuple | None:
+        """
+        Returns: tuple of the file's modification time and size, None if it's gone
+        """
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _validate_endpoints(endpoints) -> list:
+        """
+        Check a loaded endpoints.yaml has everything _create_endpoints
+        needs, before any of it is used
+
+        Returns: list of str, each problem found, empty if there are none
+        """
+        if not isinstance(endpoints, list) or not endpoints:
+            return ['expected a list of endpoints']
+        problems = []
+        names = set()
+        for i, point in enumerate(endpoints, 1):
+            if not isinstance(point, dict) or len(point) != 1:
+                problems.append(f'entry {i}: expected a single "<name>: {{url, tags}}" mapping')
+                continue
+            (name, v), = point.items()
+            if name in names:
+                problems.append(f'{name}: listed more than once')
+            names.add(name)
+            if not isinstance(v, dict):
+                problems.append(f'{name}: expected url and tags')
+                continue
+            if not isinstance(v.get('url'), str) or not v['url'].startswith('/'):
+                problems.append(f'{name}: url must be a path, ie. /upt/1/mr/1/r')
+            try:
+                if float(v.get('interval', 1)) <= 0:
+                    problems.append(f'{name}: interval must be more than 0')
+            except (TypeError, ValueError):
+                problems.append(f'{name}: interval must be a number of seconds')
+            try:
+                if float(v.get('jitter', 0)) < 0:
+                    problems.append(f'{name}: jitter can\'t be negative')
+            except (TypeError, ValueError):
+                problems.append(f'{name}: jitter must be a number of seconds')
+            if not isinstance(v.get('align', False), bool):
+                problems.append(f'{name}: align must be true or false')
+            try:
+                xcelEndpoint._parse_ttl(v.get('ttl'))
+            except (TypeError, ValueError) as e:
+                problems.append(f'{name}: {e}')
+            tags = v.get('tags')
+            if not isinstance(tags, dict) or not tags:
+                problems.append(f'{name}: no tags')
+                continue
+            for tag, details in tags.items():
+                sensors = details if isinstance(details, list) else [{'': details}]
+                for item in sensors:
+                    if not isinstance(item, dict):
+                        problems.append(f'{name}: {tag} expected a mapping of sensors')
+                        continue
+                    for sensor, sensor_details in item.items():
+                        sensor_name = f'{tag}{sensor}'
+                        if not isinstance(sensor_details, dict) or 'entity_type' not in sensor_details:
+                            problems.append(f'{name}: {sensor_name} has no entity_type')
+                            continue
+                        try:
+                            xcelEndpoint._parse_deadband(sensor_details.get('deadband'))
+                            float(sensor_details.get('heartbeat', 0))
+                            if 'aggregate' in sensor_details:
+                                xcelAggregator(sensor_name, sensor_details['aggregate'])
+                        except (TypeError, ValueError, AttributeError) as e:
+                            problems.append(f'{name}: {sensor_name} {e}')
+            try:
+                TagPlan(tags)
+            except Exception as e:
+                problems.append(f'{name}: {e}')
+
+        return problems
+
+    def reload_endpoints(self) -> bool:
+        """
+        Re-read the endpoints.yaml and apply what changed: new endpoints
+        are added, removed ones are dropped (along with their sensors in
+        homeassistant), ones with a new url or tags are rebuilt and ones
+        with only a new interval, align or jitter are rescheduled. The
+        meter session and MQTT client carry on as they are. A config that
+        doesn't validate is logged and the running one kept.
+
+        Returns: bool, whether the new config was applied
+        """
+        try:
+            endpoints = self._load_endpoints(self.endpoints_file)
+        except (OSError, yaml.YAMLError) as e:
+            problems = [str(e)]
+        else:
+            problems = self._validate_endpoints(endpoints)
+        if problems:
+            logger.error(f"Rejected changes to {self.endpoints_file}, keeping the running config:")
+            for problem in problems:
+                logger.error(f"  {problem}")
+            metrics.inc('xcel_config_reloads_total', outcome='rejected', meter=self.name)
+            return False
+
+        schedule_keys = ('interval', 'align', 'jitter')
+        def strip(v: dict) -> dict:
+            return {key: value for key, value in v.items() if key not in schedule_keys}
+        old = {name: v for point in self.endpoints_list for name, v in point.items()}
+        new = {name: v for point in endpoints for name, v in point.items()}
+        by_name = {obj.name: obj for obj in self.endpoints}
+        added, changed, removed, rescheduled = [], [], [], []
+        # (endpoint, replacement) pairs, cleaned up after the lock is let go
+        dropped = []
+        with self._lock:
+            for name, v in new.items():
+                if name not in old:
+                    added.append(self._create_endpoint(name, v, self.device_info))
+                elif strip(v) != strip(old[name]):
+                    replacement = self._create_endpoint(name, v, self.device_info)
+                    self._drop_endpoint(by_name[name])
+                    dropped.append((by_name[name], replacement))
+                    changed.append(replacement)
+                elif v != old[name]:
+                    self.scheduler.remove(by_name[name])
+                    self._schedule(by_name[name], v)
+                    rescheduled.append(by_name[name])
+            for name in old.keys() - new.keys():
+                self._drop_endpoint(by_name[name])
+                dropped.append((by_name[name], None))
+                removed.append(by_name[name])
+            fresh = {obj.name: obj for obj in added + changed}
+            self.endpoints = [fresh.get(name) or by_name[name] for name in new]
+            self.endpoints_list = endpoints
+        # Cancelling subscriptions and clearing sensors waits on the meter
+        # and broker, polling carries on meanwhile
+        if self.subscriptions is not None and dropped:
+            self.subscriptions.unsubscribe([endpoint for endpoint, _ in dropped])
+        for endpoint, replacement in dropped:
+            self._detach_endpoint(endpoint, replacement)
+        if self.discovery is not None:
+            self.discovery.sync()
+        if self.subscriptions is not None and (added or changed):
+            self._subscribe(self.subscriptions, added + changed)
+        logger.info(f"Reloaded {self.endpoints_file}: {len(added)} added, {len(changed)} changed, "
+                    f"{len(removed)} removed, {len(rescheduled)} rescheduled")
+        metrics.inc('xcel_config_reloads_total', outcome='applied', meter=self.name)
+        # New endpoints need their diagnostic sensors configured too
+        self._diagnostics_configured = False
+
+        return True
+
+    def _drop_endpoint(self, endpoint: xcelEndpoint) -> None:
+        """
+        Stop polling an endpoint, called holding the lock
+
+        Returns: None
+        """
+        self.scheduler.remove(endpoint)
+        self._last_poll.pop(endpoint, None)
+        if self.subscriptions is not None:
+            self._poll_intervals.pop(endpoint, None)
+
+    def _detach_endpoint(self, endpoint: xcelEndpoint, replacement: xcelEndpoint = None) -> None:
+        """
+        Take whichever of a dropped endpoint's sensors the replacement
+        (if any) doesn't have out of homeassistant
+
+        Returns: None
+        """
+        if self.discovery is not None:
+            # The replacement has already planned its configs under the same key
+            if replacement is None:
+                self.discovery.remove(endpoint._mqtt_friendly_name)
+        else:
+            keep = replacement.discovery_configs if replacement is not None else {}
+            for topic in endpoint.discovery_configs.keys() - keep.keys():
+                endpoint._mqtt_publish(topic, b'', retain=True)
+        if replacement is None:
+            endpoint._mqtt_publish(endpoint._availability_topic, b'', retain=True)
+
     @staticmethod
     def get_mqtt_port() -> int:
         """
@@ -250,17 +765,21 @@ class xcelMeter():
 
         Returns: mqtt.Client object
         """
-        def on_connect(client, userdata, flags, rc):
+        def on_connect(client, userdata, flags, rc, properties=None):
             if rc == 0:
                 logging.info("Connected to MQTT Broker!")
+                client.connected(properties)
             else:
-                logging.error("Failed to connect, return code %d\n", rc)
+                logging.error("Failed to connect, return code %s\n", rc)
 
         # Check if a username/PW is setup for the MQTT connection
         mqtt_username = os.getenv('MQTT_USER')
         mqtt_password = os.getenv('MQTT_PASSWORD')
-        # If no env variable was set, skip setting creds?
-        client = mqtt.Client()
+        # MQTT v5 gets topic aliases for the state topics, see xcelMqtt
+        v5 = os.getenv('MQTT_VERSION', '3.1.1') == '5'
+        # Most publishes waiting to be sent or acked before publishing blocks, 0 for no limit
+        window = int(os.getenv('MQTT_INFLIGHT', '20' if v5 else '0'))
+        client = xcelMqttClient(protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311, window=window)
         if mqtt_username and mqtt_password:
             client.username_pw_set(mqtt_username, mqtt_password)
         client.on_connect = on_connect
@@ -268,11 +787,153 @@ class xcelMeter():
         logging.info(f"MQTT_ADDRESS: {mqtt_server_address}")
         logging.info(f"MQTT_PORT: {mqtt_port}")
         logging.info(f"MQTT_USER: {mqtt_username}")
-        client.connect(mqtt_server_address, mqtt_port)
+        properties = None
+        if v5:
+            # How many QoS 1/2 messages the broker may have in flight to us at once
+            properties = Properties(PacketTypes.CONNECT)
+            properties.ReceiveMaximum = int(os.getenv('MQTT_RECEIVE_MAXIMUM', str(window or 20)))
+        client.connect(mqtt_server_address, mqtt_port, properties=properties)
         client.loop_start()
 
         return client
 
+    @staticmethod
+    def _setup_spool(client: mqtt.Client) -> xcelSpool | None:
+        """
+        Opens the store-and-forward spool if MQTT_SPOOL points at a
+        file for it to live in.
+
+        Returns: xcelSpool object, or None if spooling is disabled
+        """
+        spool_path = os.getenv('MQTT_SPOOL')
+        if not spool_path:
+            return None
+        max_rows = int(os.getenv('MQTT_SPOOL_MAX', '100000'))
+        rate = float(os.getenv('MQTT_SPOOL_RATE', '50'))
+        logging.info(f"Spooling unpublished readings to {spool_path}")
+
+        return xcelSpool(spool_path, client, max_rows, rate)
+
+    @staticmethod
+    def _setup_discovery(client: mqtt.Client, name: str) -> xcelDiscovery | None:
+        """
+        Compares discovery configs against what the broker already has
+        if MQTT_DISCOVERY_CACHE is set
+
+        Returns: xcelDiscovery object, or None to send every config as before
+        """
+        cache_path = os.getenv('MQTT_DISCOVERY_CACHE')
+        if not cache_path:
+            return None
+
+        return xcelDiscovery(client, name, cache_path,
+                             timeout=float(os.getenv('MQTT_DISCOVERY_TIMEOUT', '5')))
+
+    @staticmethod
+    def _setup_recorder() -> xcelRecorder | None:
+        """
+        Starts recording readings if METER_RECORDER points at a
+        directory to keep them in.
+
+        Returns: xcelRecorder object, or None if recording is disabled
+        """
+        root = os.getenv('METER_RECORDER')
+        if not root:
+            return None
+        retention = float(os.getenv('METER_RECORDER_RETENTION', '30'))
+        logging.info(f"Recording readings to {root}, keeping {retention:g} days")
+
+        return xcelRecorder(root, retention)
+
+    @staticmethod
+    def _setup_sinks() -> list:
+        """
+        Starts the sinks METER_SINKS lists, just MQTT if it's not set
+
+        Returns: list of xcelSink objects
+        """
+        sinks = build_sinks(os.getenv('METER_SINKS') or 'mqtt', token=os.getenv('METER_SINK_TOKEN'),
+                            batch_size=int(os.getenv('METER_SINK_BATCH', '500')),
+                            flush_interval=float(os.getenv('METER_SINK_FLUSH', '10')),
+                            queue_size=int(os.getenv('METER_SINK_QUEUE', '10000')))
+        if not any(isinstance(sink, xcelMqttSink) for sink in sinks):
+            logging.warning("METER_SINKS has no mqtt, nothing will be published to homeassistant")
+        logging.info(f"Sending readings to {', '.join(sink.name for sink in sinks)}")
+
+        return sinks
+
+    @staticmethod
+    def _setup_notifier(creds: tuple) -> xcelNotifier | None:
+        """
+        Starts listening for meter notifications if METER_PUSH_PORT is set
+
+        Returns: xcelNotifier object, or None if push mode is disabled
+        """
+        push_port = os.getenv('METER_PUSH_PORT')
+        if not push_port:
+            return None
+        context = CCM8Adapter.create_server_ssl_context(*creds)
+
+        return xcelNotifier(context, int(push_port), public_host=os.getenv('METER_PUSH_HOST'))
+
+    def _setup_subscriptions(self, notifier: xcelNotifier) -> xcelSubscriptions:
+        """
+        Subscribe to every endpoint the meter will push to us. Those
+        are then only polled every METER_PUSH_POLL seconds as a safety
+        net, the rest carry on being polled as normal. The meter's
+        certificate is pinned with the notifier first, notifications are
+        only taken from a peer presenting it.
+
+        Returns: xcelSubscriptions object, or None if the meter's certificate couldn't be pinned
+        """
+        try:
+            context = self.requests_session.get_adapter(self.url).create_ssl_context()
+            certificate = peer_certificate(context, self.ip_address, int(self.port))
+        except (OSError, ssl.SSLError) as e:
+            logger.warning(f"Couldn't read {self.name}'s certificate ({e}), polling every endpoint")
+            return None
+        if certificate_lfdi(certificate) != self._lfdi.upper():
+            logger.warning(f"{self.name}'s certificate is for lFDI {certificate_lfdi(certificate)}, "
+                           f"not {self._lfdi}, polling every endpoint")
+            return None
+        notifier.trust(certificate)
+        subscriptions = xcelSubscriptions(self.requests_session, self.url, notifier,
+                                          f'/notify/{self._lfdi}',
+                                          os.getenv('METER_PUSH_SUBSCRIPTIONS', '/edev/0/sub'),
+                                          self._on_notification,
+                                          float(os.getenv('METER_PUSH_RENEW', '3600')),
+                                          lfdi=self._lfdi)
+        # Intervals to go back to if a subscription lapses
+        self._poll_intervals = {}
+        self._subscribe(subscriptions, self.endpoints)
+
+        return subscriptions
+
+    def _subscribe(self, subscriptions: xcelSubscriptions, endpoints: list) -> None:
+        safety_interval = float(os.getenv('METER_PUSH_POLL', '300'))
+        for obj in subscriptions.subscribe(endpoints):
+            interval = self.scheduler.stats_for(obj)['interval']
+            self._poll_intervals[obj] = interval
+            self.scheduler.set_interval(obj, max(interval, safety_interval))
+
+    def _on_notification(self, endpoint: xcelEndpoint, body: bytes) -> None:
+        """
+        A reading the meter pushed to us, handled just like a polled one
+
+        Returns: None
+        """
+        if self.pipeline is not None:
+            self.pipeline.submit(endpoint, body)
+            self.pipeline.then(self._publish_pending_state)
+            return
+        with self._lock:
+            endpoint.process_response(body)
+            self._publish_pending_state()
+
+    def _publish_pending_state(self) -> None:
+        if any(obj.state_pending for obj in self.endpoints):
+            self._publish_meter_state()
+
     @retry(stop=stop_after_attempt(5),
            wait=wait_exponential(multiplier=1, min=1, max=15),
            before_sleep=before_sleep_log(logger, logging.WARNING),
@@ -280,7 +941,15 @@ class xcelMeter():
     def _get_hardware_details(self, hw_info_url: str, hw_names: list) -> dict:
         """
         Queries the meter hardware endpoint at the ip address passed
-        to the class.
+        to the class, retrying on failure.
+
+        Returns: dict, {<element name>: <meter response>}
+        """
+        return self._read_hardware_details(hw_info_url, hw_names)
+
+    def _read_hardware_details(self, hw_info_url: str, hw_names: list) -> dict:
+        """
+        A single query of the meter hardware endpoint
 
         Returns: dict, {<element name>: <meter response>}
         """
@@ -302,6 +971,7 @@ class xcelMeter():
             else:
                 logger.error(f"  OP_LEGACY_SERVER_CONNECT: NOT AVAILABLE - this may be the issue!")
             raise
+        x.raise_for_status()
 
         # Parse the response xml looking for the passed in element names
         root = ET.fromstring(x.text)
@@ -339,15 +1009,420 @@ class xcelMeter():
         else:
             logging.error(f"MQTT publish failed with return code: {result.rc}")
 
+    def connection_stats(self) -> dict:
+        """
+        How the requests to the meter got sent, see CCM8Adapter.connection_stats
+
+        Returns: dict
+        """
+        if self.transport is not None:
+            return self.transport.connection_stats()
+        return self.requests_session.get_adapter(self.url).connection_stats()
+
+    def publish_stats(self) -> dict:
+        """
+        Tally of readings published vs held back as unchanged for
+        each endpoint.
+
+        Returns: dict, {endpoint name: {'sent': #, 'suppressed': #}}
+        """
+        return {obj.name: {'sent': obj.sent, 'suppressed': obj.suppressed}
+                for obj in self.endpoints}
+
+    def _collect_metrics(self) -> list:
+        """
+        Gauges read fresh at render time, see xcelMetrics.add_collector
+
+        Returns: list of (name, labels, value)
+        """
+        gauges = []
+        for obj in self.endpoints:
+            labels = {'meter': self.name, 'endpoint': obj.name}
+            schedule = self.scheduler.stats_for(obj)
+            gauges.append(('xcel_poll_interval_configured_seconds', labels, schedule['interval']))
+            gauges.append(('xcel_poll_missed', labels, schedule['missed']))
+            gauges.append(('xcel_readings_sent', labels, obj.sent))
+            gauges.append(('xcel_readings_suppressed', labels, obj.suppressed))
+            gauges.append(('xcel_breaker_open', labels, int(obj.breaker.state == OPEN)))
+        for stat, value in self.connection_stats().items():
+            gauges.append((f'xcel_connection_{stat}', {'meter': self.name}, value))
+        gauges.append(('xcel_mqtt_in_flight', {}, self._mqtt_in_flight()))
+
+        return gauges
+
+    def _mqtt_in_flight(self) -> int:
+        """
+        Messages paho still has queued to send or is waiting on the
+        broker to acknowledge
+
+        Returns: int
+        """
+        return (len(getattr(self.mqtt_client, '_out_messages', ())) +
+                len(getattr(self.mqtt_client, '_out_packet', ())))
+
+    def _profile_probe(self) -> dict:
+        """
+        The queues and pools that could be holding on to memory, for
+        the diagnostics reports (see xcelProfiler)
+
+        Returns: dict
+        """
+        pools = self.requests_session.get_adapter(self.url).poolmanager.pools
+        idle = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None and pool.pool is not None:
+                idle += pool.pool.qsize()
+        probe = {
+            f'{self.name} mqtt_in_flight': self._mqtt_in_flight(),
+            f'{self.name} connection_pools': len(pools),
+            f'{self.name} pooled_connection_slots': idle,
+        }
+        if self.spool is not None:
+            probe[f'{self.name} spool_depth'] = len(self.spool)
+        if self.pipeline is not None:
+            probe[f'{self.name} pipeline_depth'] = self.pipeline.stats()['depth']
+        if self.transport is not None:
+            probe[f'{self.name} lean_idle_connections'] = self.transport.idle_connections()
+        for sink in self.sinks:
+            probe[f'{self.name} sink_{sink.name}_depth'] = sink.depth()
+
+        return probe
+
+    def _window_mean(self, name: str, endpoint: str) -> float | None:
+        """
+        Mean of a histogram since the last diagnostics publish
+
+        Returns: float, or None if nothing was observed
+        """
+        count, total = metrics.histogram(name, meter=self.name, endpoint=endpoint)
+        prev_count, prev_total = self._diagnostics_prev.get((name, endpoint), (0, 0.0))
+        self._diagnostics_prev[(name, endpoint)] = (count, total)
+        if count == prev_count:
+            return None
+        return (total - prev_total) / (count - prev_count)
+
+    def _send_diagnostics(self) -> None:
+        """
+        Publish per endpoint request latency (with retries, failures,
+        parse/publish time and achieved polling interval as attributes)
+        and the MQTT in-flight count as homeassistant diagnostic sensors.
+
+        Returns: None
+        """
+        mqtt_topic_prefix = os.getenv('MQTT_TOPIC_PREFIX', 'homeassistant')
+        base_topic = f'{mqtt_topic_prefix}/sensor/{self.name.replace(" ", "_")}_diagnostics'
+        sensors = []
+        for obj in self.endpoints:
+            schedule = self.scheduler.stats_for(obj)
+            latency = self._window_mean('xcel_request_seconds', obj.name)
+            parse = self._window_mean('xcel_parse_seconds', obj.name)
+            publish = self._window_mean('xcel_publish_seconds', obj.name)
+            interval = self._window_mean('xcel_poll_interval_seconds', obj.name)
+            attributes = {
+                'retries': metrics.counter('xcel_request_retries_total', meter=self.name, endpoint=obj.name),
+                'failures': metrics.counter('xcel_request_failures_total', meter=self.name, endpoint=obj.name),
+                'parse_ms': round(parse * 1000, 3) if parse is not None else None,
+                'publish_ms': round(publish * 1000, 3) if publish is not None else None,
+                'poll_interval_s': round(interval, 3) if interval is not None else None,
+                'configured_interval_s': schedule['interval'],
+                'missed_deadlines': schedule['missed'],
+                'sent': obj.sent,
+                'suppressed': obj.suppressed,
+                'fresh_hits': obj.fresh_hits,
+                'fresh_skipped': obj.fresh_skipped,
+                }
+            value = round(latency * 1000, 1) if latency is not None else None
+            sensors.append((f'{obj.name} Request Latency', 'ms', value, attributes))
+        sensors.append(('MQTT In Flight', None, self._mqtt_in_flight(), None))
+
+        for sensor_name, unit, value, attributes in sensors:
+            topic = f'{base_topic}/{sensor_name.replace(" ", "_")}'
+            if not self._diagnostics_configured:
+                config = {
+                    "name": sensor_name,
+                    "state_topic": f'{topic}/state',
+                    "state_class": "measurement",
+                    "entity_category": "diagnostic",
+                    "unique_id": f'{self._lfdi}_{sensor_name}'.lower().replace(' ', '_'),
+                    }
+                if unit:
+                    config["unit_of_measurement"] = unit
+                if attributes is not None:
+                    config["json_attributes_topic"] = f'{topic}/attributes'
+                config.update(self.device_info)
+                self.mqtt_client.publish(f'{topic}/config', json.dumps(config), retain=True)
+            if value is not None:
+                self.mqtt_client.publish(f'{topic}/state', str(value))
+            if attributes is not None:
+                self.mqtt_client.publish(f'{topic}/attributes', json.dumps(attributes))
+        self._diagnostics_configured = True
+
+    def _publish_meter_state(self) -> None:
+        """
+        MQTT_STATE_JSON=meter, send the latest reading of every endpoint
+        as one JSON document keyed by endpoint then sensor.
+
+        Returns: None
+        """
+        state = {obj._mqtt_friendly_name: obj.state for obj in self.endpoints if obj.state}
+        topic = self.endpoints[0]._state_topic
+        payload = json.dumps(state)
+        if self.spool is not None and len(self.spool):
+            self.spool.put(topic, payload)
+        else:
+            rc = self.mqtt_client.publish(topic, payload).rc
+            metrics.inc('xcel_mqtt_publish_total', rc=rc)
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                if self.spool is None:
+                    logging.error(f"MQTT publish to {topic} failed with return code: {rc}")
+                    return
+                self.spool.put(topic, payload)
+        now = monotonic()
+        for obj in self.endpoints:
+            if obj.state_pending:
+                obj.mark_published(now)
+
+    @staticmethod
+    def _batch(due: list, executor: ThreadPoolExecutor = None) -> list:
+        """
+        Swap due endpoints sharing a ReadingList for a single
+        xcelReadingList fetch, in the place of the first of them.
+        Readings the list leaves out are fetched through the executor.
+
+        Returns: list of xcelEndpoint and xcelReadingList objects
+        """
+        lists = {}
+        for obj in due:
+            list_url = xcelReadingList.list_url(obj.url)
+            # Struggling endpoints are left to their own probes
+            if list_url is not None and obj.breaker.state == CLOSED:
+                lists.setdefault(list_url, []).append(obj)
+        batched = []
+        for obj in due:
+            members = lists.get(xcelReadingList.list_url(obj.url))
+            if members is None or len(members) < 2 or obj not in members:
+                batched.append(obj)
+            elif members[0] is obj:
+                batched.append(xcelReadingList(xcelReadingList.list_url(obj.url), members, executor))
+
+        return batched
+
+    def lfdi_at(self, ip_address: str, port: int) -> str | None:
+        """
+        Ask whatever answers at the address for its lFDI, on a session of
+        its own so the meter's connections are left alone
+
+        Returns: str, or None if it couldn't be read
+        """
+        return self.read_lfdi(self.requests_session.cert, ip_address, port)
+
+    @staticmethod
+    def read_lfdi(creds: tuple, ip_address: str, port: int) -> str | None:
+        """
+        A single query of the lFDI of the meter at the address
+
+        Returns: str, or None if it couldn't be read
+        """
+        session = xcelMeter._setup_session(creds, ip_address)
+        try:
+            x = session.get(f'https://{ip_address}:{port}/sdev/sdi', verify=False, timeout=4.0)
+            x.raise_for_status()
+            return ET.fromstring(x.text).findtext(f'.//{IEEE_PREFIX}lFDI')
+        except Exception as e:
+            logger.debug(f"Couldn't read the lFDI at {ip_address}:{port}: {e}")
+            return None
+        finally:
+            session.close()
+
+    def set_address(self, ip_address: str, port: int) -> None:
+        """
+        Point every endpoint at the meter's new address (ie. after a
+        DHCP change), keeping the same session and credentials.
+
+        Returns: None
+        """
+        old_url = self.url
+        new_url = f'https://{ip_address}:{port}'
+        if new_url == old_url:
+            return
+        adapter = self.requests_session.get_adapter(old_url)
+        with self._lock:
+            self.requests_session.mount(f'https://{ip_address}', adapter)
+            for obj in self.endpoints:
+                obj.url = new_url + obj.url[len(old_url):]
+            self.url = new_url
+            self.ip_address, self.port = ip_address, port
+        logging.warning(f"Meter {self.name} moved from {old_url} to {new_url}")
+        if self.subscriptions is not None:
+            logging.warning("Subscriptions still point at the old address until they're next renewed")
+
+    def _skip_fresh(self, due: list) -> list:
+        """
+        Leave be the endpoints whose last reading is still within its
+        ttl, their next poll is moved to just after it runs out
+
+        Returns: list, the due endpoints that still need polling
+        """
+        now = time()
+        polling = []
+        for obj in due:
+            remaining = obj.fresh_for(now)
+            if remaining <= 0:
+                polling.append(obj)
+                continue
+            # This poll and every other that would have come due before then
+            skipped = int(remaining // self.scheduler.stats_for(obj)['interval']) + 1
+            obj.skip_fresh(skipped)
+            metrics.inc('xcel_poll_skipped_total', skipped, reason='fresh', **obj._metric_labels)
+            self.scheduler.defer(obj, remaining + TTL_MARGIN)
+
+        return polling
+
+    def poll_due(self, due: list) -> None:
+        """
+        Poll the given endpoints of this meter that the scheduler says
+        are due, and publish diagnostics when those are due too.
+
+        Returns: None
+        """
+        now = monotonic()
+        # Anything dropped by a config reload since the scheduler handed it out
+        due = [obj for obj in due if self.scheduler.group(obj) is self]
+        due = self._skip_fresh(due)
+        for obj in due:
+            if obj in self._last_poll:
+                metrics.observe('xcel_poll_interval_seconds', now - self._last_poll[obj],
+                                meter=self.name, endpoint=obj.name)
+            self._last_poll[obj] = now
+        with self._lock:
+            self.poll_endpoints(self._batch(due, self._executor) if self.batch_reads else due, self._executor,
+                                self.sweep_budget, self.pipeline)
+            if self.pipeline is not None:
+                # The meter's state document goes out once the sweep is published
+                self.pipeline.then(self._publish_pending_state)
+            else:
+                self._publish_pending_state()
+        if self.subscriptions is not None:
+            for obj in self.subscriptions.take_lost():
+                self.scheduler.set_interval(obj, self._poll_intervals[obj])
+        if self.diagnostics_rate > 0 and now >= self._diagnostics_due:
+            self._diagnostics_due = now + self.diagnostics_rate
+            self._send_diagnostics()
+        if self.config_reload > 0 and now >= self._config_due:
+            self._config_due = now + self.config_reload
+            stamp = self._file_stamp(self.endpoints_file)
+            if stamp is not None and stamp != self._config_stamp:
+                self._config_stamp = stamp
+                self.reload_endpoints()
+
     def run(self) -> None:
         """
-        Main business loop. Just repeatedly queries the meter endpoints,
-        parses the results, packages these up into MQTT payloads, and sends
-        them off to the MQTT server
+        Main business loop. Waits for the next endpoints to come due,
+        queries them, parses the results, packages these up into MQTT
+        payloads, and sends them off to the MQTT server
+
+        Returns: None
+        """
+        self.run_meters([self])
+
+    @staticmethod
+    def run_meters(meters: list) -> None:
+        """
+        Business loop for any number of meters sharing a scheduler. The
+        scheduler interleaves due endpoints across meters, each meter
+        gets handed its consecutive run of them to poll.
 
         Returns: None
         """
+        scheduler = meters[0].scheduler
         while True:
-            sleep(self.POLLING_RATE)
-            for obj in self.endpoints:
-                obj.run()
+            due = scheduler.wait_due()
+            if not due:
+                sleep(meters[0].POLLING_RATE)
+            # A no-op unless METER_PROFILE is set
+            with profiler.sweep(due, scheduler):
+                batch, owner = [], None
+                for obj in due:
+                    meter = scheduler.group(obj)
+                    if batch and meter is not owner:
+                        owner.poll_due(batch)
+                        batch = []
+                    owner = meter
+                    batch.append(obj)
+                if batch:
+                    owner.poll_due(batch)
+
+    @staticmethod
+    def poll_endpoints(endpoints: list, executor: ThreadPoolExecutor = None, budget: float = 0,
+                       pipeline: xcelPipeline = None) -> None:
+        """
+        Query each of the given endpoints and publish their readings.
+        With an executor the requests to the meter are spread across its
+        workers, but the responses are still parsed and published one
+        endpoint at a time in the order they came due. With a pipeline
+        the responses are handed to it instead, and it records how each
+        poll went once they're parsed.
+
+        Endpoints whose breaker is open are skipped, ones being probed
+        go last so they can't hold up the healthy ones. A failure is
+        logged and counted against the endpoint's breaker rather than
+        ending the loop. Once `budget` seconds (0 for no limit) have gone
+        by the rest of the sweep is skipped until they're next due. With
+        an executor the queries still queued are cancelled then, and one
+        still waiting on the meter counts as a failure, so a hung resource
+        can't keep the workers from the next sweep.
+
+        Returns: None
+        """
+        started = monotonic()
+        polling = []
+        for obj in endpoints:
+            if obj.allow():
+                polling.append(obj)
+            else:
+                metrics.inc('xcel_poll_skipped_total', reason='open', **obj._metric_labels)
+        polling.sort(key=lambda obj: obj.probing)
+
+        def skip(obj) -> None:
+            logger.warning(f"Sweep over its {budget:.0f}s budget, skipping {obj.name}")
+            metrics.inc('xcel_poll_skipped_total', reason='budget', **obj._metric_labels)
+
+        def over_budget(obj) -> bool:
+            if budget and monotonic() - started > budget:
+                skip(obj)
+                return True
+            return False
+
+        def process(obj, response: str) -> None:
+            if pipeline is not None:
+                pipeline.submit(obj, response)
+                return
+            obj.process_response(response)
+            obj.record(True)
+
+        if executor is None:
+            for obj in polling:
+                if over_budget(obj):
+                    continue
+                try:
+                    process(obj, obj.query_endpoint())
+                except Exception as e:
+                    logger.error(f"Failed to poll {obj.name}: {e}")
+                    obj.record(False)
+            return
+        futures = [executor.submit(obj.query_endpoint) for obj in polling]
+        for obj, future in zip(polling, futures):
+            try:
+                timeout = max(0, budget - (monotonic() - started)) if budget else None
+                process(obj, future.result(timeout=timeout))
+            except (FutureTimeout, CancelledError):
+                # Out of budget, nothing still queued goes to the meter
+                for pending in futures:
+                    pending.cancel()
+                skip(obj)
+                if not future.cancelled():
+                    obj.record(False)
+            except Exception as e:
+                logger.error(f"Failed to poll {obj.name}: {e}")
+                obj.record(False)
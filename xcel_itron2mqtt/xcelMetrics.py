@@ -0,0 +1,211 @@
+import logging
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Shown on the /metrics page next to each metric
+METRIC_HELP = {
+    'xcel_request_seconds': 'HTTP request latency to the meter per endpoint',
+    'xcel_request_errors_total': 'Failed request attempts per endpoint',
+    'xcel_request_retries_total': 'Request retries per endpoint',
+    'xcel_request_failures_total': 'Requests that failed after every retry per endpoint',
+    'xcel_parse_seconds': 'Time spent parsing each endpoint response',
+    'xcel_publish_seconds': 'Time spent publishing each endpoint reading',
+    'xcel_mqtt_publish_total': 'MQTT publishes by return code',
+    'xcel_mqtt_in_flight': 'MQTT messages queued or waiting on the broker',
+    'xcel_mqtt_window_full_total': 'Publishes given up on after waiting for room in the MQTT_INFLIGHT window',
+    'xcel_config_reloads_total': 'Changes to the endpoints yaml applied or rejected',
+    'xcel_discovery_configs_total': 'Discovery configs at startup by outcome (published, unchanged, removed)',
+    'xcel_poll_interval_seconds': 'Achieved time between polls per endpoint',
+    'xcel_poll_interval_configured_seconds': 'Configured polling interval per endpoint',
+    'xcel_poll_missed': 'Polling deadlines missed per endpoint',
+    'xcel_readings_sent': 'Readings published per endpoint',
+    'xcel_readings_suppressed': 'Readings held back as unchanged per endpoint',
+    'xcel_connection_requests': 'Requests sent to the meter',
+    'xcel_connection_handshakes': 'Full TLS handshakes with the meter',
+    'xcel_connection_resumptions': 'Resumed TLS sessions with the meter',
+    'xcel_connection_reused': 'Requests sent on an already open connection',
+    'xcel_poll_skipped_total': 'Polls skipped because the breaker was open, the sweep ran over budget or the last reading was still fresh',
+    'xcel_ttl_refetch_total': 'Refetches once a reading expired by whether the meter had a new one yet',
+    'xcel_breaker_open': 'Whether the endpoint is being left alone after repeated failures',
+    'xcel_notifications_total': 'Readings the meter pushed to us per endpoint',
+    'xcel_spool_depth': 'Readings waiting in the spool for the broker',
+    'xcel_spool_writes_total': 'Readings written to the spool',
+    'xcel_spool_replayed_total': 'Spooled readings published once the broker was back',
+    'xcel_spool_evicted_total': 'Spooled readings dropped, oldest first, to stay under MQTT_SPOOL_MAX',
+    'xcel_pipeline_queue_depth': 'Items waiting for each pipeline stage',
+    'xcel_pipeline_items_total': 'Items each pipeline stage has processed',
+    'xcel_pipeline_stage_seconds': 'Time each pipeline stage spent on an item',
+    'xcel_pipeline_wait_seconds': 'Time items waited in the queue for each pipeline stage',
+    'xcel_sink_readings_total': 'Readings written by each sink',
+    'xcel_sink_dropped_total': 'Readings a sink dropped because its queue was full',
+    'xcel_sink_errors_total': 'Batches a sink failed to write, tried again with the next',
+    'xcel_sink_write_seconds': 'Time each sink spent writing a batch',
+    'xcel_pipeline_coalesced_total': 'Queued measurements replaced by a newer one before their stage got to them',
+}
+
+class Histogram():
+    """
+    Cumulative bucketed histogram in the Prometheus style
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+class xcelMetrics():
+    """
+    Registry of counters, gauges and histograms for the hot path.
+    Metrics are keyed by name plus labels (ie. endpoint='Power Factor').
+    Collectors are called at render time for values that are cheaper to
+    read on demand than to keep up to date.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observe how long the with block took into the named histogram
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def add_collector(self, collector) -> None:
+        """
+        Register a callable returning a list of (name, labels, value)
+        gauges to be read at render time.
+        """
+        self._collectors.append(collector)
+
+    def counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name: str, **labels) -> tuple:
+        """
+        Returns: tuple of (count, sum) for the named histogram
+        """
+        with self._lock:
+            hist = self._histograms.get(self._key(name, labels))
+            return (hist.count, hist.sum) if hist else (0, 0.0)
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+        labels = labels + extra
+        if not labels:
+            return ''
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+    def render(self) -> str:
+        """
+        Returns: str of every metric in the Prometheus text exposition format
+        """
+        gauges = {}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges[self._key(name, labels)] = value
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {e}")
+        with self._lock:
+            counters = dict(self._counters)
+            gauges.update(self._gauges)
+            histograms = {k: (list(h.counts), h.sum, h.count) for k, h in self._histograms.items()}
+
+        lines = []
+        seen = set()
+        def header(name, metric_type):
+            if (name, metric_type) not in seen:
+                seen.add((name, metric_type))
+                lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+                lines.append(f'# TYPE {name} {metric_type}')
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append(f'{name}{self._format_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, bucket in zip(Histogram.BUCKETS, counts):
+                lines.append(f'{name}_bucket{self._format_labels(labels, (("le", bound),))} {bucket}')
+            lines.append(f'{name}_bucket{self._format_labels(labels, (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+            lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host: str, port: int) -> ThreadingHTTPServer:
+        """
+        Serve render() at /metrics from a background thread
+
+        Returns: the running server
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+        return server
+
+# Shared by every meter and endpoint in the process
+metrics = xcelMetrics()
@@ -0,0 +1,132 @@
+import logging
+import threading
+import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class xcelMqttClient(mqtt.Client):
+    """
+    paho client with two additions, both off unless asked for:
+
+    Topic aliases (MQTT v5): every state topic gets a topic alias the
+    first time it's published, after that only the 2 byte alias goes
+    over the wire instead of the ~70 byte topic. Aliases are handed out
+    first come first served up to the broker's Topic Alias Maximum and
+    have to be re-sent after every reconnect.
+
+    Publish window: no more than `window` publishes may be waiting on
+    paho to write them out (QoS 0) or on the broker to ack them (QoS
+    1/2). A publish into a full window blocks the caller for up to
+    `window_timeout` seconds, then fails with MQTT_ERR_QUEUE_SIZE so the
+    reading goes to the spool instead of piling up in paho's queue. Until
+    the window moves again later publishes fail straight away.
+
+    Whoever sets on_connect has to call connected(properties) from it.
+    """
+    def __init__(self, protocol: int = mqtt.MQTTv311, window: int = 0,
+                 window_timeout: float = 5.0):
+        super().__init__(protocol=protocol)
+        self.window = window
+        self.window_timeout = window_timeout
+        if window > 0:
+            # Also bounds QoS 1/2 messages sent but not yet acked
+            self.max_inflight_messages_set(window)
+        self._outstanding = 0
+        self._stalled = False
+        self._window_cond = threading.Condition()
+        # {topic: alias}, and the aliases the broker has been told about on this connection
+        self._aliases = {}
+        self._aliased = set()
+        self._alias_max = 0
+        self._alias_lock = threading.Lock()
+        self.on_publish = self._published
+        self.on_disconnect = self._disconnected
+
+    def connected(self, properties: Properties = None) -> None:
+        """
+        A (re)connection to the broker, the broker has forgotten every
+        alias and anything that was in the window is gone
+
+        Returns: None
+        """
+        alias_max = getattr(properties, 'TopicAliasMaximum', 0) if self._protocol == mqtt.MQTTv5 else 0
+        with self._alias_lock:
+            self._aliased.clear()
+            if alias_max < len(self._aliases):
+                self._aliases.clear()
+            self._alias_max = alias_max
+        self._reset_window()
+        if alias_max:
+            logger.info(f"Broker allows {alias_max} topic aliases")
+
+    def _disconnected(self, client, userdata, rc, properties=None) -> None:
+        with self._alias_lock:
+            self._aliased.clear()
+        self._reset_window()
+
+    def _reset_window(self) -> None:
+        with self._window_cond:
+            self._outstanding = 0
+            self._stalled = False
+            self._window_cond.notify_all()
+
+    def _published(self, client, userdata, mid) -> None:
+        with self._window_cond:
+            if self._outstanding > 0:
+                self._outstanding -= 1
+                self._stalled = False
+                self._window_cond.notify()
+
+    def _acquire(self) -> bool:
+        with self._window_cond:
+            timeout = 0 if self._stalled else self.window_timeout
+            if not self._window_cond.wait_for(lambda: self._outstanding < self.window, timeout=timeout):
+                if not self._stalled:
+                    logger.warning(f"MQTT broker hasn't taken a publish in {self.window_timeout:g}s, "
+                                   f"not waiting on it until it does")
+                self._stalled = True
+                return False
+            self._outstanding += 1
+            return True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        if self.window > 0 and not self._acquire():
+            metrics.inc('xcel_mqtt_window_full_total')
+            info = mqtt.MQTTMessageInfo(0)
+            info.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+            return info
+        try:
+            info = self._publish(topic, payload, qos, retain, properties)
+        except Exception:
+            if self.window > 0:
+                self._published(self, None, 0)
+            raise
+        # A QoS 0 publish that wasn't queued never gets its on_publish
+        if self.window > 0 and qos == 0 and info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self._published(self, None, info.mid)
+
+        return info
+
+    def _publish(self, topic, payload, qos, retain, properties):
+        if not self._alias_max or not topic.endswith('/state'):
+            return super().publish(topic, payload, qos, retain, properties)
+        with self._alias_lock:
+            alias = self._aliases.get(topic)
+            if alias is None and len(self._aliases) < self._alias_max:
+                alias = self._aliases[topic] = len(self._aliases) + 1
+            if alias is None:
+                return super().publish(topic, payload, qos, retain, properties)
+            properties = properties or Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            # Held through the publish so nothing uses the alias before the broker learns it
+            known = alias in self._aliased
+            info = super().publish('' if known else topic, payload, qos, retain, properties)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._aliased.add(alias)
+
+        return info
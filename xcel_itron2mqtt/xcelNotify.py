@@ -0,0 +1,295 @@
+import ssl
+import socket
+import hashlib
+import logging
+import requests
+import threading
+import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Prefix that appears on all of the XML elements
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+
+SUBSCRIPTION_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Subscription xmlns="urn:ieee:std:2030.5:ns">'
+    '<subscribedResource>{resource}</subscribedResource>'
+    '<encoding>0</encoding>'
+    '<level>+S1</level>'
+    '<limit>1</limit>'
+    '<notificationURI>{notification_uri}</notificationURI>'
+    '</Subscription>'
+)
+
+# Notification.status values, anything but 0 means the subscription is gone
+NOTIFICATION_DEFAULT = '0'
+
+def certificate_lfdi(certificate: bytes) -> str:
+    """
+    The 2030.5 LFDI of a DER certificate, its SHA-256 fingerprint cut
+    down to the first 160 bits
+
+    Returns: str, 40 upper case hex digits
+    """
+    return hashlib.sha256(certificate).hexdigest()[:40].upper()
+
+def peer_certificate(ssl_context: ssl.SSLContext, host: str, port: int, timeout: float = 4.0) -> bytes:
+    """
+    Returns: bytes, the DER certificate the server at host:port presents
+    """
+    with socket.create_connection((host, port), timeout) as raw:
+        with ssl_context.wrap_socket(raw) as tls:
+            return tls.getpeercert(binary_form=True)
+
+class xcelNotifier():
+    """
+    HTTPS listener for the 2030.5 Notifications meters push to us. One
+    listener serves every meter in the process, each meter's
+    subscriptions point at their own route (see xcelSubscriptions).
+    Connections have to present a certificate pinned with trust(), and
+    a route only takes notifications from the certificate with its
+    meter's LFDI, anything else gets a 403.
+    """
+    def __init__(self, ssl_context: ssl.SSLContext, port: int, host: str = '0.0.0.0',
+                 public_host: str = None):
+        self.public_host = public_host
+        self.ssl_context = ssl_context
+        # {route: (callback(body), LFDI of the meter allowed to use it)}
+        self._routes = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        # A peer without a pinned certificate fails its handshake, no traceback needed
+        self._server.handle_error = lambda request, client_address: logger.debug(
+            f"Rejected notification connection from {client_address[0]}", exc_info=True)
+        # Handshakes happen in each connection's thread rather than in accept()
+        self._server.socket = ssl_context.wrap_socket(self._server.socket, server_side=True,
+                                                      do_handshake_on_connect=False)
+        self.host, self.port = self._server.server_address[:2]
+        threading.Thread(target=self._server.serve_forever, name='meter_notify', daemon=True).start()
+        logger.info(f"Listening for meter notifications on port {self.port}")
+
+    def _handler(self):
+        notifier = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                callback, lfdi = notifier._routes.get(self.path, (None, None))
+                status = 404
+                if callback is not None:
+                    certificate = self.connection.getpeercert(binary_form=True)
+                    peer = certificate_lfdi(certificate) if certificate else None
+                    if peer != lfdi:
+                        logger.warning(f"Refused notification on {self.path} from "
+                                       f"{self.client_address[0]}, lFDI {peer}")
+                        status = 403
+                        callback = None
+                if callback is not None:
+                    try:
+                        callback(body)
+                        status = 201
+                    except Exception as e:
+                        logger.error(f"Failed to handle notification on {self.path}: {e}")
+                        status = 400
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def add_route(self, route: str, callback, lfdi: str) -> None:
+        self._routes[route] = (callback, lfdi.upper())
+
+    def trust(self, certificate: bytes) -> None:
+        """
+        Accept connections presenting this DER certificate (a meter's)
+
+        Returns: None
+        """
+        self.ssl_context.load_verify_locations(cadata=certificate)
+
+    def notification_uri(self, meter_ip: str, route: str) -> str:
+        """
+        Where the meter should send notifications. Unless set, our
+        address is whichever one the OS would use to reach the meter.
+
+        Returns: str
+        """
+        host = self.public_host
+        if not host:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                # Nothing is sent, this just picks the outgoing interface
+                probe.connect((meter_ip, 1))
+                host = probe.getsockname()[0]
+
+        return f'https://{host}:{self.port}{route}'
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+class xcelSubscriptions():
+    """
+    A meter's subscriptions to its own reading resources. Each endpoint
+    the meter agrees to subscribe to gets its readings pushed through
+    on_notification(endpoint, body). Every `renew` seconds the
+    subscriptions are checked and re-created if the meter forgot them;
+    any that can't be are handed back by take_lost() so polling can
+    pick them up again. Only the meter with the given lfdi may notify
+    us on the route.
+    """
+    def __init__(self, session: requests.Session, base_url: str, notifier: xcelNotifier,
+                 route: str, subscription_list: str, on_notification, renew: float = 3600,
+                 lfdi: str = ''):
+        self.session = session
+        self.base_url = base_url
+        self.notifier = notifier
+        self.route = route
+        self.subscription_list = subscription_list
+        self.on_notification = on_notification
+        self.renew = renew
+        self.notification_uri = notifier.notification_uri(urlsplit(base_url).hostname, route)
+        # {resource path: {'endpoint': xcelEndpoint, 'href': subscription url}}
+        self._subscriptions = {}
+        self._lost = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._renewing = False
+        notifier.add_route(route, self._notified, lfdi)
+
+    def _create(self, resource: str) -> str | None:
+        """
+        Ask the meter to push updates of the resource to us
+
+        Returns: str, the new subscription's href or None if refused
+        """
+        payload = SUBSCRIPTION_TEMPLATE.format(resource=resource,
+                                               notification_uri=self.notification_uri)
+        try:
+            response = self.session.post(f'{self.base_url}{self.subscription_list}', data=payload,
+                                         headers={'Content-Type': 'application/sep+xml'},
+                                         verify=False, timeout=4.0)
+        except requests.RequestException as e:
+            logger.debug(f"Subscription to {resource} failed: {e}")
+            return None
+        location = response.headers.get('Location')
+        if response.status_code not in (200, 201) or not location:
+            logger.debug(f"Meter refused subscription to {resource}: HTTP {response.status_code}")
+            return None
+
+        # Some servers hand back an absolute url
+        return urlsplit(location).path
+
+    def subscribe(self, endpoints: list) -> list:
+        """
+        Subscribe to every endpoint's resource
+
+        Returns: list of the endpoints the meter is pushing
+        """
+        subscribed = []
+        for obj in endpoints:
+            resource = urlsplit(obj.url).path
+            href = self._create(resource)
+            if href is None:
+                continue
+            with self._lock:
+                self._subscriptions[resource] = {'endpoint': obj, 'href': href}
+            subscribed.append(obj)
+        logger.info(f"Meter is pushing {len(subscribed)} of {len(endpoints)} endpoints, polling the rest")
+        if subscribed and self.renew > 0 and not self._renewing:
+            self._renewing = True
+            threading.Thread(target=self._renew_loop, name='meter_subscriptions', daemon=True).start()
+
+        return subscribed
+
+    def unsubscribe(self, endpoints: list) -> None:
+        """
+        Cancel the subscriptions of the given endpoints (ie. ones taken
+        out of the endpoints.yaml)
+
+        Returns: None
+        """
+        with self._lock:
+            dropped = [(resource, self._subscriptions.pop(resource)) for resource, subscription
+                       in list(self._subscriptions.items()) if subscription['endpoint'] in endpoints]
+            self._lost = [obj for obj in self._lost if obj not in endpoints]
+        for resource, subscription in dropped:
+            try:
+                self.session.delete(f"{self.base_url}{subscription['href']}", verify=False, timeout=4.0)
+            except requests.RequestException as e:
+                logger.debug(f"Cancelling subscription to {resource} failed: {e}")
+
+    def _drop(self, resource: str) -> None:
+        with self._lock:
+            subscription = self._subscriptions.pop(resource, None)
+            if subscription is not None:
+                self._lost.append(subscription['endpoint'])
+                logger.warning(f"Lost subscription to {resource}, falling back to polling")
+
+    def _renew_loop(self) -> None:
+        while not self._closed.wait(self.renew):
+            with self._lock:
+                subscriptions = list(self._subscriptions.items())
+            for resource, subscription in subscriptions:
+                try:
+                    alive = self.session.get(f"{self.base_url}{subscription['href']}",
+                                             verify=False, timeout=4.0).ok
+                except requests.RequestException:
+                    alive = False
+                if alive:
+                    continue
+                href = self._create(resource)
+                if href is None:
+                    self._drop(resource)
+                else:
+                    subscription['href'] = href
+
+    def _notified(self, body: bytes) -> None:
+        root = ET.fromstring(body)
+        resource = root.findtext(f'{IEEE_PREFIX}subscribedResource')
+        status = root.findtext(f'{IEEE_PREFIX}status', NOTIFICATION_DEFAULT)
+        with self._lock:
+            subscription = self._subscriptions.get(resource)
+        if subscription is None:
+            raise KeyError(f'No subscription to {resource}')
+        if status != NOTIFICATION_DEFAULT:
+            self._drop(resource)
+            return
+        metrics.inc('xcel_notifications_total', **subscription['endpoint']._metric_labels)
+        self.on_notification(subscription['endpoint'], body)
+
+    def take_lost(self) -> list:
+        """
+        Returns: list of endpoints whose subscriptions have lapsed since the last call
+        """
+        with self._lock:
+            lost, self._lost = self._lost, []
+        return lost
+
+    def close(self) -> None:
+        """
+        Cancel every subscription with the meter
+
+        Returns: None
+        """
+        self._closed.set()
+        with self._lock:
+            subscriptions = list(self._subscriptions.values())
+            self._subscriptions.clear()
+        for subscription in subscriptions:
+            try:
+                self.session.delete(f"{self.base_url}{subscription['href']}", verify=False, timeout=4.0)
+            except requests.RequestException:
+                pass
@@ -0,0 +1,171 @@
+import logging
+import threading
+from itertools import count
+from collections import OrderedDict
+from time import monotonic, time
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class xcelCoalescingQueue():
+    """
+    Bounded FIFO between two pipeline stages. Items put with a key
+    replace whatever is still queued under the same key, in its place
+    in line, so a backed up stage only ever sees the latest of them.
+    Items without a key are all kept in order. put() blocks while the
+    queue is full unless it's replacing an item.
+    """
+    def __init__(self, name: str, maxsize: int = 64, metric_labels: dict = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.metric_labels = metric_labels or {}
+        self.coalesced = 0
+        # {key: item}, unkeyed items get a key of their own
+        self._items = OrderedDict()
+        self._seq = count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item, key=None) -> None:
+        with self._cond:
+            if key is not None and key in self._items:
+                self._items[key] = item
+                self.coalesced += 1
+                metrics.inc('xcel_pipeline_coalesced_total', stage=self.name, **self.metric_labels)
+                return
+            while len(self._items) >= self.maxsize and not self._closed:
+                self._cond.wait()
+            self._items[key if key is not None else ('seq', next(self._seq))] = item
+            self._cond.notify_all()
+
+    def get(self):
+        """
+        Wait for the oldest item
+
+        Returns: the item, or None once the queue is closed
+        """
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if not self._items:
+                return None
+            item = self._items.popitem(last=False)[1]
+            self._cond.notify_all()
+            return item
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class xcelPipeline():
+    """
+    Runs parsing and publishing of a meter's readings in stages of their
+    own, so a slow broker or a big response doesn't hold up the next
+    fetch. Fetched responses go through the parse queue to the parse
+    thread, parsed readings through the publish queue to the publish
+    thread. Both queues are bounded and keep only the latest reading of
+    an endpoint that's all measurements; totals are kept in order.
+
+    The parse stage records the outcome of each poll with the endpoint's
+    breaker.
+    """
+    STAGES = ('parse', 'publish')
+
+    def __init__(self, name: str, maxsize: int = 64):
+        self.name = name
+        self._queues = {stage: xcelCoalescingQueue(stage, maxsize, {'meter': name})
+                        for stage in self.STAGES}
+        self.processed = dict.fromkeys(self.STAGES, 0)
+        self._threads = [
+            threading.Thread(target=self._run, args=(stage, work),
+                             name=f'{stage}_{name}', daemon=True)
+            for stage, work in (('parse', self._parse), ('publish', self._publish))
+        ]
+        for thread in self._threads:
+            thread.start()
+        metrics.add_collector(self._collect)
+
+    def _collect(self) -> list:
+        return [('xcel_pipeline_queue_depth', {'meter': self.name, 'stage': stage}, len(queue))
+                for stage, queue in self._queues.items()]
+
+    def submit(self, unit, response: str) -> None:
+        """
+        Hand a fetched response on to be parsed and published, blocks
+        while the parse stage is backed up
+
+        Returns: None
+        """
+        # Readings are stamped with when they were polled, not when they get parsed
+        self._queues['parse'].put((unit, (response, time()), monotonic()),
+                                  key=unit if unit.coalescable else None)
+
+    def then(self, callback) -> None:
+        """
+        Have the publish stage call callback() once everything submitted
+        so far is published
+
+        Returns: None
+        """
+        self._queues['parse'].put((None, callback, monotonic()))
+
+    def _run(self, stage: str, work) -> None:
+        queue = self._queues[stage]
+        while (item := queue.get()) is not None:
+            unit, payload, queued = item
+            started = monotonic()
+            metrics.observe('xcel_pipeline_wait_seconds', started - queued,
+                            meter=self.name, stage=stage)
+            try:
+                work(unit, payload)
+            except Exception as e:
+                logger.error(f"Failed to {stage} {getattr(unit, 'name', payload)}: {e}")
+            metrics.observe('xcel_pipeline_stage_seconds', monotonic() - started,
+                            meter=self.name, stage=stage)
+            metrics.inc('xcel_pipeline_items_total', meter=self.name, stage=stage)
+            self.processed[stage] += 1
+
+    def _parse(self, unit, payload) -> None:
+        publish = self._queues['publish']
+        if unit is None:
+            # A then() callback, passed along in order
+            publish.put((None, payload, monotonic()))
+            return
+        try:
+            readings = unit.parse(*payload)
+        except Exception:
+            unit.record(False)
+            raise
+        unit.record(True)
+        for obj, reading, timestamp in readings:
+            publish.put((obj, (reading, timestamp), monotonic()),
+                        key=obj if obj.coalescable else None)
+
+    def _publish(self, obj, payload) -> None:
+        if obj is None:
+            payload()
+            return
+        obj.publish(*payload)
+
+    def idle(self) -> bool:
+        """
+        Returns: bool, whether nothing is queued in any stage
+        """
+        return not any(len(queue) for queue in self._queues.values())
+
+    def stats(self) -> dict:
+        return {'depth': {stage: len(queue) for stage, queue in self._queues.items()},
+                'processed': dict(self.processed),
+                'coalesced': {stage: queue.coalesced for stage, queue in self._queues.items()}}
+
+    def close(self) -> None:
+        for queue in self._queues.values():
+            queue.close()
+        for thread in self._threads:
+            thread.join(timeout=5)
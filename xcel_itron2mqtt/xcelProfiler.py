@@ -0,0 +1,238 @@
+import io
+import gc
+import pstats
+import logging
+import cProfile
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from time import monotonic, process_time
+
+logger = logging.getLogger(__name__)
+
+# Nothing to do per batch while profiling is off
+_OFF = nullcontext()
+
+class xcelProfiler():
+    """
+    Opt-in diagnostics for a bridge that's been running for months. Every
+    `interval` seconds polling is run under cProfile until every scheduled
+    endpoint has been polled `sweeps` times over (a sweep being one full
+    pass of the endpoints, however many batches the scheduler hands them
+    out in), then a report is written to `directory` with:
+
+    - the profile, as text and as a .prof file for pstats/snakeviz
+    - the process' CPU time while the batches ran, per sweep
+    - calls and time spent in the functions in WATCHED
+    - the lines that allocated the most memory since the last report
+      (tracemalloc), and how much is held by the likely suspects
+    - whatever the registered probes report (ie. paho's in-flight queue)
+
+    Only the newest `keep` reports are kept. cProfile only sees the
+    polling thread, work handed to METER_CONCURRENCY or METER_PIPELINE
+    threads shows up as time waiting on them, though their CPU time is
+    counted while a batch runs. While not started, sweep() costs one
+    attribute check.
+    """
+    WATCHED = ('query_endpoint', 'parse_response', '_mqtt_publish')
+    # {suspect: path fragment of the files its memory is allocated from}
+    SUSPECTS = {
+        'paho': 'paho/mqtt/',
+        'xml.etree': 'xml/etree/',
+        'requests': 'requests/',
+        'urllib3': 'urllib3/',
+        'ssl': 'ssl.py',
+    }
+    # Lines of each listing in a report
+    TOP = 25
+
+    def __init__(self):
+        self.directory = None
+        self.sweeps = 10
+        self.interval = 3600.0
+        self.keep = 24
+        self._probes = []
+        self._profile = None
+        self._sweeps_left = 0
+        # Keys not yet polled in the current sweep
+        self._unpolled = set()
+        self._batches = 0
+        self._cpu = 0.0
+        self._next_at = 0.0
+        self._snapshot = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def start(self, directory: str, sweeps: int = 10, interval: float = 3600,
+              keep: int = 24, frames: int = 1) -> None:
+        """
+        Start tracing allocations and profile the next `sweeps` sweeps
+
+        Returns: None
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.sweeps = max(1, sweeps)
+        self.interval = interval
+        self.keep = keep
+        tracemalloc.start(frames)
+        self._snapshot = self._take_snapshot()
+        self._next_at = monotonic()
+        logger.info(f"Profiling {self.sweeps} sweeps every {interval:g}s into {directory}")
+
+    def add_probe(self, probe) -> None:
+        """
+        Register a callable returning a dict of figures to add to each report
+        """
+        self._probes.append(probe)
+
+    def sweep(self, due: list, scheduler):
+        """
+        Context manager to run each batch of due endpoints in, the
+        scheduler's keys() being what a full sweep has to cover
+
+        Returns: context manager
+        """
+        if self.directory is None:
+            return _OFF
+        return self._sweep(due, scheduler)
+
+    @contextmanager
+    def _sweep(self, due: list, scheduler):
+        if self._profile is None:
+            if monotonic() < self._next_at:
+                yield
+                return
+            self._profile = cProfile.Profile()
+            self._sweeps_left = self.sweeps
+            self._unpolled = scheduler.keys()
+            self._batches = 0
+            self._cpu = 0.0
+        cpu = process_time()
+        self._profile.enable()
+        try:
+            yield
+        finally:
+            self._profile.disable()
+            self._cpu += process_time() - cpu
+            self._batches += 1
+            # Anything dropped by a config reload no longer needs polling
+            self._unpolled.difference_update(due)
+            self._unpolled.intersection_update(scheduler.keys())
+            if not self._unpolled:
+                self._sweeps_left -= 1
+                self._unpolled = scheduler.keys()
+            if self._sweeps_left <= 0:
+                profile, self._profile = self._profile, None
+                self._next_at = monotonic() + self.interval
+                try:
+                    self._report(profile)
+                except Exception as e:
+                    logger.error(f"Failed to write profile report: {e}")
+
+    @staticmethod
+    def _take_snapshot() -> tracemalloc.Snapshot:
+        # Leave out our own bookkeeping
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    @staticmethod
+    def _rss_kb() -> int | None:
+        try:
+            with open('/proc/self/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def _suspects(self, snapshot: tracemalloc.Snapshot) -> dict:
+        """
+        Returns: dict of {suspect: bytes allocated from its files}
+        """
+        held = dict.fromkeys(self.SUSPECTS, 0)
+        for stat in snapshot.statistics('filename'):
+            filename = stat.traceback[0].filename.replace('\\', '/')
+            for suspect, fragment in self.SUSPECTS.items():
+                if fragment in filename:
+                    held[suspect] += stat.size
+                    break
+        return held
+
+    def _functions(self, profile: cProfile.Profile) -> list:
+        """
+        Returns: list of (function, calls, total seconds, seconds per call)
+        for the WATCHED functions
+        """
+        timings = []
+        for (filename, line, function), (_, calls, _, cumulative, _) in pstats.Stats(profile).stats.items():
+            if function in self.WATCHED:
+                timings.append((f'{function} ({Path(filename).name}:{line})', calls, cumulative,
+                                cumulative / calls if calls else 0.0))
+        return sorted(timings)
+
+    def _report(self, profile: cProfile.Profile) -> None:
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        snapshot = self._take_snapshot()
+        lines = [f'# xcel_itron2mqtt diagnostics {stamp}, {self.sweeps} sweeps '
+                 f'({self._batches} batches) profiled', '']
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines += ['## Process',
+                  f'rss_kb: {self._rss_kb()}',
+                  f'traced_kb: {current // 1024} (peak {peak // 1024})',
+                  f'gc_counts: {gc.get_count()}',
+                  f'cpu_ms_per_sweep: {self._cpu / self.sweeps * 1000:.2f}', '']
+
+        before = self._suspects(self._snapshot)
+        lines.append('## Memory by suspect (kb, change since last report)')
+        for suspect, size in self._suspects(snapshot).items():
+            lines.append(f'{suspect}: {size // 1024} ({(size - before[suspect]) / 1024:+.1f})')
+        lines.append('')
+
+        lines.append('## Probes')
+        for probe in self._probes:
+            try:
+                lines += [f'{k}: {v}' for k, v in probe().items()]
+            except Exception as e:
+                lines.append(f'probe failed: {e}')
+        lines.append('')
+
+        lines += ['## Watched functions (calls, total s, ms per call)']
+        lines += [f'{name}: {calls} {total:.4f} {per_call * 1000:.3f}'
+                  for name, calls, total, per_call in self._functions(profile)]
+        lines.append('')
+
+        lines.append(f'## Top {self.TOP} allocation growth since last report')
+        growth = [stat for stat in snapshot.compare_to(self._snapshot, 'lineno') if stat.size_diff > 0]
+        lines += [str(stat) for stat in growth[:self.TOP]]
+        lines.append('')
+        self._snapshot = snapshot
+
+        stream = io.StringIO()
+        pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(self.TOP)
+        lines += ['## Profile', stream.getvalue()]
+
+        (self.directory / f'{stamp}-report.txt').write_text('\n'.join(lines))
+        profile.dump_stats(self.directory / f'{stamp}-profile.prof')
+        logger.info(f"Wrote diagnostics report {self.directory / f'{stamp}-report.txt'}")
+        self._rotate()
+
+    def _rotate(self) -> None:
+        reports = sorted(self.directory.glob('*-report.txt'))
+        for report in reports[:max(0, len(reports) - self.keep)]:
+            stamp = report.name[:-len('-report.txt')]
+            for old in self.directory.glob(f'{stamp}-*'):
+                old.unlink(missing_ok=True)
+
+# Shared by every meter in the process
+profiler = xcelProfiler()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Local history of raw meter readings, independent of homeassistant's recorder.
+
+Every numeric sensor gets a directory of daily (UTC) segment files:
+
+    <root>/<meter>/<endpoint>/<sensor>/<YYYY-MM-DD>.dat
+
+Each segment is a flat run of fixed-width 16 byte records, a float64
+unix timestamp followed by a float64 value in the machine's byte order,
+appended in time order. A write is one append per sensor regardless of how much
+history there is, and reads memory-map the segments and binary search
+them for the range wanted. Segments older than the retention are deleted.
+
+Run this file to query or export what's been recorded:
+
+    python3 xcelRecorder.py list
+    python3 xcelRecorder.py query Xcel_Itron_5/Instantaneous_Demand/value --start=-1d
+    python3 xcelRecorder.py export Xcel_Itron_5/Instantaneous_Demand/value --format csv -o demand.csv
+"""
+import os
+import sys
+import csv
+import mmap
+import struct
+import logging
+import argparse
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from datetime import datetime, timezone
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Native order, so a mapped segment can be read as array('d') as is
+RECORD = struct.Struct('=dd')
+SEGMENT_SUFFIX = '.dat'
+
+def _safe(name: str) -> str:
+    # Same as the MQTT topics, no spaces
+    return name.replace(' ', '_').replace('/', '_')
+
+def _day(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d')
+
+class xcelRecorder():
+    """
+    Appends every reading an endpoint parses to its sensors' segment
+    files under `root`, keeping `retention` days of them (0 keeps
+    everything). One recorder can be shared by several meters. Readings
+    should be stamped with when they were polled, one stamped earlier
+    than the last record in its segment (ie. the clock stepped back) is
+    recorded at that record's time so the segment stays in order.
+    """
+    def __init__(self, root: str, retention: float = 30):
+        self.root = Path(root)
+        self.retention = retention
+        self.root.mkdir(parents=True, exist_ok=True)
+        # {sensor directory: (day, fd, time of its last record)} of the segment each sensor is appending to
+        self._open = {}
+        self._lock = threading.Lock()
+        self._pruned_day = None
+
+    def record(self, meter: str, endpoint: str, reading: dict, timestamp: float = None) -> int:
+        """
+        Append a parsed reading, skipping any sensors that aren't numbers
+
+        Returns: integer, # of values recorded
+        """
+        timestamp = time() if timestamp is None else timestamp
+        day = _day(timestamp)
+        written = 0
+        with self._lock:
+            if day != self._pruned_day:
+                self._pruned_day = day
+                self._prune(timestamp)
+            for sensor, value in reading.items():
+                try:
+                    value = float(value)
+                except (TypeError, ValueError):
+                    continue
+                path = self.root / _safe(meter) / _safe(endpoint) / _safe(sensor)
+                fd, last = self._segment(path, day)
+                if timestamp < last:
+                    logger.debug(f"Recording {path} at {last}, {last - timestamp:.3f}s after its reading")
+                os.write(fd, RECORD.pack(max(timestamp, last), value))
+                self._open[path] = (day, fd, max(timestamp, last))
+                written += 1
+
+        return written
+
+    def _segment(self, path: Path, day: str) -> tuple:
+        """
+        Returns: tuple of the fd of the sensor's segment for the day, and
+        the time of the last record in it (-inf if there are none)
+        """
+        current = self._open.get(path)
+        if current is not None and current[0] == day:
+            return current[1:]
+        if current is not None:
+            os.close(current[1])
+        path.mkdir(parents=True, exist_ok=True)
+        segment = path / f'{day}{SEGMENT_SUFFIX}'
+        fd = os.open(segment, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        # A write cut short by a crash would throw every record after it out of line
+        size = os.fstat(fd).st_size
+        if size % RECORD.size:
+            size -= size % RECORD.size
+            os.truncate(segment, size)
+        # Carry on from where the segment left off, ie. after a restart
+        last = RECORD.unpack(os.pread(fd, RECORD.size, size - RECORD.size))[0] if size else float('-inf')
+        self._open[path] = (day, fd, last)
+
+        return fd, last
+
+    def _prune(self, now: float) -> None:
+        if self.retention <= 0:
+            return
+        oldest = _day(now - self.retention * 86400)
+        for segment in self.root.glob(f'*/*/*/*{SEGMENT_SUFFIX}'):
+            if segment.stem < oldest:
+                logger.debug(f"Recorder retention dropping {segment}")
+                segment.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        with self._lock:
+            for _, fd, _ in self._open.values():
+                os.close(fd)
+            self._open.clear()
+
+def sensors(root: str) -> list:
+    """
+    Returns: list of every recorded sensor as 'meter/endpoint/sensor'
+    """
+    return sorted('/'.join(path.parts[-3:]) for path in Path(root).glob('*/*/*') if path.is_dir())
+
+def scan(root: str, sensor: str, start: float = None, end: float = None):
+    """
+    Read the records of a sensor between start and end (unix time,
+    inclusive, None for unbounded) a segment at a time
+
+    Returns: generator of (timestamps, values), both array('d')
+    """
+    path = Path(root) / sensor
+    first = _day(start) if start is not None else ''
+    last = _day(end) if end is not None else '9999'
+    for segment in sorted(path.glob(f'*{SEGMENT_SUFFIX}')):
+        if not first <= segment.stem <= last:
+            continue
+        with open(segment, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size // RECORD.size * RECORD.size
+            if not size:
+                continue
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped).cast('d') as doubles, doubles[0::2] as times:
+                    lo = bisect_left(times, start) if start is not None else 0
+                    hi = bisect_right(times, end) if end is not None else len(times)
+                records = array('d')
+                records.frombytes(mapped[lo * RECORD.size:hi * RECORD.size])
+        if records:
+            yield records[0::2], records[1::2]
+
+def summarize(root: str, sensor: str, start: float = None, end: float = None) -> dict:
+    """
+    Returns: dict of count, first, last, min, max and mean over the range
+    """
+    count, total, low, high, first, last = 0, 0.0, None, None, None, None
+    for times, values in scan(root, sensor, start, end):
+        count += len(values)
+        total += sum(values)
+        low = min(values) if low is None else min(low, min(values))
+        high = max(values) if high is None else max(high, max(values))
+        first = times[0] if first is None else first
+        last = times[-1]
+
+    return {'count': count, 'first': first, 'last': last, 'min': low, 'max': high,
+            'mean': total / count if count else None}
+
+def export(root: str, sensor_list: list, output, fmt: str = 'csv',
+           start: float = None, end: float = None) -> int:
+    """
+    Write the records of each sensor in the range to output (a path, or
+    a file object for csv) as rows of time, sensor, value
+
+    Returns: integer, # of rows written
+    """
+    if fmt == 'parquet':
+        try:
+            import pyarrow as pa
+            import pyarrow.compute as pc
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit('Parquet export needs pyarrow, pip3 install pyarrow')
+        def column(doubles: array):
+            # Hand the array's buffer straight to arrow rather than a value at a time
+            return pa.Array.from_buffers(pa.float64(), len(doubles), [None, pa.py_buffer(doubles)])
+
+        tables = []
+        for sensor in sensor_list:
+            for times, values in scan(root, sensor, start, end):
+                micros = pc.cast(pc.multiply(column(times), 1e6), pa.int64(), safe=False)
+                tables.append(pa.table({
+                    'time': micros.cast(pa.timestamp('us', tz='UTC')),
+                    'sensor': pa.array([sensor] * len(times), pa.string()),
+                    'value': column(values)}))
+        if not tables:
+            return 0
+        table = pa.concat_tables(tables)
+        pq.write_table(table, output)
+        return table.num_rows
+
+    rows = 0
+    writer = csv.writer(output)
+    writer.writerow(['time', 'sensor', 'value'])
+    for sensor in sensor_list:
+        for times, values in scan(root, sensor, start, end):
+            writer.writerows((datetime.fromtimestamp(t, timezone.utc).isoformat(), sensor, f'{v:.15g}')
+                             for t, v in zip(times, values))
+            rows += len(times)
+
+    return rows
+
+def parse_time(value: str) -> float | None:
+    """
+    Times on the command line are ISO 8601 (UTC unless given) or
+    relative to now, ie. -1d, -12h, -30m
+
+    Returns: float unix time, or None if not given
+    """
+    if value is None:
+        return None
+    units = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+    if value.startswith('-') and value[-1:] in units:
+        return time() - float(value[1:-1]) * units[value[-1]]
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+
+    return moment.timestamp()
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--root', default=os.getenv('METER_RECORDER', 'history'),
+                        help='recorder directory, defaults to METER_RECORDER')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list recorded sensors')
+    for name, helptext in (('query', 'summarize a sensor over a time range'),
+                           ('export', 'export sensors over a time range')):
+        command = commands.add_parser(name, help=helptext)
+        command.add_argument('sensors', nargs='+', help='meter/endpoint/sensor, as shown by list')
+        command.add_argument('--start', help='ISO 8601 time or relative, ie. --start=-1d')
+        command.add_argument('--end', help='ISO 8601 time or relative, ie. --end=-1h')
+    export_command = commands.choices['export']
+    export_command.add_argument('--format', default='csv', choices=['csv', 'parquet'])
+    export_command.add_argument('-o', '--output', help='file to write, csv goes to stdout by default')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        print('\n'.join(sensors(args.root)))
+        return
+    start, end = parse_time(args.start), parse_time(args.end)
+    if args.command == 'query':
+        for sensor in args.sensors:
+            summary = summarize(args.root, sensor, start, end)
+            for key in ('first', 'last'):
+                if summary[key] is not None:
+                    summary[key] = datetime.fromtimestamp(summary[key], timezone.utc).isoformat()
+            print(sensor, ' '.join(f'{k}={v}' for k, v in summary.items()))
+        return
+    if args.format == 'parquet':
+        if not args.output:
+            parser.error('parquet export needs --output')
+        rows = export(args.root, args.sensors, args.output, 'parquet', start, end)
+    elif args.output:
+        with open(args.output, 'w', newline='') as f:
+            rows = export(args.root, args.sensors, f, 'csv', start, end)
+    else:
+        rows = export(args.root, args.sensors, sys.stdout, 'csv', start, end)
+    print(f'{rows} rows exported', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+import heapq
+import random
+import logging
+from collections import deque
+from time import monotonic, time, sleep
+
+logger = logging.getLogger(__name__)
+
+class xcelScheduler():
+    """
+    Heap of next-due times keyed by whatever is being polled (endpoints).
+    Deadlines are chained off the previous deadline in monotonic time
+    rather than off when the last poll finished, so slow requests don't
+    accumulate drift.
+    """
+    def __init__(self):
+        # Heap of (due time, sequence #, key)
+        self._heap = []
+        # Per key schedule details, {key: {...}}
+        self._entries = {}
+        # Tie breaker for the heap so keys never need to be comparable
+        self._seq = 0
+
+    def add(self, key, interval: float, align: bool = False, jitter: float = 0.0,
+            name: str = None, group=None) -> None:
+        """
+        Schedule a new key to be returned every `interval` seconds.
+        The first poll is always immediate. If align is set the deadlines
+        after that land on wall-clock multiples of the interval
+        (ie. :00, :15, :30, :45 for 900s). Jitter adds a
+        random 0 to `jitter` seconds onto each deadline without it
+        accumulating into the next one. Keys sharing a group (ie. the
+        meter they belong to) are handed out round-robin against other
+        groups when several are due at once.
+
+        Returns: None
+        """
+        if interval <= 0:
+            raise ValueError(f'Polling interval must be positive, got {interval}')
+        now = monotonic()
+        base = now + interval
+        if align:
+            # Translate the next wall-clock boundary into monotonic time
+            base = now + (interval - time() % interval)
+        self._entries[key] = {
+            'name': name or str(key),
+            'group': group,
+            'interval': interval,
+            'jitter': jitter,
+            'base': base,
+            'polls': 0,
+            'missed': 0,
+            }
+        self._push(key, due=now)
+
+    def remove(self, key) -> None:
+        """
+        Stop scheduling the given key. Its heap entry is dropped lazily.
+
+        Returns: None
+        """
+        self._entries.pop(key, None)
+
+    def set_interval(self, key, interval: float) -> None:
+        """
+        Change how often a key is polled, starting from now. A first
+        poll that hasn't been handed out yet still happens right away.
+
+        Returns: None
+        """
+        if interval <= 0:
+            raise ValueError(f'Polling interval must be positive, got {interval}')
+        entry = self._entries[key]
+        entry['interval'] = interval
+        entry['base'] = monotonic() + interval
+        if entry['polls'] > 0:
+            self._push(key)
+
+    def defer(self, key, delay: float) -> None:
+        """
+        Push a key's next poll back to `delay` seconds from now, its
+        deadlines carry on every interval from there. The polls passed
+        over aren't counted as missed.
+
+        Returns: None
+        """
+        entry = self._entries[key]
+        entry['base'] = monotonic() + delay
+        self._push(key, due=entry['base'])
+
+    def _push(self, key, due: float = None) -> None:
+        entry = self._entries[key]
+        if due is None:
+            due = entry['base']
+            if entry['jitter']:
+                due += random.uniform(0, entry['jitter'])
+        entry['due'] = due
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, key))
+
+    def _reschedule(self, key, now: float) -> None:
+        """
+        Move the key onto its next deadline, counting every deadline
+        that already went by while we were busy as missed.
+        """
+        entry = self._entries[key]
+        interval = entry['interval']
+        # The first poll is handed out ahead of the chain of deadlines
+        if entry['polls'] == 0 and now < entry['base']:
+            entry['polls'] += 1
+            self._push(key)
+            return
+        missed = int((now - entry['base']) // interval)
+        if missed > 0:
+            entry['missed'] += missed
+            logger.warning(f"{entry['name']} missed {missed} polling deadline(s), "
+                           f"{entry['missed']} missed in total")
+        entry['polls'] += 1
+        entry['base'] += (max(missed, 0) + 1) * interval
+        self._push(key)
+
+    def wait_due(self) -> list:
+        """
+        Block until at least one key is due, then hand back every key
+        that is due, earliest deadline first.
+
+        Returns: list of keys
+        """
+        while self._heap:
+            due, _, key = self._heap[0]
+            entry = self._entries.get(key)
+            # Skip over removed or superseded heap entries
+            if entry is None or entry['due'] != due:
+                heapq.heappop(self._heap)
+                continue
+            delay = due - monotonic()
+            if delay > 0:
+                sleep(delay)
+            break
+        else:
+            return []
+
+        now = monotonic()
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry['due'] != due:
+                continue
+            ready.append(key)
+            self._reschedule(key, now)
+
+        return self._interleave(ready)
+
+    def _interleave(self, ready: list) -> list:
+        """
+        Round-robin the due keys across their groups, keeping the
+        deadline order within each group, so no one group (meter)
+        gets all of its polls in before the others.
+        """
+        queues = {}
+        for key in ready:
+            queues.setdefault(self._entries[key]['group'], deque()).append(key)
+        if len(queues) < 2:
+            return ready
+        interleaved = []
+        while queues:
+            for group in list(queues):
+                interleaved.append(queues[group].popleft())
+                if not queues[group]:
+                    del queues[group]
+
+        return interleaved
+
+    def keys(self) -> set:
+        """
+        Returns: set of every key being scheduled
+        """
+        return set(self._entries)
+
+    def group(self, key):
+        """
+        Returns: the group the key was added with, None if not scheduled
+        """
+        entry = self._entries.get(key)
+        return entry['group'] if entry else None
+
+    def stats_for(self, key) -> dict:
+        """
+        Returns: dict, {'interval': s, 'polls': #, 'missed': #} for a single key
+        """
+        entry = self._entries[key]
+        return {'interval': entry['interval'], 'polls': entry['polls'], 'missed': entry['missed']}
+
+    def stats(self) -> dict:
+        """
+        Returns: dict, {name: {'interval': s, 'polls': #, 'missed': #}}
+        """
+        return {entry['name']: self.stats_for(key) for key, entry in self._entries.items()}
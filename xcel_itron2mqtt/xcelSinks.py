@@ -0,0 +1,313 @@
+import sys
+import json
+import atexit
+import math
+import queue
+import socket
+import logging
+import threading
+import http.client
+from time import monotonic
+from urllib.parse import urlsplit
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Measurement every reading is written to in line protocol
+MEASUREMENT = 'xcel'
+
+def _escape(text: str, special: str) -> str:
+    for char in '\\' + special:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+class xcelSink():
+    """
+    Somewhere parsed readings go. Every reading an endpoint publishes
+    is handed to each of its sinks with submit(endpoint, reading,
+    timestamp), the timestamp being when the reading was parsed.
+    """
+    name = 'sink'
+
+    def submit(self, endpoint, reading: dict, timestamp: float) -> bool:
+        """
+        Take a parsed reading
+
+        Returns: bool, False if the reading was dropped
+        """
+        raise NotImplementedError
+
+    def depth(self) -> int:
+        """
+        Returns: int, # of readings waiting to be written
+        """
+        return 0
+
+    def close(self) -> None:
+        pass
+
+class xcelMqttSink(xcelSink):
+    """
+    Publishes readings to homeassistant. The endpoint a reading came
+    from holds its sensors' topics, deadbands, heartbeats and spool, so
+    it does the publishing (see xcelEndpoint._process_send_mqtt). This
+    runs on the caller's thread, MQTT already has its own queueing in
+    the pipeline's publish stage, the MQTT_INFLIGHT window and the spool.
+    """
+    name = 'mqtt'
+
+    def submit(self, endpoint, reading: dict, timestamp: float) -> bool:
+        endpoint._process_send_mqtt(reading)
+        return True
+
+class xcelBatchSink(xcelSink):
+    """
+    A sink with its own bounded queue and thread, submit() never waits
+    on it, so a slow sink can't hold up polling. Readings that don't
+    fit in the queue are dropped and counted. The thread hands write()
+    batches of readings once `batch_size` have queued up or the oldest
+    has waited `flush_interval` seconds. A batch write() fails on is
+    tried again with the next one, as long as the queue has room for it.
+    """
+    def __init__(self, name: str, batch_size: int = 500, flush_interval: float = 10.0,
+                 queue_size: int = 10000):
+        self.name = name
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        # (timestamp, meter, endpoint name, reading) tuples, None asks the thread to flush and stop
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name=f'sink_{name}', daemon=True)
+        self._thread.start()
+        # Whatever is still queued gets written on the way out
+        atexit.register(self.close)
+
+    def submit(self, endpoint, reading: dict, timestamp: float) -> bool:
+        """
+        Queue a parsed reading for the sink
+
+        Returns: bool, False if the queue was full and the reading dropped
+        """
+        try:
+            self._queue.put_nowait((timestamp, endpoint._metric_labels['meter'], endpoint.name, reading))
+        except queue.Full:
+            metrics.inc('xcel_sink_dropped_total', sink=self.name)
+            return False
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def write(self, batch: list) -> None:
+        """
+        Send a batch of (timestamp, meter, endpoint name, reading) tuples, raising if it didn't go
+
+        Returns: None
+        """
+        raise NotImplementedError
+
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        # A failed batch waits out the flush interval, however big it gets
+        failed = False
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=max(0, deadline - monotonic()) if batch else None)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                stopping = True
+            elif item:
+                if not batch:
+                    deadline = monotonic() + self.flush_interval
+                batch.append(item)
+                if len(batch) < self.batch_size or (failed and monotonic() < deadline):
+                    continue
+            if batch:
+                batch = self._flush(batch)
+                failed = bool(batch)
+                deadline = monotonic() + self.flush_interval
+
+    def _flush(self, batch: list) -> list:
+        """
+        Returns: list, what's left of the batch to try again
+        """
+        try:
+            with metrics.timer('xcel_sink_write_seconds', sink=self.name):
+                self.write(batch)
+        except Exception as e:
+            logger.error(f"Sink {self.name} failed to write {len(batch)} readings: {e}")
+            metrics.inc('xcel_sink_errors_total', sink=self.name)
+            # Hang on to as much as the queue would hold, the newest of it
+            kept = batch[-self.queue_size:]
+            if len(kept) < len(batch):
+                metrics.inc('xcel_sink_dropped_total', len(batch) - len(kept), sink=self.name)
+            return kept
+        metrics.inc('xcel_sink_readings_total', len(batch), sink=self.name)
+        return []
+
+    def close(self, timeout: float = 5.0) -> None:
+        """
+        Write out whatever is queued and stop the thread
+
+        Returns: None
+        """
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warning(f"Sink {self.name} still backed up, closing without flushing")
+            return
+        self._thread.join(timeout)
+
+class xcelLineProtocolSink(xcelBatchSink):
+    """
+    Writes readings in InfluxDB line protocol, one line per reading
+    with the meter and endpoint as tags and each sensor as a field:
+
+        xcel,meter=Xcel_Itron_5,endpoint=Instantaneous_Demand value=1234.0 1706295600000000000
+
+    `target` is where to: a file path (or file:///path) to append to,
+    unix:///path for a socket (ie. telegraf's socket_listener), or an
+    http(s):// write url (ie. http://127.0.0.1:8086/api/v2/write?org=o&bucket=b)
+    which gets `token` as its Authorization if given.
+    """
+    def __init__(self, target: str, token: str = None, **kwargs):
+        parts = urlsplit(target)
+        self.scheme = parts.scheme if parts.scheme in ('file', 'unix', 'http', 'https') else 'file'
+        self.path = parts.path if parts.scheme in ('file', 'unix') else target
+        self.target = parts
+        self.token = token
+        self._conn = None
+        super().__init__(f'influx_{self.scheme}', **kwargs)
+
+    @staticmethod
+    def line(timestamp: float, meter: str, endpoint: str, reading: dict) -> str | None:
+        """
+        Returns: str, the reading as a line of line protocol, None if it has no values
+        """
+        fields = []
+        for sensor, value in reading.items():
+            if value is None:
+                continue
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                text = _escape(str(value), '"')
+                fields.append(f'{_escape(sensor, ",= ")}="{text}"')
+                continue
+            if math.isfinite(number):
+                fields.append(f'{_escape(sensor, ",= ")}={number!r}')
+        if not fields:
+            return None
+        tags = (f'meter={_escape(meter.replace(" ", "_"), ",= ")},'
+                f'endpoint={_escape(endpoint.replace(" ", "_"), ",= ")}')
+
+        return f'{MEASUREMENT},{tags} {",".join(fields)} {round(timestamp * 1e6) * 1000}\n'
+
+    def write(self, batch: list) -> None:
+        payload = ''.join(filter(None, (self.line(*item) for item in batch))).encode('utf-8')
+        if not payload:
+            return
+        if self.scheme == 'file':
+            with open(self.path, mode='ab') as file:
+                file.write(payload)
+        elif self.scheme == 'unix':
+            self._send(payload)
+        else:
+            self._post(payload)
+
+    def _send(self, payload: bytes) -> None:
+        # The listener may have restarted since the last batch, reconnect once
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._conn.settimeout(10)
+                try:
+                    self._conn.connect(self.path)
+                except OSError:
+                    self._conn.close()
+                    self._conn = None
+                    raise
+            try:
+                self._conn.sendall(payload)
+                return
+            except OSError:
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+    def _post(self, payload: bytes) -> None:
+        target = self.target.path + (f'?{self.target.query}' if self.target.query else '')
+        headers = {'Content-Type': 'text/plain; charset=utf-8'}
+        if self.token:
+            headers['Authorization'] = f'Token {self.token}'
+        # A kept-alive connection the server has since closed is retried on a new one
+        for attempt in range(2):
+            if self._conn is None:
+                connection = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+                self._conn = connection(self.target.hostname, self.target.port, timeout=10)
+            try:
+                self._conn.request('POST', target, body=payload, headers=headers)
+                response = self._conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+                continue
+            if response.status >= 300:
+                raise http.client.HTTPException(f'{response.status} from {self.target.geturl()}: '
+                                                f'{body[:200].decode("utf-8", "replace")}')
+            return
+
+class xcelJsonLinesSink(xcelBatchSink):
+    """
+    Writes readings to stdout (or the given stream) as one JSON object
+    per line, {"time": unix seconds, "meter", "endpoint", "reading": {sensor: value}},
+    for piping into whatever else wants them. Logging goes to stderr so
+    stdout only ever carries readings.
+    """
+    def __init__(self, stream=None, **kwargs):
+        self.stream = stream or sys.stdout
+        super().__init__('jsonl', **kwargs)
+
+    def write(self, batch: list) -> None:
+        self.stream.write(''.join(json.dumps({'time': timestamp, 'meter': meter,
+                                              'endpoint': endpoint, 'reading': reading}) + '\n'
+                                  for timestamp, meter, endpoint, reading in batch))
+        self.stream.flush()
+
+def build_sinks(spec: str, token: str = None, **kwargs) -> list:
+    """
+    Sinks from a comma separated list, each either `mqtt`, `stdout` for
+    JSON lines or a line protocol target (see xcelLineProtocolSink). Any
+    other keyword arguments go to every batched sink.
+
+    Returns: list of xcelSink
+    """
+    sinks = []
+    for target in (part.strip() for part in spec.split(',')):
+        if not target:
+            continue
+        if target == 'mqtt':
+            sinks.append(xcelMqttSink())
+        elif target == 'stdout':
+            sinks.append(xcelJsonLinesSink(**kwargs))
+        else:
+            sinks.append(xcelLineProtocolSink(target, token=token, **kwargs))
+    # Two of the same kind still need telling apart in the metrics
+    seen = {}
+    for sink in sinks:
+        seen[sink.name] = seen.get(sink.name, 0) + 1
+        if seen[sink.name] > 1:
+            sink.name = f'{sink.name}_{seen[sink.name]}'
+
+    return sinks
@@ -0,0 +1,153 @@
+import sqlite3
+import logging
+import threading
+import paho.mqtt.client as mqtt
+from time import monotonic
+
+# Local imports
+from xcelMetrics import metrics
+
+logger = logging.getLogger(__name__)
+
+class xcelSpool():
+    """
+    On-disk store-and-forward queue for readings that couldn't be
+    published. Lives in a SQLite database in WAL mode so a restart of the
+    bridge doesn't lose what's queued either. A background thread
+    replays the backlog in batches, paced to `rate` readings a second,
+    whenever the client is connected.
+
+    Measurement readings are coalesced, only the latest one per topic is
+    kept since homeassistant only cares about the current value. Totals
+    are all kept so no energy goes missing. When the spool is over
+    max_rows the oldest readings are evicted first.
+    """
+    # Readings published per replay batch
+    BATCH_SIZE = 100
+
+    def __init__(self, path: str, client: mqtt.Client, max_rows: int = 100000,
+                 rate: float = 50.0):
+        self.path = path
+        self.client = client
+        self.max_rows = max_rows
+        # Replay pace in readings per second, 0 for as fast as possible
+        self.rate = rate
+        self.spooled = 0
+        self.replayed = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Only lose the last few writes on power loss, not the spool
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS spool ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'topic TEXT NOT NULL, '
+                         'payload TEXT NOT NULL, '
+                         'retain INTEGER NOT NULL, '
+                         'coalesce INTEGER NOT NULL)')
+        # Finds the queued measurement a newer one replaces
+        self._db.execute('CREATE INDEX IF NOT EXISTS spool_latest '
+                         'ON spool (topic) WHERE coalesce = 1')
+        self._depth = self._db.execute('SELECT COUNT(*) FROM spool').fetchone()[0]
+        if self._depth:
+            logger.info(f"MQTT spool {path} has {self._depth} reading(s) waiting to be replayed")
+        metrics.add_collector(lambda: [('xcel_spool_depth', {}, self._depth)])
+        self._thread = threading.Thread(target=self._replay_loop, name='mqtt_spool', daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        return self._depth
+
+    def put(self, topic: str, payload: str, retain: bool = False, coalesce: bool = False) -> None:
+        """
+        Queue a reading to be published once the broker is back
+
+        Returns: None
+        """
+        with self._lock, self._db:
+            if coalesce:
+                # The replacement goes to the back of the queue with the newest readings
+                self._depth -= self._db.execute('DELETE FROM spool WHERE topic = ? AND coalesce = 1',
+                                                (topic,)).rowcount
+            self._db.execute('INSERT INTO spool (topic, payload, retain, coalesce) VALUES (?, ?, ?, ?)',
+                             (topic, str(payload), int(retain), int(coalesce)))
+            self._depth += 1
+            self.spooled += 1
+            if self._depth > self.max_rows:
+                excess = self._depth - self.max_rows
+                self._db.execute('DELETE FROM spool WHERE id IN '
+                                 '(SELECT id FROM spool ORDER BY id LIMIT ?)', (excess,))
+                self._depth -= excess
+                self.evicted += excess
+                metrics.inc('xcel_spool_evicted_total', excess)
+        metrics.inc('xcel_spool_writes_total')
+        self._wake.set()
+
+    def _next_batch(self) -> list:
+        # No more than a second's worth at a time so the pacing stays smooth
+        size = self.BATCH_SIZE if self.rate <= 0 else max(1, min(self.BATCH_SIZE, int(self.rate)))
+        with self._lock:
+            return self._db.execute('SELECT id, topic, payload, retain FROM spool '
+                                    'ORDER BY id LIMIT ?', (size,)).fetchall()
+
+    def _ack(self, ids: list) -> None:
+        if not ids:
+            return
+        with self._lock, self._db:
+            # Rows a newer measurement replaced while we were publishing are already gone
+            before = self._db.total_changes
+            self._db.executemany('DELETE FROM spool WHERE id = ?', [(i,) for i in ids])
+            self._depth -= self._db.total_changes - before
+
+    def replay(self) -> int:
+        """
+        Publish one batch of spooled readings in order, paced to the
+        replay rate. Stops at the first reading the client won't take.
+
+        Returns: integer, # of readings published
+        """
+        batch = self._next_batch()
+        sent = []
+        started = monotonic()
+        for row_id, topic, payload, retain in batch:
+            if not self.client.is_connected():
+                break
+            rc = self.client.publish(topic, payload, retain=bool(retain)).rc
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            sent.append(row_id)
+        self._ack(sent)
+        self.replayed += len(sent)
+        metrics.inc('xcel_spool_replayed_total', len(sent))
+        if sent and self.rate > 0:
+            remaining = len(sent) / self.rate - (monotonic() - started)
+            if remaining > 0:
+                self._stopped.wait(remaining)
+
+        return len(sent)
+
+    def _replay_loop(self) -> None:
+        while not self._stopped.is_set():
+            if self._depth and self.client.is_connected():
+                try:
+                    if self.replay():
+                        continue
+                except sqlite3.Error as e:
+                    logger.error(f"MQTT spool replay failed: {e}")
+            # Wake up on new readings, otherwise check on the broker every second
+            self._wake.wait(1.0)
+            self._wake.clear()
+
+    def stats(self) -> dict:
+        return {'depth': self._depth, 'spooled': self.spooled,
+                'replayed': self.replayed, 'evicted': self.evicted}
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+        with self._lock:
+            self._db.close()
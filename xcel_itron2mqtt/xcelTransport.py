@@ -0,0 +1,169 @@
+import ssl
+import socket
+import logging
+import threading
+from http.client import HTTPResponse, HTTPException, BadStatusLine
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# What a meter that quietly dropped an idle connection looks like on the next request
+_STALE = (ConnectionError, BadStatusLine, ssl.SSLEOFError, ssl.SSLZeroReturnError)
+
+class xcelTransport():
+    """
+    A lean alternative to the requests session for polling the meter.
+    Holds persistent TLS connections to the meter (one, unless
+    METER_CONCURRENCY asks for more), sends a GET built once per url and
+    hands back the body as the bytes read off the socket, so there's no
+    Response object, charset detection or decoding in between.
+
+    The ssl_context is the one CCM8Adapter builds. If it's a
+    ResumingSSLContext point its adapter here and reconnects resume the
+    last TLS session and are counted in connection_stats().
+    """
+    def __init__(self, ssl_context: ssl.SSLContext, pool_size: int = 1):
+        self.ssl_context = ssl_context
+        self.pool_size = max(1, pool_size)
+        # Idle connections, as (host, port, socket), most recently used last
+        self._idle = []
+        self._lock = threading.Lock()
+        # {url: (host, port, request bytes)}
+        self._requests = {}
+        self._stats = {'requests': 0, 'handshakes': 0, 'resumptions': 0, 'reused': 0}
+        self._closed = False
+
+    def get(self, url: str, timeout: float = 15.0) -> bytes:
+        """
+        GET the url, on an idle connection if there is one. A connection
+        the meter dropped while idle is retried once on a new one.
+
+        Returns: bytes, the body of the response
+        """
+        host, port, request = self._request(url)
+        sock = self._checkout(host, port)
+        reused = sock is not None
+        if sock is None:
+            sock = self._connect(host, port, timeout)
+        try:
+            status, body, keep_alive = self._exchange(sock, request, timeout)
+        except _STALE as e:
+            sock.close()
+            if not reused:
+                raise
+            logger.debug(f"Idle connection to {host}:{port} was dropped ({e!r}), reconnecting")
+            reused = False
+            sock = self._connect(host, port, timeout)
+            try:
+                status, body, keep_alive = self._exchange(sock, request, timeout)
+            except BaseException:
+                sock.close()
+                raise
+        except BaseException:
+            sock.close()
+            raise
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['reused'] += reused
+        if keep_alive:
+            self._checkin(host, port, sock)
+        else:
+            sock.close()
+        if status >= 400:
+            raise HTTPException(f'{status} Error for url: {url}')
+
+        return body
+
+    def _request(self, url: str) -> tuple:
+        """
+        Returns: tuple of (host, port, the request's bytes), built once per url
+        """
+        request = self._requests.get(url)
+        if request is None:
+            parts = urlsplit(url)
+            target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+            head = (f'GET {target} HTTP/1.1\r\n'
+                    f'Host: {parts.netloc}\r\n'
+                    'Accept: */*\r\n'
+                    'Accept-Encoding: identity\r\n'
+                    'Connection: keep-alive\r\n'
+                    '\r\n')
+            request = self._requests[url] = (parts.hostname, parts.port or 443, head.encode('ascii'))
+
+        return request
+
+    @staticmethod
+    def _exchange(sock: ssl.SSLSocket, request: bytes, timeout: float) -> tuple:
+        """
+        Returns: tuple of (status, body bytes, whether the connection can be reused)
+        """
+        sock.settimeout(timeout)
+        sock.sendall(request)
+        response = HTTPResponse(sock, method='GET')
+        try:
+            response.begin()
+            body = response.read()
+        finally:
+            response.close()
+
+        return response.status, body, not response.will_close
+
+    def _connect(self, host: str, port: int, timeout: float) -> ssl.SSLSocket:
+        raw = socket.create_connection((host, port), timeout)
+        try:
+            # Have the OS probe idle connections, and don't hold back the small request
+            raw.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return self.ssl_context.wrap_socket(raw)
+        except BaseException:
+            raw.close()
+            raise
+
+    def _checkout(self, host: str, port: int) -> ssl.SSLSocket | None:
+        stale = []
+        sock = None
+        with self._lock:
+            while self._idle:
+                idle_host, idle_port, idle_sock = self._idle.pop()
+                if (idle_host, idle_port) == (host, port):
+                    sock = idle_sock
+                    break
+                # The meter moved, see xcelMeter.set_address
+                stale.append(idle_sock)
+        for old in stale:
+            old.close()
+
+        return sock
+
+    def _checkin(self, host: str, port: int, sock: ssl.SSLSocket) -> None:
+        with self._lock:
+            if not self._closed and len(self._idle) < self.pool_size:
+                self._idle.append((host, port, sock))
+                return
+        sock.close()
+
+    def _record_connection(self, resumed: bool) -> None:
+        # Called by ResumingSSLContext for every new connection
+        with self._lock:
+            self._stats['resumptions' if resumed else 'handshakes'] += 1
+        logger.debug(f"New meter connection, TLS session {'resumed' if resumed else 'full handshake'}")
+
+    def connection_stats(self) -> dict:
+        """
+        Same as CCM8Adapter.connection_stats
+
+        Returns: dict, {'requests': #, 'handshakes': #, 'resumptions': #, 'reused': #}
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def idle_connections(self) -> int:
+        with self._lock:
+            return len(self._idle)
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for _, _, sock in idle:
+            sock.close()